@@ -5,27 +5,31 @@ import threading
 
 import queue
 
-import socket
+import asyncio
 
-import csv 
+import socket
 
 import time
-import datetime
 
 import optparse
 
 import sys
 
-import os
-
 from PIL import Image, ImageTk
-import cv2 
 import numpy as np
 
 import serial
 
 from enum import Enum
 
+import EventLogger
+import FrameProcessing
+import FrameStacking
+import FrameStorage
+import PacketCapture
+import ParallelDecode
+import TelemetryStore
+
 class PacketType(Enum):
     """Enum for packet types."""
     TYPE_INVALID = 0
@@ -43,6 +47,10 @@ class PacketType(Enum):
     TYPE_IMAGE_DATA = 10
     TYPE_IMAGE_END = 11
     TYPE_TELEMETRY = 12
+    # Rx types, continued
+    TYPE_ROW_REQUEST = 13
+    # Tx types, continued - generated by CMOSReadoutInterface rather than sent by the PCB
+    TYPE_IMAGE_PROGRESS = 14
 
 
 
@@ -60,6 +68,9 @@ CMD_P_CMOS_SETTING = "AA87"
 # Get CMOS Setting
 CMD_P_GET_CMOS = "AA78"
 CMD_WRITE_FLASH = "FFFF"
+# Row range retransmission request - followed by start row (4 hex digits), row count (4 hex digits) and bitmask of sections to resend (2 hex digits)
+# The PCB answers each request with the requested image row packets followed by an image end packet
+CMD_P_ROW_REQUEST = "CCAA"
 
 # PCB to GUI
 # Acknowledge
@@ -71,15 +82,60 @@ SIG_IMAGE_DATA = "CC"
 # Image data end
 SIG_IMAGE_END = "CC0F"
 # Telemetry
-SIG_TELEMETRY = "33"
+SIG_TELEMETRY = f"{TelemetryStore.TELEMETRY_HEADER:02X}"
+
+# Byte forms of the above, for matching headers against raw received data without converting it to hex
+_SIG_ACK_BYTES = bytes.fromhex(SIG_ACK)
+_SIG_IMAGE_START_BYTES = bytes.fromhex(SIG_IMAGE_START)
+_SIG_IMAGE_DATA_BYTES = bytes.fromhex(SIG_IMAGE_DATA)
+_SIG_IMAGE_END_BYTES = bytes.fromhex(SIG_IMAGE_END)
+_SIG_TELEMETRY_BYTES = bytes.fromhex(SIG_TELEMETRY)
+
+# Packet lengths in bytes, including header, used to split the serial byte stream into packets
+# The telemetry layout is defined once, in TelemetryStore, which also decodes telemetry in bulk
+TELEMETRY_PACKET_LENGTH = TelemetryStore.TELEMETRY_PACKET_STRUCT.size
+_TELEMETRY_STRUCT = TelemetryStore.TELEMETRY_PACKET_STRUCT # Header, state, temp1, temp2, voltage, fault code
+TELEMETRY_STATE_NAMES = TelemetryStore.TELEMETRY_STATE_BYTES
+ACK_PACKET_LENGTH = 3 # SIG_ACK followed by the 2-byte command being acknowledged - assumed from the simulator, see README
+IMAGE_MARKER_LENGTH = 2 # SIG_IMAGE_START / SIG_IMAGE_END
 
 PKTS_PER_ROW = 4
 #IMAGE_DATA_LENGTH = (IMAGE_WIDTH * 3 // PKTS_PER_ROW) # Length of data part of image row packet in bytes, no header or leader - normally 6144, depends on row length
 
+RX_BUFFER_SIZE = 4096 # Largest datagram expected from the PCB, in bytes
+RX_BUFFER_COUNT = 256 # Number of preallocated receive buffers used in zero-copy mode
+RX_BATCH_SIZE = 256 # Most datagrams drained from the socket and decoded together by getPackets
+RX_SOCKET_BUFFER_SIZE = 8 * 1024 * 1024 # Requested kernel receive buffer size (SO_RCVBUF), in bytes - absorbs bursts between drains
+
+# Threaded pipeline (see CMOSReadoutInterface.start)
+RX_QUEUE_DEPTH = 2048 # Most received datagrams waiting to be decoded before the receiver starts dropping
+SUBSCRIBER_QUEUE_DEPTH = 8 # Most finished packets waiting for each subscriber before its oldest are dropped
+PIPELINE_POLL_INTERVAL = 0.5 # Seconds the receiver thread waits for data before checking whether it should stop
+
+FRAME_POOL_SIZE = 4 # Preallocated full-resolution frame buffers - one being assembled, the rest held by consumers
+
+PROGRESS_INTERVAL = 0.1 # Least seconds between TYPE_IMAGE_PROGRESS packets in progressive mode
+
+MAX_RETRANSMIT_ATTEMPTS = 2 # Rounds of row range requests for one frame before it is delivered with holes
+MAX_RETRANSMIT_REQUESTS = 64 # Most row range requests sent in one round
+
+# Pixel packing lives in FrameProcessing, so decode worker processes can use it without importing this module
+_packed_12bit_length = FrameProcessing.packed_12bit_length
+unpack_12bit = FrameProcessing.unpack_12bit
+pack_12bit = FrameProcessing.pack_12bit
+
 class Packet:
     """
     Class representing all types of packet, with fields for type and data fields.
-    The data type in each field may depend on the packet type. For example, a TYPE_IMAGE_DATA packet has field "data1" as a 2D numpy array of the scaled-down image
+    The data type in each field may depend on the packet type. For example, a TYPE_IMAGE_DATA packet has field "data1" as a 2D numpy array of the scaled-down image,
+    and field "data2" as a FrameBuffer holding the full-resolution 12-bit frame. Whoever receives a TYPE_IMAGE_DATA packet must call release() when done with it.
+    Its field "data3" is the frame's FrameProcessing.FrameStatistics (mean, standard deviation, min, max, saturated pixels and histogram),
+    of the pixel values as received, before any calibration. Each row section is counted once, as it was when first counted:
+    if a later copy (a retransmission or duplicate) differs, the frame holds the later copy but the statistics describe the earlier one.
+    A TYPE_IMAGE_PROGRESS packet (progressive mode only) reports a frame still being assembled: "data1" is the (start, end) range of rows updated
+    since the last progress packet, "data2" the FrameBuffer being filled in, "data3" a copy of which (row, section) pairs have arrived so far,
+    and "data4" the number the frame will have once complete. It must also be released.
+    A TYPE_ACK packet's "data1" is the acknowledged command, as a hex string such as "CCF0".
     """
     def __init__(self, type, data1=None, data2=None, data3=None, data4=None):
         self.type = type
@@ -87,7 +143,81 @@ class Packet:
         self.data2 = data2
         self.data3 = data3
         self.data4 = data4
+
+    def retain(self):
+        """Take an extra reference to any pooled frame buffer in this packet, for handing it to another consumer."""
+        if (isinstance(self.data2, FrameBuffer)):
+            self.data2.retain()
+
+    def release(self):
+        """Give back this holder's reference to any pooled frame buffer in this packet."""
+        if (isinstance(self.data2, FrameBuffer)):
+            self.data2.release()
+
+class FrameBuffer:
+    """
+    A preallocated full-resolution frame, lent out by a FramePool.
+    Reference counted - it goes back to its pool once every holder has called release().
+    """
+    def __init__(self, pool, height, width, dtype, array=None, index=0):
+        self.array = np.zeros((height, width), dtype=dtype) if array is None else array # Pixel data, all zeros while in the pool
+        self.index = index # Position in the pool
+        self.frame_number = -1 # Sequence number of the frame held, set when the frame completes
+        self.timestamp = 0.0 # Unix time the frame completed
+        self.assembly_seconds = 0.0 # Time from the frame's first row packet being decoded to its completion
+        self._pool = pool
+        self._refs = 0
+
+    def retain(self):
+        with self._pool._lock:
+            self._refs += 1
+
+    def release(self):
+        with self._pool._lock:
+            self._refs -= 1
+            if (self._refs > 0):
+                return
+        self._pool._return(self)
+
+class FramePool:
+    """
+    Fixed set of full-resolution frame buffers, reused so that steady-state capture does no large allocations.
+    Memory stays bounded - if consumers hold every buffer, acquire returns None rather than allocating more.
+    """
+    def __init__(self, count, height, width, dtype=np.int32, arrays=None):
+        """
+        Args:
+            arrays (np.ndarray): (count, height, width) zeroed array to use for the buffers, e.g. in shared memory, or None to allocate them.
+        """
+        self._lock = threading.Lock()
+        self._buffers = [FrameBuffer(self, height, width, dtype, None if arrays is None else arrays[i], i) for i in range(count)]
+        self._free = list(self._buffers)
+
+    def acquire(self):
+        """
+        Take a zeroed buffer from the pool, holding one reference to it.
+        Returns:
+            FrameBuffer: The buffer, or None if every buffer is in use.
+        """
+        with self._lock:
+            if (len(self._free) == 0):
+                return None
+            buffer = self._free.pop()
+            buffer._refs = 1
+            return buffer
+
+    def free_count(self):
+        """Number of buffers available to acquire."""
+        with self._lock:
+            return len(self._free)
+
+    def _return(self, buffer):
+        # Zero on return, on the releasing consumer's thread rather than the assembling one
+        buffer.array.fill(0)
+        with self._lock:
+            self._free.append(buffer)
         
+
 class Telemetry:
     """Class representing telemetry data."""
     def __init__(self, state="", temp1=0.0, temp2=0.0, voltage=0.0, fault_code=-1):
@@ -97,181 +227,1180 @@ class Telemetry:
         self.voltage = voltage
         self.fault_code = fault_code
 
+    @staticmethod
+    def from_bytes(data):
+        """
+        Parse a raw telemetry packet: header (0x33), state, temp1, temp2 and voltage (16-bit), fault code (32-bit), all big-endian.
+        Args:
+            data (bytes-like): The whole packet, including header.
+        Returns:
+            Telemetry: The readings, or None if data is not a telemetry packet of the right length.
+        """
+        if (len(data) != TELEMETRY_PACKET_LENGTH or data[0] != _SIG_TELEMETRY_BYTES[0]):
+            return None
+        header, state, temp1, temp2, voltage, faultCode = _TELEMETRY_STRUCT.unpack(data)
+        # Adjust temperatures and voltage here depending on how values are formatted
+        return Telemetry(TELEMETRY_STATE_NAMES.get(state, "Invalid mode"), float(temp1), float(temp2), float(voltage), faultCode)
+
     @staticmethod
     def from_hex(hex_str):
-        """Convert a hex string from a telemetry packet to a Telemetry object."""
-        if len(hex_str) != 24:
+        """
+        Convert a hex string from a telemetry packet to a Telemetry object.
+        Returns:
+            Telemetry: The readings, or None if hex_str is not a telemetry packet of the right length.
+        """
+        if len(hex_str) != TELEMETRY_PACKET_LENGTH * 2:
             print("Telemetry hex string has incorrect length")
-        
-        # Function assumes system header (0x33) occupies position 0:2 of hex_str
-        state = "Standby mode" if (hex_str[2:4].casefold() == "0F".casefold()) else "Image collection mode" if (hex_str[2:4].casefold() == "F0".casefold()) else "Invalid mode"
-        temp1 = float(int(hex_str[4:8], 16)) # Adjust this depending on how values are formatted in hex
-        temp2 = float(int(hex_str[8:12], 16))
-        voltage = float(int(hex_str[12:16], 16))
-        faultCode = int(hex_str[16:24], 16)
-        
-        return Telemetry(state, temp1, temp2, voltage, faultCode)
+            return None
+        return Telemetry.from_bytes(bytes.fromhex(hex_str))
     
+def _set_socket_buffer_size(sock, size):
+    """Request a kernel receive buffer of size bytes for a UDP socket. The OS may grant less."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    except (OSError, AttributeError) as e:
+        print(f"Unable to set UDP receive buffer size: {e}")
+
+# Command sent for each packet type, GUI to PCB. Types with a "CMD_P" command have the packet's data1 hex string concatenated
+_PACKET_COMMANDS = {
+    PacketType.TYPE_IMAGE_ENABLE: CMD_P_IMAGE_ENABLE,
+    PacketType.TYPE_IMAGE_REQUEST: CMD_IMAGE_REQUEST,
+    PacketType.TYPE_RESET: CMD_RESET,
+    PacketType.TYPE_ABORT: CMD_ABORT,
+    PacketType.TYPE_CMOS_SETTING: CMD_P_CMOS_SETTING,
+    PacketType.TYPE_GET_CMOS: CMD_P_GET_CMOS,
+    PacketType.TYPE_FLASH_WRITE: CMD_WRITE_FLASH,
+    PacketType.TYPE_ROW_REQUEST: CMD_P_ROW_REQUEST,
+}
+
+def encode_packet(packet):
+    """
+    Convert a command Packet to the bytes sent to the PCB.
+    Args:
+        packet (Packet): Packet of one of the Rx types. For TYPE_CMOS_SETTING and TYPE_GET_CMOS, data1 is the setting as a hex string,
+            and for TYPE_ROW_REQUEST it is the row range (see row_request_packet).
+            For TYPE_IMAGE_ENABLE, data1 may hold a 16-character hex timestamp, otherwise the current Unix time is used.
+    Returns:
+        bytes: The encoded command.
+    """
+    if (packet.type not in _PACKET_COMMANDS):
+        raise ValueError(f"Packet type {packet.type} cannot be sent to the PCB")
+
+    packet_hex = _PACKET_COMMANDS[packet.type]
+    if (packet.type == PacketType.TYPE_IMAGE_ENABLE):
+        packet_hex += packet.data1 if packet.data1 != None else format(int(time.time()), '016x')
+    elif (packet.type in (PacketType.TYPE_CMOS_SETTING, PacketType.TYPE_GET_CMOS, PacketType.TYPE_ROW_REQUEST) and packet.data1 != None):
+        packet_hex += packet.data1
+    return bytes.fromhex(packet_hex)
+
+def row_request_packet(start_row, row_count, section_mask):
+    """
+    Build a packet asking the PCB to resend some sections of a range of rows of the current frame.
+    Args:
+        start_row (int): First row to resend.
+        row_count (int): Number of consecutive rows to resend.
+        section_mask (int): Bit n set to resend section n of each row.
+    Returns:
+        Packet: TYPE_ROW_REQUEST packet.
+    """
+    return Packet(type=PacketType.TYPE_ROW_REQUEST, data1=format(start_row, '04x') + format(row_count, '04x') + format(section_mask, '02x'))
+
+def coalesce_missing_sections(rows_filled, max_requests=None):
+    """
+    Group the unfilled (row, section) entries of a frame into as few row range requests as possible.
+    Consecutive rows with anything missing become one range, requesting every section missing from any of them.
+    If that still gives more than max_requests ranges, the smallest gaps between ranges are bridged until it does not.
+    Args:
+        rows_filled (np.ndarray): (rows, PKTS_PER_ROW) bool array, True where a section has been received.
+        max_requests (int): Most ranges to return, or None for no limit.
+    Returns:
+        list: (start_row, row_count, section_mask) tuples, in row order.
+    """
+    masks = (~rows_filled).astype(np.uint8) @ (1 << np.arange(rows_filled.shape[1], dtype=np.uint8))
+    rows = np.flatnonzero(masks)
+    if (rows.size == 0):
+        return []
+
+    gap = 1
+    while (True):
+        breaks = np.flatnonzero(np.diff(rows) > gap) + 1
+        if (max_requests == None or breaks.size + 1 <= max_requests):
+            break
+        gap *= 2
+
+    ranges = []
+    for run in np.split(rows, breaks):
+        start = int(run[0])
+        count = int(run[-1]) - start + 1
+        ranges.append((start, count, int(np.bitwise_or.reduce(masks[start:start + count]))))
+    return ranges
+
+class PacketSubscription:
+    """
+    A consumer's view of the packets published by a running CMOSReadoutInterface pipeline.
+    Each subscription has its own bounded queue, so a slow consumer only loses its own oldest packets
+    and never holds up decoding or other consumers.
+    """
+    def __init__(self, types=None, maxsize=SUBSCRIBER_QUEUE_DEPTH):
+        self.types = types # Packet types delivered to this subscription, or None for all
+        self.dropped = 0 # Packets discarded because this consumer fell behind
+        self.closed = False
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def _offer(self, packet):
+        """Queue a packet for the consumer, discarding the oldest queued packet if full. Called by the decoder thread."""
+        if (self.types != None and packet.type not in self.types):
+            return
+        packet.retain()
+        while (True):
+            try:
+                self._queue.put_nowait(packet)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait().release()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _close(self):
+        """Wake the consumer with an end marker once the pipeline stops."""
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def get_all(self, timeout=None):
+        """
+        Wait for the next packet, then return it along with every other packet already queued.
+        Call release() on each packet when done with it.
+        Args:
+            timeout (float): Seconds to wait for the first packet, or None to wait indefinitely.
+        Returns:
+            list: Packets in the order they were published. Empty on timeout or once the pipeline has stopped.
+        """
+        if (self.closed and self._queue.empty()):
+            return []
+        try:
+            packets = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while (True):
+            try:
+                packets.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return [packet for packet in packets if packet != None]
+
+    def take_latest(self):
+        """
+        Without waiting, take the newest packet queued and release any older ones - for consumers that only want the latest value,
+        such as a display. Call release() on the returned packet when done with it.
+        Returns:
+            Packet: The newest packet, or None if nothing is queued.
+        """
+        latest = None
+        for packet in self.get_all(timeout=0):
+            if (latest != None):
+                latest.release()
+                self.dropped += 1
+            latest = packet
+        return latest
+
+    def qsize(self):
+        """Number of packets waiting for the consumer."""
+        return self._queue.qsize()
+
 class CMOSReadoutInterface:
     """Main interface class for CMOS readout operations."""
 
-    def __init__(self, image_height, image_width, socket=None, serial_port=None, transmission_udp=True, enable_save_images=False, image_save_dir = None):
+    def __init__(self, image_height, image_width, socket=None, serial_port=None, transmission_udp=True, enable_save_images=False, image_save_dir = None, zero_copy_receive=False, rx_buffer_count=RX_BUFFER_COUNT, rx_socket_buffer_size=RX_SOCKET_BUFFER_SIZE, rx_queue_depth=RX_QUEUE_DEPTH, remote_address=None, frame_pool_size=FRAME_POOL_SIZE, enable_retransmission=False, max_retransmit_attempts=MAX_RETRANSMIT_ATTEMPTS, save_workers=FrameStorage.DEFAULT_WRITERS, save_queue_depth=FrameStorage.DEFAULT_WRITE_QUEUE_DEPTH, save_compression=FrameStorage.DEFAULT_PNG_COMPRESSION, save_policy=FrameStorage.POLICY_DROP, replay=None, logger=None, telemetry_capacity=TelemetryStore.DEFAULT_TELEMETRY_CAPACITY, preview_binning=FrameProcessing.PREVIEW_BINNING, progressive=False, progress_interval=PROGRESS_INTERVAL, display_mapping=None, calibration=None, decode_workers=0):
         self.image_height = image_height
         self.image_width = image_width
         self.socket = socket # UDP socket to transmit to
+        self.remote_address = remote_address # (IP, port) of the PCB, to send packets to over UDP
         self.serial_port = serial_port # Serial port, alternate communication method
         self.transmission_udp = transmission_udp # True if using UDP, false if using serial
         self.enable_save_images = enable_save_images # True if images should be saved to disk
         self.image_save_dir = image_save_dir # Directory to save images to, if desired
+        self.preview_binning = preview_binning # Binning factor of the 8-bit preview sent with each frame
+        # Curve and contrast of the 8-bit preview - a linear stretch of the full 12-bit range unless given otherwise
+        self.display_mapping = display_mapping if display_mapping != None else FrameProcessing.DisplayMapping()
+        self.calibration = calibration # Calibration.Calibrator applied to each finished frame, or None to leave frames raw
+        self.stacker = None # FrameStacking stacker each finished frame is added to, while stacking
+        self.progressive = progressive # True to report partially received frames as TYPE_IMAGE_PROGRESS packets
+        self.progress_interval = progress_interval # Least seconds between progress packets
+
+        # Images are saved by a pool of background writers, created the first time a frame is saved
+        self.save_workers = save_workers
+        self.save_queue_depth = save_queue_depth
+        self.save_compression = save_compression # PNG compression level, 0-9
+        self.save_policy = save_policy # What to do when the writers fall behind - see FrameStorage.POLICY_*. Drop by default, so a slow disk never stalls decoding
+        self.image_writer = None
+        self.recorder = None # FrameStorage.FrameRecorder raw frames are appended to while recording
+        self.capture = None # PacketCapture.PacketCaptureWriter received datagrams are written to while capturing
+        self.replay = replay # PacketCapture.PacketReplay to receive datagrams from instead of the PCB
+        self.logger = logger if logger != None else EventLogger.default_logger() # Events are queued here and written to disk in the background
+        self.zero_copy_receive = zero_copy_receive # True to receive into preallocated buffers with recvfrom_into
+
+        # Pool of preallocated receive buffers, reused in rotation in zero-copy mode
+        self._rx_buffers = [bytearray(RX_BUFFER_SIZE) for _ in range(rx_buffer_count if zero_copy_receive else 0)]
+        self._rx_views = [memoryview(buffer) for buffer in self._rx_buffers]
+        self._rx_index = 0
+
+        # Ask the kernel for a larger receive buffer, so bursts queue up between drains instead of overrunning
+        if (self.socket != None and rx_socket_buffer_size):
+            _set_socket_buffer_size(self.socket, rx_socket_buffer_size)
 
         self.latest_packet = Packet(PacketType.TYPE_INVALID) # Latest packet received from PCB
+        self.telemetry_history = TelemetryStore.TelemetryStore(telemetry_capacity) # Every telemetry reading received, oldest overwritten once full
 
-        # Image frame built up as packets are received
-        self._frame = np.zeros((self.image_height, self.image_width), dtype=np.int32) 
+        # Image frame built up as packets are received, in a buffer from a fixed pool handed to consumers when complete
+        # Frames waiting for the image writers hold a buffer each, so the pool is grown to cover them
+        if (self.enable_save_images):
+            frame_pool_size += save_workers + save_queue_depth
+        # With decode workers, the frame buffers and the received-sections tracker are in shared memory for the worker processes to write to
+        self.decode_workers = None # ParallelDecode.ParallelDecoder, or None to decode on the decoder thread
+        if (decode_workers > 0):
+            self.decode_workers = ParallelDecode.ParallelDecoder(self.image_height, self.image_width, frame_pool_size, PKTS_PER_ROW,
+                                                                 4 + _packed_12bit_length(self.image_width // PKTS_PER_ROW), RX_BATCH_SIZE, workers=decode_workers)
+        self.frame_pool = FramePool(frame_pool_size, self.image_height, self.image_width, dtype=np.int32,
+                                    arrays=None if self.decode_workers == None else self.decode_workers.frames)
+        self._assembly = self.frame_pool.acquire()
+        self._frame = self._assembly.array
+        self._frame_count = 0
+        self._dirty_start = self.image_height # Rows updated since the last progress packet, start to end inclusive
+        self._dirty_end = -1
+        self._last_progress = 0.0
+        self._histogram = np.zeros(FrameProcessing.MAX_PIXEL_VALUE + 1, dtype=np.int64) # Of the frame being assembled, built up section by section
+        # New sections decoded one packet at a time, waiting to be added to the histogram together
+        self._pending_rows = np.zeros(RX_BATCH_SIZE, dtype=np.intp)
+        self._pending_sections = np.zeros(RX_BATCH_SIZE, dtype=np.intp)
+        self._pending_count = 0
+        self._frame_start_time = None # perf_counter time the first row packet of the frame being assembled was decoded
+
+        # Selective retransmission of missing row sections at image end
+        self.enable_retransmission = enable_retransmission # True to request missing row sections before delivering a frame
+        self.max_retransmit_attempts = max_retransmit_attempts
+        self._retransmit_attempts = 0 # Rounds requested so far for the frame being assembled
+        self._retransmit_pending = 0 # Row requests in the current round not yet answered with an image end
 
         # Tracker array for if corresponding row+section in frame is filled
-        self._rows_filled = np.ndarray((self.image_height, PKTS_PER_ROW), dtype=bool)
+        self._rows_filled = np.ndarray((self.image_height, PKTS_PER_ROW), dtype=bool) if self.decode_workers == None else self.decode_workers.rows_filled
         self._rows_filled.fill(False)
 
+        # Scratch arrays reused by getPackets to decode a batch of row packets in one step
+        self._section_width = self.image_width // PKTS_PER_ROW
+        self._section_bytes = _packed_12bit_length(self._section_width)
+        self._min_row_packet_length = min(500, self._section_bytes) # Shorter image packets are start/end markers - 500 for full-width rows
+        self._batch_payloads = np.zeros((RX_BATCH_SIZE, self._section_bytes), dtype=np.uint8)
+        self._batch_pixels = np.zeros((RX_BATCH_SIZE, self._section_width), dtype=np.int32)
+        self._batch_rows = np.zeros(RX_BATCH_SIZE, dtype=np.intp)
+        self._batch_sections = np.zeros(RX_BATCH_SIZE, dtype=np.intp)
+
+        # Bytes received over serial and not yet split into packets
+        self._serial_buffer = bytearray()
+        self._serial_offset = 0
+
+        # Threaded pipeline state (see start)
+        self.rx_queue_depth = rx_queue_depth # Most datagrams in flight between receiver and decoder
+        self._pipeline_running = False
+        self._pipeline_stop = threading.Event()
+        self._pipeline_threads = []
+        self._rx_queue = queue.Queue() # Batches of datagrams, bounded by _rx_slots rather than by maxsize
+        self._rx_slots = None
+        self._rx_discard = bytearray(RX_BUFFER_SIZE) # Scratch buffer that overflow datagrams are read into and dropped
+        self._subscriptions = []
+        self._subscriptions_lock = threading.Lock()
+        self._pipeline_counters = {"rx_datagrams": 0, "rx_dropped": 0, "decoded_datagrams": 0, "published_packets": 0, "frames_completed": 0, "frames_dropped": 0, "retransmit_requests": 0, "retransmit_bytes_saved": 0}
+
 
     
+    def start(self):
+        """
+        Start the threaded pipeline: a receiver thread that only moves datagrams from the socket (or packets from the serial port)
+        into a bounded queue, and a decoder thread that assembles frames and publishes finished packets to subscribers (see subscribe).
+        getPacket and getPackets must not be used while the pipeline is running.
+        """
+        if (self._pipeline_running):
+            return
+        if (self.replay != None):
+            receiver = self._replay_loop
+        elif (self.transmission_udp and self.socket != None):
+            receiver = self._receiver_loop
+        elif (not self.transmission_udp and self.serial_port != None and self.serial_port.is_open):
+            receiver = self._serial_receiver_loop
+        else:
+            print("No UDP socket or open serial port detected, unable to start receive pipeline")
+            return
+
+        # In zero-copy mode every datagram in flight occupies one pool buffer, so the pool bounds the queue
+        if (self.zero_copy_receive and len(self._rx_views) < self.rx_queue_depth):
+            self._rx_buffers = [bytearray(RX_BUFFER_SIZE) for _ in range(self.rx_queue_depth)]
+            self._rx_views = [memoryview(buffer) for buffer in self._rx_buffers]
+        self._rx_index = 0
+        self._rx_slots = threading.Semaphore(self.rx_queue_depth)
+
+        self._pipeline_stop.clear()
+        self._pipeline_running = True
+        self._pipeline_threads = [
+            threading.Thread(target=receiver, name="CMOS receiver", daemon=True),
+            threading.Thread(target=self._decoder_loop, name="CMOS decoder", daemon=True),
+        ]
+
+        for thread in self._pipeline_threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        """
+        Stop the threaded pipeline, after the decoder has processed everything already received.
+        Args:
+            timeout (float): Seconds to wait for each pipeline thread to finish.
+        """
+        if (not self._pipeline_running):
+            return
+        self._pipeline_stop.set()
+        for thread in self._pipeline_threads:
+            thread.join(timeout=timeout)
+        self._pipeline_threads = []
+        self._pipeline_running = False
+
+    def subscribe(self, types=None, maxsize=SUBSCRIBER_QUEUE_DEPTH):
+        """
+        Subscribe to packets published by the pipeline, such as finished frames and telemetry.
+        Args:
+            types (tuple): PacketTypes to receive, or None for all.
+            maxsize (int): Most packets held for this consumer before its oldest are dropped.
+        Returns:
+            PacketSubscription: Queue of packets for the consumer to read from its own thread.
+        """
+        subscription = PacketSubscription(types=types, maxsize=maxsize)
+        with self._subscriptions_lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop delivering packets to a subscription."""
+        with self._subscriptions_lock:
+            if (subscription in self._subscriptions):
+                self._subscriptions.remove(subscription)
+        subscription._close()
+
+    def pipeline_stats(self):
+        """
+        Snapshot of pipeline queue depths and counters, for display or logging.
+        Returns:
+            dict: Datagrams received, dropped and decoded, current receive queue depth and capacity,
+                and per-subscriber queue depth and drop counts.
+        """
+        stats = dict(self._pipeline_counters)
+        stats["rx_queue_depth"] = stats["rx_datagrams"] - stats["decoded_datagrams"]
+        stats["rx_queue_capacity"] = self.rx_queue_depth
+        stats["frame_pool_free"] = self.frame_pool.free_count()
+        stats["decode_workers"] = self.decode_workers.workers if self.decode_workers != None else 0
+        if (self.image_writer != None):
+            stats["image_writer"] = self.image_writer.stats()
+        recorder = self.recorder
+        if (recorder != None):
+            stats["recorded_frames"] = recorder.frame_count
+        with self._subscriptions_lock:
+            stats["subscribers"] = [{"types": subscription.types, "queued": subscription.qsize(), "dropped": subscription.dropped} for subscription in self._subscriptions]
+        return stats
+
+    def _receiver_loop(self):
+        """Receiver thread: move datagrams from the socket into the receive queue as fast as possible, and nothing else."""
+        sock = self.socket
+        counters = self._pipeline_counters
+        try:
+            sock.settimeout(PIPELINE_POLL_INTERVAL)
+        except OSError:
+            pass
+
+        while (not self._pipeline_stop.is_set()):
+            batch = []
+            try:
+                # Wait for the first datagram, then drain everything else already queued without blocking
+                data = self._receive_into_slot(sock)
+                if (data != None):
+                    batch.append(data)
+                sock.setblocking(False)
+                try:
+                    while (len(batch) < RX_BATCH_SIZE):
+                        data = self._receive_into_slot(sock)
+                        if (data != None):
+                            batch.append(data)
+                except (BlockingIOError, InterruptedError):
+                    pass
+                finally:
+                    sock.settimeout(PIPELINE_POLL_INTERVAL)
+            except socket.timeout:
+                pass
+            except OSError:
+                # Socket closed, expecting GUI to close
+                if (len(batch) == 0):
+                    break
+
+            if (len(batch) > 0):
+                counters["rx_datagrams"] += len(batch)
+                self._capture(batch)
+                self._rx_queue.put(batch)
+
+        self._rx_queue.put(None) # Tell the decoder nothing more is coming
+
+    def _serial_receiver_loop(self):
+        """Receiver thread for a serial link: split the byte stream into packets and move them into the receive queue, and nothing else."""
+        port = self.serial_port
+        counters = self._pipeline_counters
+        try:
+            port.timeout = PIPELINE_POLL_INTERVAL
+        except (AttributeError, ValueError):
+            pass
+
+        while (not self._pipeline_stop.is_set()):
+            try:
+                # Wait for at least one byte, then take everything else already waiting
+                data = port.read(max(1, port.in_waiting))
+            except OSError:
+                break # Port closed
+            if (len(data) > 0):
+                self._serial_buffer += data
+
+            batch = []
+            packet = self._next_serial_packet()
+            while (packet != None):
+                if (self._rx_slots.acquire(blocking=False)):
+                    batch.append(packet)
+                else:
+                    counters["rx_dropped"] += 1 # Decoder has fallen behind
+                if (len(batch) == RX_BATCH_SIZE):
+                    counters["rx_datagrams"] += len(batch)
+                    self._capture(batch)
+                    self._rx_queue.put(batch)
+                    batch = []
+                packet = self._next_serial_packet()
+            if (len(batch) > 0):
+                counters["rx_datagrams"] += len(batch)
+                self._capture(batch)
+                self._rx_queue.put(batch)
+
+        self._rx_queue.put(None)
+
+    def _replay_loop(self):
+        """Receiver thread when replaying a capture: move datagrams into the receive queue as they fall due, never dropping any."""
+        counters = self._pipeline_counters
+        while (not self._pipeline_stop.is_set()):
+            batch = self.replay.next_batch(RX_BATCH_SIZE, timeout=PIPELINE_POLL_INTERVAL)
+            if (batch == None):
+                break # End of capture
+            if (len(batch) > 0):
+                # Wait for the decoder rather than drop, so every replay of a capture decodes identically
+                for data in batch:
+                    self._rx_slots.acquire()
+                counters["rx_datagrams"] += len(batch)
+                self._capture(batch)
+                self._rx_queue.put(batch)
+
+        self._rx_queue.put(None)
+
+    def _receive_into_slot(self, sock):
+        """
+        Receive one datagram for the pipeline, reserving a receive queue slot for it.
+        Returns:
+            bytes or memoryview: The datagram, or None if the queue was full and it was dropped.
+        """
+        if (not self._rx_slots.acquire(blocking=False)):
+            # Decoder has fallen behind - keep the socket drained and count the loss rather than let the kernel drop silently
+            sock.recv_into(self._rx_discard)
+            self._pipeline_counters["rx_dropped"] += 1
+            return None
+        try:
+            if (self.zero_copy_receive):
+                view = self._rx_views[self._rx_index]
+                nbytes = sock.recv_into(view)
+                self._rx_index = (self._rx_index + 1) % len(self._rx_views)
+                return view[:nbytes]
+            return sock.recv(RX_BUFFER_SIZE)
+        except BaseException:
+            self._rx_slots.release()
+            raise
+
+    def _decoder_loop(self):
+        """Decoder thread: assemble frames from received datagrams and publish finished packets to subscribers."""
+        counters = self._pipeline_counters
+        while (True):
+            batch = self._rx_queue.get()
+            if (batch == None):
+                break
+            packets = self._process_batch(batch)
+            counters["decoded_datagrams"] += len(batch)
+            # Buffers are free for reuse only once decoded - slots are released in the order they were taken
+            self._rx_slots.release(len(batch))
+            for packet in packets:
+                self._publish(packet)
+
+        with self._subscriptions_lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription._close()
+
+    def _publish(self, packet):
+        """Hand a finished packet to every subscriber, then give up the decoder's own reference to it."""
+        self.latest_packet = packet
+        self._pipeline_counters["published_packets"] += 1
+        with self._subscriptions_lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription._offer(packet)
+        packet.release()
+
+    def _save_frame(self, frame):
+        """
+        Hand a finished frame to the background image writers, which hold a reference to it until it is written.
+        Args:
+            frame (FrameBuffer): Frame to save to image_save_dir as a 16-bit PNG.
+        """
+        if (self.image_writer == None):
+            self.image_writer = FrameStorage.ImageWriterPool(self.image_save_dir, workers=self.save_workers, queue_depth=self.save_queue_depth,
+                                                             compression=self.save_compression, policy=self.save_policy, log=self.log_to_file)
+        frame.retain()
+        self.image_writer.submit(frame.array, on_done=frame.release, timestamp=frame.timestamp, frame_number=frame.frame_number)
+
+    def set_calibration(self, cache, settings, pedestal=0):
+        """
+        Calibrate finished frames with the master dark and flat for the sensor settings in use.
+        Args:
+            cache (Calibration.MasterCache): Masters to choose from.
+            settings (Calibration.SensorSettings): Sensor settings in use.
+            pedestal (int): Added after dark subtraction, see Calibration.Calibrator.
+        Returns:
+            Calibration.Calibrator: The calibrator now in use, or None if the cache has no masters for these settings, leaving frames raw.
+        """
+        self.calibration = cache.calibrator(settings, pedestal)
+        if (self.calibration == None):
+            self.log_to_file(f"No calibration masters for {settings}, frames left uncalibrated", level=EventLogger.LEVEL_WARNING)
+        else:
+            self.log_to_file(f"Calibrating frames for {settings}")
+        return self.calibration
+
+    def start_recording(self, path, capacity=FrameStorage.DEFAULT_RECORDING_FRAMES):
+        """
+        Record every completed frame, raw, to a preallocated memory-mapped file. Much quicker than saving images,
+        so it keeps up with the sensor. Read the recording back with FrameStorage.RecordingReader.
+        Frames are copied into the file on the decoder thread, so while recording each frame's decode waits for that copy,
+        and for the OS if it falls behind writing pages back to disk.
+        Args:
+            path (str): File to record to. Replaced if it exists.
+            capacity (int): Most frames to record. Frames after that are not recorded, and a warning is logged when the file fills.
+        Returns:
+            FrameStorage.FrameRecorder: The new recorder.
+        """
+        self.stop_recording()
+        self.recorder = FrameStorage.FrameRecorder(path, self.image_height, self.image_width, capacity)
+        self.log_to_file(f"Recording frames to {path}")
+        return self.recorder
+
+    def stop_recording(self):
+        """
+        Stop recording and close the recording file.
+        Returns:
+            int: Number of frames recorded, or None if not recording.
+        """
+        recorder = self.recorder
+        if (recorder == None):
+            return None
+        self.recorder = None
+        recorder.close()
+        self.log_to_file(f"Recorded {recorder.frame_count} frames to {recorder.path}" + (f", {recorder.dropped} not recorded - file full" if recorder.dropped else ""))
+        return recorder.frame_count
+
+    def start_stacking(self, mode=FrameStacking.STACK_MEAN, **options):
+        """
+        Add every finished frame, after calibration, to a stack, replacing any stack already running.
+        Args:
+            mode (str): FrameStacking.STACK_* mode.
+            options: Passed to the stacker, e.g. window for FrameStacking.STACK_WINDOW.
+        Returns:
+            The new stacker - call its result() for the stacked frame.
+        """
+        self.stacker = FrameStacking.make_stacker(mode, self.image_height, self.image_width, **options)
+        self.log_to_file(f"Stacking frames ({mode})")
+        return self.stacker
+
+    def stop_stacking(self):
+        """
+        Stop adding frames to the stack.
+        Returns:
+            The stacker, still holding the stacked frame, or None if not stacking.
+        """
+        stacker = self.stacker
+        if (stacker == None):
+            return None
+        self.stacker = None
+        self.log_to_file(f"Stacked {stacker.count} frames")
+        return stacker
+
+    def start_capture(self, path):
+        """
+        Capture every datagram received from now on, with its arrival time, for replaying later with PacketCapture.PacketReplay.
+        Args:
+            path (str): File to capture to. Replaced if it exists.
+        Returns:
+            PacketCapture.PacketCaptureWriter: The new capture.
+        """
+        self.stop_capture()
+        self.capture = PacketCapture.PacketCaptureWriter(path, self.image_height, self.image_width)
+        self.log_to_file(f"Capturing packets to {path}")
+        return self.capture
+
+    def stop_capture(self):
+        """
+        Stop capturing and close the capture file.
+        Returns:
+            int: Number of datagrams captured, or None if not capturing.
+        """
+        capture = self.capture
+        if (capture == None):
+            return None
+        self.capture = None
+        capture.close()
+        self.log_to_file(f"Captured {capture.packets} packets ({capture.bytes / 1e6:.1f} MB) to {capture.path}")
+        if (capture.dropped > 0):
+            self.log_to_file(f"Capture fell behind and left out {capture.dropped} packets", level=EventLogger.LEVEL_WARNING)
+        return capture.packets
+
+    def _capture(self, datagrams):
+        capture = self.capture
+        if (capture != None):
+            capture.write(datagrams)
+
+    def close_decode_workers(self):
+        """
+        Stop the decode worker processes, if any, and free their shared memory. Frames are decoded on the decoder thread from then on.
+        Call with the pipeline stopped.
+        """
+        decodeWorkers = self.decode_workers
+        if (decodeWorkers == None):
+            return
+        decodeWorkers.wait()
+        self.decode_workers = None
+        decodeWorkers.close()
+
+    def close_image_writer(self, timeout=None):
+        """
+        Wait for frames still being saved to be written, then stop the image writers. Call on shutdown.
+        Args:
+            timeout (float): Most seconds to wait, or None to wait indefinitely.
+        Returns:
+            bool: True if every frame was written in time.
+        """
+        if (self.image_writer == None):
+            return True
+        writer = self.image_writer
+        self.image_writer = None
+        return writer.close(timeout)
+
     def getPacket(self):
-        """Receive a packet from the PCB"""
+        """Receive a packet from the PCB. Call release() on a returned TYPE_IMAGE_DATA packet when done with it."""
+        # Raw bytes received from socket - a memoryview into the receive buffer pool in zero-copy mode
+        data = self._receive()
+
+        if (data != None and len(data) > 0):
+            self._capture((data,))
+            return self._process_datagram(data)
+
+    def getPackets(self, max_packets=RX_BATCH_SIZE):
+        """
+        Receive every datagram currently queued from the PCB, waiting only for the first, and process them as a batch.
+        Row packets are decoded together in one NumPy step rather than one call per packet.
+        Args:
+            max_packets (int): Most datagrams to drain in one call. Limited to the receive buffer pool size in zero-copy mode.
+        Returns:
+            list: Packets for the caller to act on, in the order they were received. May be empty.
+                Call release() on each when done with it.
+        """
+        max_packets = min(max_packets, RX_BATCH_SIZE)
+        if (self.zero_copy_receive):
+            # Views into the pool must stay valid until the batch is decoded
+            max_packets = min(max_packets, len(self._rx_views))
+
+        datagrams = []
+        data = self._receive()
+        if (data == None):
+            return []
+        if (len(data) > 0):
+            datagrams.append(data)
+
+        # Drain whatever else is already queued without blocking
+        if (self.replay == None and self.transmission_udp and self.socket != None):
+            timeout = self.socket.gettimeout()
+            self.socket.setblocking(False)
+            try:
+                while (len(datagrams) < max_packets):
+                    if (self.zero_copy_receive):
+                        view = self._rx_views[self._rx_index]
+                        nbytes, addr = self.socket.recvfrom_into(view)
+                        self._rx_index = (self._rx_index + 1) % len(self._rx_views)
+                        data = view[:nbytes]
+                    else:
+                        data, addr = self.socket.recvfrom(RX_BUFFER_SIZE)
+                    if (len(data) > 0):
+                        datagrams.append(data)
+            except (BlockingIOError, InterruptedError):
+                pass # Socket is empty
+            except OSError:
+                pass # Socket closed mid-drain, process what was received
+            finally:
+                try:
+                    self.socket.settimeout(timeout)
+                except OSError:
+                    pass
+        elif (self.replay != None):
+            # Take every other datagram already due
+            datagrams += self.replay.next_batch(max_packets - len(datagrams), timeout=0) or []
+        elif (not self.transmission_udp):
+            # Take every other complete packet already read from the serial port
+            while (len(datagrams) < max_packets):
+                data = self._next_serial_packet()
+                if (data == None):
+                    break
+                datagrams.append(data)
+
+        self._capture(datagrams)
+        return self._process_batch(datagrams)
+
+    def _process_batch(self, datagrams):
+        """
+        Process a list of datagrams in order, decoding consecutive full-length row packets together.
+        Args:
+            datagrams (list): Raw packets, including headers.
+        Returns:
+            list: Packets for the caller to act on.
+        """
+        packets = []
+        rowRun = [] # Row packets waiting to be decoded - flushed before any other packet so frame boundaries are respected
+        batchable = self.image_width % PKTS_PER_ROW == 0
+
+        for data in datagrams:
+            if (batchable and self._is_image_row(data) and len(data) >= 4 + self._section_bytes):
+                rowRun.append(data)
+                if (len(rowRun) == RX_BATCH_SIZE):
+                    self._decode_rows(rowRun)
+                    rowRun = []
+                continue
+
+            if (len(rowRun) > 0):
+                self._decode_rows(rowRun)
+                rowRun = []
+            packet = self._process_datagram(data)
+            if (packet != None):
+                packets.append(packet)
+
+        if (len(rowRun) > 0):
+            self._decode_rows(rowRun)
+
+        self._collect_decoded()
+        progress = self._progress_packet()
+        if (progress != None):
+            packets.append(progress)
+        return packets
+
+    def _decode_rows(self, datagrams):
+        """
+        Decode a batch of full-length image row packets into the frame in one step.
+        Args:
+            datagrams (list): Up to RX_BATCH_SIZE row packets, each at least 4 + section bytes long.
+        """
+        if (self._frame_start_time == None):
+            self._frame_start_time = time.perf_counter()
+        if (self.decode_workers != None):
+            # Decoded straight into the frame buffer by a worker process - see _collect_decoded
+            self.decode_workers.submit(datagrams, self._assembly.index)
+            return
+
+        count = len(datagrams)
+        payloads = self._batch_payloads[:count]
+        rows = self._batch_rows[:count]
+        sections = self._batch_sections[:count]
+
+        # Gather headers and payloads - the only per-packet Python work left
+        for i, data in enumerate(datagrams):
+            rows[i] = int.from_bytes(data[1:3], "big")
+            sections[i] = data[3]
+            payloads[i] = np.frombuffer(data, dtype=np.uint8, count=self._section_bytes, offset=4)
+
+        valid = (rows < self.image_height) & (sections < PKTS_PER_ROW)
+        if (not valid.all()):
+            self.log_to_file(f"Discarded {count - np.count_nonzero(valid)} image packets for out-of-range rows/sections", level=EventLogger.LEVEL_WARNING)
+
+        pixels = self._batch_pixels[:count]
+        unpack_12bit(payloads, pixels)
+
+        # Scatter each decoded section into place through a (row, section, pixel) view of the frame
+        frameSections = self._frame.reshape(self.image_height, PKTS_PER_ROW, self._section_width)
+        validRows = rows[valid]
+        validSections = sections[valid]
+        validPixels = pixels[valid]
+        isNew = ~self._rows_filled[validRows, validSections]
+        frameSections[validRows, validSections] = validPixels
+        self._rows_filled[validRows, validSections] = True
+
+        # Statistics count each section once, however many times it is received
+        newPixels = validPixels[isNew]
+        if (len(newPixels) > 1):
+            keys = validRows[isNew].astype(np.int64) * PKTS_PER_ROW + validSections[isNew]
+            _, first = np.unique(keys, return_index=True)
+            if (len(first) < len(keys)):
+                newPixels = newPixels[first]
+        FrameProcessing.accumulate_histogram(self._histogram, newPixels)
+
+        if (self.progressive and len(validRows) > 0):
+            self._dirty_start = min(self._dirty_start, int(validRows.min()))
+            self._dirty_end = max(self._dirty_end, int(validRows.max()))
+
+    def _count_pending_sections(self):
+        """Add the sections decoded one packet at a time since the last call to the histogram, in one step."""
+        count = self._pending_count
+        if (count > 0):
+            frameSections = self._frame.reshape(self.image_height, PKTS_PER_ROW, self._section_width)
+            FrameProcessing.accumulate_histogram(self._histogram, frameSections[self._pending_rows[:count], self._pending_sections[:count]])
+            self._pending_count = 0
+
+    def _collect_decoded(self, wait=False):
+        """
+        With decode workers, take in the batches they have finished: note the rows decoded for progressive display,
+        and log any packets discarded.
+        Args:
+            wait (bool): Wait for every batch submitted so far first - needed before the frame is read as a whole.
+        """
+        if (self.decode_workers == None):
+            return
+        if (wait):
+            self.decode_workers.wait()
+        rowStart, rowEnd, discarded = self.decode_workers.take_decoded_rows()
+        if (discarded > 0):
+            self.log_to_file(f"Discarded {discarded} image packets for out-of-range rows/sections", level=EventLogger.LEVEL_WARNING)
+        if (self.progressive and rowEnd >= rowStart):
+            self._dirty_start = min(self._dirty_start, rowStart)
+            self._dirty_end = max(self._dirty_end, rowEnd)
+
+    def _is_image_row(self, data):
+        """True if data is an image row/section packet rather than an image start/end packet."""
+        # if (len(data) > 3072 + 4): # Length of an image data packet (may need to update) 
+        return data[0:1] == _SIG_IMAGE_DATA_BYTES and len(data) > self._min_row_packet_length
+
+    def _receive(self):
+        """
+        Receive one datagram from the PCB.
+        Returns:
+            bytes or memoryview: The received data, or None if nothing was received. In zero-copy mode this is a view
+                into the receive buffer pool, valid until the pool wraps around to the same buffer again.
+        """
+        data = None
+
+        # Replaying a capture
+        if (self.replay != None):
+            batch = self.replay.next_batch(1, timeout=PIPELINE_POLL_INTERVAL)
+            if (batch):
+                data = batch[0]
         # Receiving UDP
-        if (self.transmission_udp and self.socket != None):
+        elif (self.transmission_udp and self.socket != None):
             try: 
-                data, addr = self.socket.recvfrom(4096)
+                if (self.zero_copy_receive):
+                    # Receive straight into the next preallocated buffer, no new bytes object per packet
+                    view = self._rx_views[self._rx_index]
+                    nbytes, addr = self.socket.recvfrom_into(view)
+                    self._rx_index = (self._rx_index + 1) % len(self._rx_views)
+                    data = view[:nbytes]
+                else:
+                    data, addr = self.socket.recvfrom(RX_BUFFER_SIZE)
             except:
                 print("No socket detected, expecting GUI to close")
                 time.sleep(2) # Delay loop from restarting and printing the above again
-            data_hex = data.hex()
             # Print raw bytes of received packet for diagnostic 
-            #print("UDP: " + data_hex)
+            #print("UDP: " + data.hex())
         # Receiving Serial
         elif (not self.transmission_udp and self.serial_port.is_open):
-            out = b""
-            while (self.serial_port.inWaiting() > 0):
-                out += self.serial_port.read(1)
-            if (out != b""):
-                print("Serial: " + out) 
-            pass
+            data = self._next_serial_packet()
+            if (data == None):
+                # Wait for at least one byte (up to the port's read timeout), then take everything else already waiting
+                out = self.serial_port.read(max(1, self.serial_port.in_waiting))
+                if (out != b""):
+                    #print("Serial: " + out.hex()) 
+                    self._serial_buffer += out
+                data = self._next_serial_packet()
         # Not receiving either
         else:
             pass
-       
 
-        # Raw hex data received from socket, as a string   
-        data_hex = None
+        return data
+
+    def _finish_frame(self):
+        """
+        Hand off the frame being assembled to consumers and start the next one.
+        Returns:
+            Packet: TYPE_IMAGE_DATA packet for the finished frame, or None if it had to be dropped.
+        """
+        self._retransmit_attempts = 0
+        self._retransmit_pending = 0
+
+        # Every row received so far must be in the frame before it is handed on
+        self._collect_decoded(wait=True)
+        if (self.decode_workers != None):
+            self.decode_workers.take_histogram(self._histogram)
+        self._count_pending_sections()
+
+        # Optional: Report completion of image frame to GUI
+        #percent_filled = np.count_nonzero(self._rows_filled) / self._rows_filled.size * 100
+        #self.log_to_file(f"Frame completion: {percent_filled:.1f}%")
         
-    
-        if (data_hex != None and len(data_hex) > 0):
-            header = data_hex[0:2]
-            if (header.casefold() == SIG_IMAGE_DATA.casefold()):
-                # if (len(data_hex) > 6144 + 8): # Length of an image data packet (may need to update) 
-                if (len(data_hex) > 1000): 
-                    # Received packet is of image row/section data
-
-                    rowIndex = int(data_hex[2:6], 16)
-                    colIndex = int(data_hex[6:8], 16)
-                    #print("Detected image packet for row", rowIndex)
-
-                    #if (rowIndex >= IMAGE_HEIGHT):
-                    #    continue
-
-                    # Convert hex string to 12-bit integers, 3 hex digits per integer
-                    #imageData = data_hex[8:(8 + IMAGE_DATA_LENGTH)]
-                    imageData = data_hex[8:(8 + (self.image_width * 3 // PKTS_PER_ROW))]
-
-                    #padding = (3 - len(imageData) % 3) % 3 # This and next line may not be neccessary if correct length is always sent - replace with error if incorect length?
-                    #imageData = '0' * padding + imageData
-
-                    #self._frame[rowIndex] = [int(imageData[i:i+3], 16) for i in range(0, len(imageData), 3)]
-                    for i in range(0, len(imageData), 3):
-                        self._frame[rowIndex, (i // 3) + (colIndex * self.image_width // 4)] = int(imageData[i:i+3], 16)
-                    
-                    self._rows_filled[rowIndex, colIndex] = True 
-
-                    
-                            
-                elif (data_hex[0:4].casefold() == SIG_IMAGE_START.casefold()): # Length of an image start packet
-                    self.log_to_file("Received image start packet")
-                elif (data_hex[0:4].casefold() == SIG_IMAGE_END.casefold()): # Length of an image end packet
-                    self.log_to_file("Received image end packet")
-
-                    # Optional: Report completion of image frame to GUI
-                    #percent_filled = np.count_nonzero(self._rows_filled) / self._rows_filled.size * 100
-                    #self.log_to_file(f"Frame completion: {percent_filled:.1f}%")
-                    
-                    # Reset rows_filled to all false
-                    self._rows_filled.fill(False)
-
-                    # Reset frame to all zeros
-                    self._frame = np.zeros((self.image_height, self.image_width), dtype=np.int32) 
-            
-                    
-                    # Downscale to 1/4 size for display
-                    frameResized = cv2.resize(self._frame, (self.image_width//4, self.image_height//4), interpolation=cv2.INTER_NEAREST) 
-                    normalized_8 = (frameResized / 4095.0 * 255).astype(np.uint8)
+        # Reset rows_filled to all false
+        self._rows_filled.fill(False)
+        self._dirty_start = self.image_height
+        self._dirty_end = -1
+
+        # Record every frame from the sensor, even those dropped below because consumers are behind
+        timestamp = time.time()
+        frameNumber = self._frame_count
+        self._frame_count += 1
+        recorder = self.recorder
+        if (recorder != None):
+            if (recorder.append(self._frame, timestamp, frameNumber) == None and recorder.dropped == 1):
+                self.log_to_file(f"Recording {recorder.path} is full after {recorder.capacity} frames - later frames are not recorded", level=EventLogger.LEVEL_WARNING)
+
+        # Hand off the finished frame and start the next one in a zeroed buffer from the pool
+        finishedFrame = self._assembly
+        nextFrame = self.frame_pool.acquire()
+        if (nextFrame == None):
+            # Consumers still hold every other buffer - drop this frame and reassemble in place, rather than allocate
+            self._pipeline_counters["frames_dropped"] += 1
+            self.log_to_file("Frame pool exhausted, dropped frame", level=EventLogger.LEVEL_WARNING)
+            self._frame.fill(0)
+            self._histogram.fill(0)
+            self._frame_start_time = None
+            return None
+        self._assembly = nextFrame
+        self._frame = nextFrame.array
+
+        finishedFrame.frame_number = frameNumber
+        finishedFrame.timestamp = timestamp
+        finishedFrame.assembly_seconds = time.perf_counter() - self._frame_start_time if self._frame_start_time != None else 0.0
+        self._frame_start_time = None
+        self._pipeline_counters["frames_completed"] += 1
 
+        # Dark subtraction and flat-field correction, in place - after recording, so recordings stay raw and can be recalibrated
+        calibration = self.calibration
+        if (calibration != None):
+            calibration.apply(finishedFrame.array)
+
+        stacker = self.stacker
+        if (stacker != None):
+            stacker.add(finishedFrame.array)
+
+        # Statistics were accumulated as the rows arrived, so only the histogram is left to summarise
+        statistics = FrameProcessing.FrameStatistics(self._histogram)
+        self._histogram = np.zeros_like(self._histogram)
+
+        
+        # Downscale for display (to 1/4 size by default), averaging each block of pixels rather than keeping one pixel per block
+        frameResized = FrameProcessing.bin_frame(finishedFrame.array, self.preview_binning)
+        normalized_8 = FrameProcessing.to_8bit(frameResized, self.display_mapping)
 
-                    if (self.enable_save_images):
-                        # Save non-scaled image to disk
-                        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                        filename = os.path.join(self.image_save_dir, f"image_{timestamp}.png")
-                        normalized_16 = (self._frame * (65535.0/4095)).astype(np.uint16) # Convert to 16-bit for saving
-                        cv2.imwrite(filename, normalized_16)
-                        self.log_to_file(f"Saved image to {filename}")
 
-                    return Packet(type=PacketType.TYPE_IMAGE_DATA, data1=normalized_8)
-                # Create "process telemetry" function to simplfy code?
+        if (self.enable_save_images):
+            # Save non-scaled image to disk, in the background
+            self._save_frame(finishedFrame)
 
-            elif (header.casefold() == SIG_TELEMETRY.casefold()):
-                curr_telemetry = Telemetry.from_hex(data_hex)
+        return Packet(type=PacketType.TYPE_IMAGE_DATA, data1=normalized_8, data2=finishedFrame, data3=statistics)
+
+    def _progress_packet(self):
+        """
+        In progressive mode, report the rows updated in the frame being assembled, at most once every progress_interval.
+        Returns:
+            Packet: TYPE_IMAGE_PROGRESS packet, or None if not in progressive mode, nothing has changed or one was sent too recently.
+        """
+        if (not self.progressive or self._dirty_end < self._dirty_start):
+            return None
+        now = time.perf_counter()
+        if (now - self._last_progress < self.progress_interval):
+            return None
+        self._last_progress = now
+
+        rowRange = (self._dirty_start, self._dirty_end + 1)
+        self._dirty_start = self.image_height
+        self._dirty_end = -1
+        self._assembly.retain()
+        return Packet(type=PacketType.TYPE_IMAGE_PROGRESS, data1=rowRange, data2=self._assembly, data3=self._rows_filled.copy(), data4=self._frame_count)
+
+    def request_missing_sections(self):
+        """
+        Ask the PCB to resend only the row sections missing from the frame being assembled, rather than the whole frame.
+        Missing sections are coalesced into as few row range requests as possible, and fill the frame in place as they arrive.
+        Returns:
+            bool: True if requests were sent, False if nothing is missing or the frame has used up its attempts.
+        """
+        self._collect_decoded(wait=True)
+        if (self._rows_filled.all() or self._retransmit_attempts >= self.max_retransmit_attempts):
+            return False
+
+        ranges = coalesce_missing_sections(self._rows_filled, max_requests=MAX_RETRANSMIT_REQUESTS)
+        for start, count, mask in ranges:
+            self.sendPacket(row_request_packet(start, count, mask))
+        self._retransmit_attempts += 1
+        self._retransmit_pending = len(ranges)
+
+        # Compare with re-requesting the whole frame with CMD_IMAGE_REQUEST
+        packetBytes = 4 + self._section_bytes
+        fullBytes = self.image_height * PKTS_PER_ROW * packetBytes
+        requestedBytes = sum(count * bin(mask).count("1") for start, count, mask in ranges) * packetBytes
+        self._pipeline_counters["retransmit_requests"] += len(ranges)
+        self._pipeline_counters["retransmit_bytes_saved"] += fullBytes - requestedBytes
+        self.log_to_file(f"Requested {np.count_nonzero(~self._rows_filled)} missing row sections in {len(ranges)} requests, {requestedBytes} bytes instead of {fullBytes}")
+        return True
+
+    def _next_serial_packet(self):
+        """
+        Split the next complete packet off the bytes received over serial, which arrive as one unframed stream.
+        Packet boundaries come from the header and the fixed length of each packet type. Bytes that cannot start a packet are skipped.
+        Returns:
+            bytes: The packet, or None if no complete packet has been received yet.
+        """
+        buffer = self._serial_buffer
+        while (self._serial_offset < len(buffer)):
+            offset = self._serial_offset
+            header = buffer[offset]
+            if (header == _SIG_IMAGE_DATA_BYTES[0]):
+                if (len(buffer) - offset < IMAGE_MARKER_LENGTH):
+                    return None
+                # Start/end markers cannot be mistaken for a row packet, as no row index has 0xF0 or 0x0F as its high byte
+                marker = bytes(buffer[offset:offset + IMAGE_MARKER_LENGTH])
+                length = IMAGE_MARKER_LENGTH if marker in (_SIG_IMAGE_START_BYTES, _SIG_IMAGE_END_BYTES) else 4 + self._section_bytes
+            elif (header == _SIG_TELEMETRY_BYTES[0]):
+                length = TELEMETRY_PACKET_LENGTH
+            elif (header == _SIG_ACK_BYTES[0]):
+                length = ACK_PACKET_LENGTH
+            else:
+                self._serial_offset += 1 # Not a packet header - resynchronise on the next byte
+                continue
+
+            if (len(buffer) - offset < length):
+                return None
+            packet = bytes(buffer[offset:offset + length])
+            self._serial_offset += length
+            # Compact once the consumed part dominates, rather than shifting the buffer for every packet
+            if (self._serial_offset > len(buffer) // 2):
+                del buffer[:self._serial_offset]
+                self._serial_offset = 0
+            return packet
+
+        buffer.clear()
+        self._serial_offset = 0
+        return None
+
+    def _process_datagram(self, data):
+        """
+        Parse one datagram received from the PCB and update the frame being assembled.
+        Args:
+            data (bytes-like): Raw packet, including header. Only read, never copied.
+        Returns:
+            Packet: A packet for the caller to act on, or None if the datagram needs no further action.
+        """
+        header = data[0:1]
+        if (header == _SIG_IMAGE_DATA_BYTES):
+            if (self._is_image_row(data)): 
+                # Received packet is of image row/section data
+
+                rowIndex = int.from_bytes(data[1:3], "big")
+                colIndex = data[3]
+                #print("Detected image packet for row", rowIndex)
+
+                if (rowIndex >= self.image_height or colIndex >= PKTS_PER_ROW):
+                    self.log_to_file(f"Discarded image packet for out-of-range row {rowIndex}, section {colIndex}", level=EventLogger.LEVEL_WARNING)
+                    return None
+
+                # Unpack 12-bit integers straight into this section of the row, 3 bytes per 2 pixels
+                sectionStart = colIndex * self._section_width
+                section = self._frame[rowIndex, sectionStart:sectionStart + self._section_width]
+                unpack_12bit(data[4:4 + self._section_bytes], section)
                 
-                return Packet(Type=PacketType.TYPE_TELEMETRY, data1=curr_telemetry)
+                if (not self._rows_filled[rowIndex, colIndex]):
+                    # Counted in batches - a histogram update costs more than decoding one section
+                    self._pending_rows[self._pending_count] = rowIndex
+                    self._pending_sections[self._pending_count] = colIndex
+                    self._pending_count += 1
+                    if (self._pending_count == len(self._pending_rows)):
+                        self._count_pending_sections()
+                self._rows_filled[rowIndex, colIndex] = True 
+                if (self._frame_start_time == None):
+                    self._frame_start_time = time.perf_counter()
+
+                if (self.progressive):
+                    self._dirty_start = min(self._dirty_start, rowIndex)
+                    self._dirty_end = max(self._dirty_end, rowIndex)
+                    return self._progress_packet()
+
+                
+                        
+            elif (data[0:2] == _SIG_IMAGE_START_BYTES): # Length of an image start packet
+                self.log_to_file("Received image start packet", level=EventLogger.LEVEL_DEBUG)
+                if (self._retransmit_attempts > 0):
+                    # A new frame is starting before retransmission of the last one finished - deliver it as it stands
+                    return self._finish_frame()
+            elif (data[0:2] == _SIG_IMAGE_END_BYTES): # Length of an image end packet
+                self.log_to_file("Received image end packet", level=EventLogger.LEVEL_DEBUG)
+
+                # Keep assembling into the same buffer while missing sections are resent - the PCB sends an image end after each request
+                if (self._retransmit_pending > 0):
+                    self._retransmit_pending -= 1
+                    if (self._retransmit_pending > 0):
+                        return None
+                if (self.enable_retransmission and self.request_missing_sections()):
+                    return None
 
-                self.log_to_file("Received telemetry", curr_telemetry)
+                return self._finish_frame()
+            # Create "process telemetry" function to simplfy code?
 
-            elif (header.casefold() == SIG_ACK.casefold()):
-                self.log_to_file("Received ACK")
+        elif (header == _SIG_TELEMETRY_BYTES):
+            curr_telemetry = Telemetry.from_bytes(data)
+            if (curr_telemetry == None):
+                self.log_to_file(f"Discarded telemetry packet of incorrect length {len(data)}", level=EventLogger.LEVEL_WARNING)
+                return None
+            self.telemetry_history.append_telemetry(curr_telemetry)
+
+            self.log_to_file("Received telemetry", curr_telemetry, level=EventLogger.LEVEL_DEBUG)
+            
+            return Packet(type=PacketType.TYPE_TELEMETRY, data1=curr_telemetry)
+
+        elif (header == _SIG_ACK_BYTES):
+            command = data[1:ACK_PACKET_LENGTH].hex().upper()
+            self.log_to_file(f"Received ACK for command {command}")
+            return Packet(type=PacketType.TYPE_ACK, data1=command)
 
     def sendPacket(self, Packet):
         """Send a Packet to the PCB."""
-        if (self.transmission_udp and self.socket != None):
-            # Convert packet to hex string
-            packet_hex = Packet.type.value + Packet.data1 + Packet.data2 + Packet.data3 + Packet.data4
+        if (self.transmission_udp and self.socket != None and self.remote_address != None):
             # Send packet over UDP
-            self.sock.sendto(int(packet_hex, 16).to_bytes(len(packet_hex) // 2), self.addr)
-        elif (not self.transmission_udp and self.ser.is_open):
-            # Convert packet to hex string
-            packet_hex = Packet.type.value + Packet.data1 + Packet.data2 + Packet.data3 + Packet.data4
+            self.socket.sendto(encode_packet(Packet), self.remote_address)
+        elif (not self.transmission_udp and self.serial_port != None and self.serial_port.is_open):
             # Send packet over serial
-            self.ser.write(bytes.fromhex(packet_hex))
+            self.serial_port.write(encode_packet(Packet))
         else:
             print("No connection detected, unable to send packet")
 
 
-    def log_to_file(self, message, telemetry=None):
+    def log_to_file(self, message, telemetry=None, level=EventLogger.LEVEL_INFO):
         """
         Log events such as packet reception and sending, optionally including telemtry data, to a CSV file.
+        Only queues the event - it is written to disk (and printed, depending on level) by the logger's own thread.
         Args:
             message (str): A message to save to the log.
             telemetry (telemetry): A class containing telemetry information.
+            level (int): EventLogger.LEVEL_* of the event.
         """
-        # Open the CSV in append mode
-        with open("packet_log.csv", mode="a", newline="") as file:
-            
-            writer = csv.writer(file)
-            
-            # Get the current timestamp
-            timestamp = datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]  # Format: YYYY-MM-DD HH:MM:SS.mmm
-            print(timestamp + ": " + message)
-
-            # Write the log entry
-            if (telemetry == None):
-                writer.writerow([timestamp, message])
-            else:
-                writer.writerow([timestamp, message, telemetry.state, telemetry.temp1, telemetry.temp2, telemetry.voltage, telemetry.fault_code])
+        fields = None
+        if (telemetry != None):
+            fields = (telemetry.state, telemetry.temp1, telemetry.temp2, telemetry.voltage, telemetry.fault_code)
+        self.logger.log(message, level, fields)
 
    
 
@@ -280,4 +1409,150 @@ class CMOSReadoutInterface:
         timestamp = int(time.time())
         # Convert to 16-character hex string, removing '0x' prefix
         return format(timestamp, '016x')
-    
+
+
+class _ReadoutDatagramProtocol(asyncio.DatagramProtocol):
+    """asyncio protocol passing each received datagram straight to an AsyncCMOSReadoutInterface."""
+    def __init__(self, owner):
+        self.owner = owner
+
+    def datagram_received(self, data, addr):
+        self.owner._datagram_received(data, addr)
+
+    def error_received(self, exc):
+        print(f"UDP receive error: {exc}")
+
+    def connection_lost(self, exc):
+        self.owner._connection_lost()
+
+
+class AsyncCMOSReadoutInterface:
+    """
+    asyncio variant of CMOSReadoutInterface, for embedding in an event loop alongside other I/O.
+    Datagrams are delivered by the event loop as they arrive, so nothing ever blocks or polls. Frame assembly is shared with
+    CMOSReadoutInterface, and images are saved to disk by its background image writers.
+
+    Usage:
+        iface = AsyncCMOSReadoutInterface(2048, 2048, local_address=("192.168.137.6", 50007))
+        await iface.open()
+        await iface.send(Packet(PacketType.TYPE_IMAGE_REQUEST))
+        async for frame in iface.frames():
+            ...
+    """
+    def __init__(self, image_height, image_width, local_address=None, remote_address=None, sock=None, enable_save_images=False, image_save_dir=None, save_policy=FrameStorage.POLICY_DROP):
+        self.local_address = local_address # (IP, port) to listen on, if sock is not given
+        self.remote_address = remote_address # (IP, port) of the PCB - if None, learned from the first datagram received
+        self.sock = sock # Already bound UDP socket to use instead of local_address
+        self.transport = None
+
+        # Frame assembly is done by a socket-less synchronous interface, fed one datagram at a time
+        # Its image writers are background threads - save_policy should not be POLICY_BLOCK, which would stall the event loop
+        self._interface = CMOSReadoutInterface(image_height, image_width, enable_save_images=enable_save_images, image_save_dir=image_save_dir, rx_socket_buffer_size=0, save_policy=save_policy)
+        self._queues = [] # (types, asyncio.Queue) for each active packets() iterator
+        self.dropped = 0 # Packets discarded because an iterator fell behind
+
+    async def open(self):
+        """Create the UDP endpoint on the running event loop."""
+        loop = asyncio.get_running_loop()
+        if (self.sock != None):
+            self.transport, protocol = await loop.create_datagram_endpoint(lambda: _ReadoutDatagramProtocol(self), sock=self.sock)
+        else:
+            self.transport, protocol = await loop.create_datagram_endpoint(lambda: _ReadoutDatagramProtocol(self), local_addr=self.local_address)
+        _set_socket_buffer_size(self.transport.get_extra_info("socket"), RX_SOCKET_BUFFER_SIZE)
+        return self
+
+    async def close(self):
+        """Close the UDP endpoint. Active frames() and packets() iterators finish once they have yielded what is queued."""
+        if (self.transport != None):
+            self.transport.close()
+            self.transport = None
+        self._end_iterators()
+        # Wait for images still being saved without blocking the loop
+        await asyncio.get_running_loop().run_in_executor(None, self._interface.close_image_writer)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def send(self, packet):
+        """
+        Send a Packet to the PCB.
+        Args:
+            packet (Packet): Command packet, see encode_packet.
+        """
+        if (self.transport == None or self.remote_address == None):
+            print("No connection detected, unable to send packet")
+            return
+        # UDP sends never block - the transport buffers if the socket is momentarily full
+        self.transport.sendto(encode_packet(packet), self.remote_address)
+
+    async def packets(self, types=None, maxsize=SUBSCRIBER_QUEUE_DEPTH):
+        """
+        Asynchronously iterate over packets as they are published, such as finished frames and telemetry.
+        Each packet's frame buffer stays valid until the loop asks for the next packet - call retain() to keep it longer.
+        Args:
+            types (tuple): PacketTypes to yield, or None for all.
+            maxsize (int): Most packets held for this iterator before its oldest are dropped.
+        """
+        packetQueue = asyncio.Queue(maxsize=maxsize)
+        entry = (types, packetQueue)
+        self._queues.append(entry)
+        try:
+            while (True):
+                packet = await packetQueue.get()
+                if (packet == None):
+                    return
+                try:
+                    yield packet
+                finally:
+                    packet.release()
+        finally:
+            if (entry in self._queues):
+                self._queues.remove(entry)
+            while (not packetQueue.empty()):
+                packet = packetQueue.get_nowait()
+                if (packet != None):
+                    packet.release()
+
+    def frames(self, maxsize=SUBSCRIBER_QUEUE_DEPTH):
+        """
+        Asynchronously iterate over finished frames, as TYPE_IMAGE_DATA packets (see Packet).
+        Args:
+            maxsize (int): Most frames held for this iterator before its oldest are dropped.
+        """
+        return self.packets(types=(PacketType.TYPE_IMAGE_DATA,), maxsize=maxsize)
+
+    def _datagram_received(self, data, addr):
+        """Decode one datagram on the event loop thread and publish any resulting packet."""
+        if (self.remote_address == None):
+            self.remote_address = addr
+        if (len(data) == 0):
+            return
+        self._interface._capture((data,))
+        packet = self._interface._process_datagram(data)
+        if (packet == None):
+            return
+
+        self._interface.latest_packet = packet
+        for types, packetQueue in list(self._queues):
+            if (types != None and packet.type not in types):
+                continue
+            if (packetQueue.full()):
+                packetQueue.get_nowait().release()
+                self.dropped += 1
+            packet.retain()
+            packetQueue.put_nowait(packet)
+        packet.release()
+
+    def _connection_lost(self):
+        self.transport = None
+        self._end_iterators()
+
+    def _end_iterators(self):
+        """Tell every active iterator to finish after the packets already queued."""
+        for types, packetQueue in list(self._queues):
+            if (packetQueue.full()):
+                packetQueue.get_nowait().release()
+            packetQueue.put_nowait(None)
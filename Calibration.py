@@ -0,0 +1,210 @@
+# Calibration.py
+# Dark-frame subtraction and flat-field correction: building master darks and flats from captured frames,
+# caching them by the sensor settings they were taken with, and calibrating each incoming frame in place.
+
+import threading
+
+import collections
+
+import os
+
+import numpy as np
+
+from FrameProcessing import MAX_PIXEL_VALUE
+
+COMBINE_MEDIAN = "median" # Rejects outliers such as cosmic ray hits, but needs every frame's rows in memory at once
+COMBINE_MEAN = "mean" # Lower noise, only one accumulator in memory
+COMBINE_MEMORY_LIMIT = 256 * 1024 * 1024 # Most bytes of frame rows held at once while combining
+
+FLAT_GAIN_BITS = 12 # Flat-field gains are applied as fixed-point integers with this many fraction bits
+MAX_FLAT_GAIN = 8.0 # Pixels needing more correction than this (dead or vignetted to near black) are left uncorrected
+
+# Sensor settings a master frame is only valid for - those changing the pixel values the sensor reports for the same light
+SensorSettings = collections.namedtuple("SensorSettings", ["analog_gain", "analog_gain_x2", "digital_gain", "offset", "bit_depth"],
+                                        defaults=[0, 0, 0, 0, 12])
+
+MASTER_DARK = "dark"
+MASTER_FLAT = "flat"
+
+
+def combine_frames(frames, method=COMBINE_MEDIAN, memory_limit=COMBINE_MEMORY_LIMIT):
+    """
+    Combine several frames of the same scene into one master frame, pixel by pixel.
+    Works through the frames in bands of rows, so memory use stays within memory_limit however many frames there are.
+    Args:
+        frames (sequence): 2D frames, all the same shape - a list, a 3D array, or a FrameStorage.RecordingReader,
+            which then only reads each band of rows from disk as it is needed.
+        method (str): COMBINE_MEDIAN or COMBINE_MEAN.
+        memory_limit (int): Most bytes of frame rows to hold at once.
+    Returns:
+        np.ndarray: float32 master frame.
+    """
+    count = len(frames)
+    if (count == 0):
+        raise ValueError("No frames to combine")
+    if (method not in (COMBINE_MEDIAN, COMBINE_MEAN)):
+        raise ValueError(f"Unknown combine method {method}")
+    height, width = frames[0].shape
+    master = np.zeros((height, width), dtype=np.float32)
+
+    if (method == COMBINE_MEAN):
+        # A running sum needs no more than one frame at a time
+        total = np.zeros((height, width), dtype=np.float64)
+        for i in range(count):
+            total += frames[i]
+        np.divide(total, count, out=master, casting="unsafe")
+        return master
+
+    bandRows = max(1, min(height, memory_limit // (count * width * 4)))
+    stack = np.empty((count, bandRows, width), dtype=np.float32)
+    for start in range(0, height, bandRows):
+        end = min(start + bandRows, height)
+        band = stack[:, :end - start]
+        for i in range(count):
+            band[i] = frames[i][start:end]
+        np.median(band, axis=0, out=master[start:end], overwrite_input=True)
+    return master
+
+def make_master_flat(frames, dark=None, method=COMBINE_MEDIAN, memory_limit=COMBINE_MEMORY_LIMIT):
+    """
+    Build a master flat: the combined flat frames, less the dark, normalised to a mean of 1.
+    Args:
+        frames (sequence): Flat frames - evenly lit, well below saturation. See combine_frames.
+        dark (np.ndarray): Master dark taken with the same settings and exposure, or None if the flats are already dark subtracted.
+    Returns:
+        np.ndarray: float32 master flat.
+    """
+    flat = combine_frames(frames, method, memory_limit)
+    if (dark is not None):
+        flat -= dark
+    level = flat[flat > 0].mean() if np.any(flat > 0) else 1.0
+    flat /= level
+    return flat
+
+
+class Calibrator:
+    """
+    Calibrates frames in place: subtracts a master dark, then corrects by a master flat.
+    Everything is precomputed as integers, so a frame is calibrated in a few in-place passes with no full-size temporaries,
+    and stays a 12-bit integer frame that displays, saves and records as before.
+    """
+    def __init__(self, dark=None, flat=None, pedestal=0, settings=None):
+        """
+        Args:
+            dark (np.ndarray): Master dark, or None for no dark subtraction.
+            flat (np.ndarray): Master flat normalised to a mean of 1, or None for no flat-field correction.
+            pedestal (int): Added after dark subtraction, so noise below the dark level is kept rather than clipped at 0.
+            settings (SensorSettings): Settings the masters were taken with, for reference.
+        """
+        self.pedestal = pedestal
+        self.settings = settings
+        self._dark = None if dark is None else np.rint(dark).astype(np.int32)
+        self._gain = None
+        if (flat is not None):
+            # Multiplying by 1 / flat rather than dividing by flat, as a fixed-point integer
+            gain = np.ones(flat.shape, dtype=np.float64)
+            np.divide(1.0, flat, out=gain, where=flat > 1.0 / MAX_FLAT_GAIN)
+            self._gain = np.rint(gain * (1 << FLAT_GAIN_BITS)).astype(np.int32)
+
+    def apply(self, frame):
+        """
+        Calibrate a frame in place.
+        Args:
+            frame (np.ndarray): int32 frame, such as FrameBuffer.array. Left holding values clipped to 0 to MAX_PIXEL_VALUE.
+        """
+        if (self._dark is not None):
+            np.subtract(frame, self._dark, out=frame)
+        if (self.pedestal):
+            frame += self.pedestal
+        if (self._gain is not None):
+            np.multiply(frame, self._gain, out=frame)
+            frame += 1 << (FLAT_GAIN_BITS - 1) # Round to nearest
+            np.right_shift(frame, FLAT_GAIN_BITS, out=frame)
+        np.clip(frame, 0, MAX_PIXEL_VALUE, out=frame)
+
+
+class MasterCache:
+    """
+    Master darks and flats, keyed by the sensor settings they were taken with, so changing settings picks up the right masters.
+    Kept in memory, and also saved as .npy files in a directory if one is given, to be reused in later sessions.
+    """
+    def __init__(self, directory=None):
+        """
+        Args:
+            directory (str): Directory masters are saved to and loaded from, or None to keep them in memory only.
+        """
+        self.directory = directory
+        self._masters = {}
+        self._lock = threading.Lock()
+        if (directory != None):
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, settings):
+        name = f"{kind}_again{settings.analog_gain}_x{settings.analog_gain_x2}_dgain{settings.digital_gain}_offset{settings.offset}_{settings.bit_depth}bit.npy"
+        return os.path.join(self.directory, name)
+
+    def get(self, kind, settings):
+        """
+        The master of a kind for some settings.
+        Args:
+            kind (str): MASTER_DARK or MASTER_FLAT.
+            settings (SensorSettings): Settings in use.
+        Returns:
+            np.ndarray: float32 master, or None if there is none for these settings.
+        """
+        key = (kind, SensorSettings(*settings))
+        with self._lock:
+            master = self._masters.get(key)
+            if (master is None and self.directory != None):
+                path = self._path(*key)
+                if (os.path.exists(path)):
+                    master = np.load(path)
+                    self._masters[key] = master
+        return master
+
+    def put(self, kind, settings, master):
+        """Store a master for some settings, replacing any there already."""
+        key = (kind, SensorSettings(*settings))
+        master = np.asarray(master, dtype=np.float32)
+        with self._lock:
+            self._masters[key] = master
+        if (self.directory != None):
+            np.save(self._path(*key), master)
+
+    def build_dark(self, frames, settings, method=COMBINE_MEDIAN, memory_limit=COMBINE_MEMORY_LIMIT):
+        """
+        Combine dark frames into a master dark, and store it for these settings.
+        Args:
+            frames (sequence): Frames taken with no light, see combine_frames.
+            settings (SensorSettings): Settings they were taken with.
+        Returns:
+            np.ndarray: The master dark.
+        """
+        dark = combine_frames(frames, method, memory_limit)
+        self.put(MASTER_DARK, settings, dark)
+        return dark
+
+    def build_flat(self, frames, settings, method=COMBINE_MEDIAN, memory_limit=COMBINE_MEMORY_LIMIT):
+        """
+        Combine flat frames into a master flat, less the master dark for the same settings if there is one, and store it.
+        Args:
+            frames (sequence): Evenly lit frames, see combine_frames.
+            settings (SensorSettings): Settings they were taken with.
+        Returns:
+            np.ndarray: The master flat, normalised to a mean of 1.
+        """
+        flat = make_master_flat(frames, self.get(MASTER_DARK, settings), method, memory_limit)
+        self.put(MASTER_FLAT, settings, flat)
+        return flat
+
+    def calibrator(self, settings, pedestal=0):
+        """
+        A Calibrator using the masters for some settings.
+        Returns:
+            Calibrator: The calibrator, or None if there are no masters for these settings.
+        """
+        dark = self.get(MASTER_DARK, settings)
+        flat = self.get(MASTER_FLAT, settings)
+        if (dark is None and flat is None):
+            return None
+        return Calibrator(dark, flat, pedestal, SensorSettings(*settings))
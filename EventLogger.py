@@ -0,0 +1,241 @@
+# EventLogger.py
+# Event log for the readout system, written to CSV by a background thread.
+# Logging an event only queues it, so the receive and decode loops never wait on the disk or the console.
+
+import threading
+
+import queue
+
+import atexit
+
+import csv
+
+import time
+import datetime
+
+import os
+
+# Log levels - events below a logger's level are discarded without being queued
+LEVEL_DEBUG = 10 # Routine per-packet events, such as image start/end and telemetry
+LEVEL_INFO = 20
+LEVEL_WARNING = 30 # Data lost or discarded
+LEVEL_ERROR = 40
+LEVEL_NAMES = {LEVEL_DEBUG: "DEBUG", LEVEL_INFO: "INFO", LEVEL_WARNING: "WARNING", LEVEL_ERROR: "ERROR"}
+
+DEFAULT_LOG_FILE = "packet_log.csv"
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 # Size at which the log is rotated, 0 for no limit
+DEFAULT_BACKUP_COUNT = 5 # Rotated logs kept, as packet_log.csv.1 (newest) to packet_log.csv.5 (oldest)
+DEFAULT_LOG_QUEUE_DEPTH = 10000 # Most events waiting to be written before new ones are dropped
+LOG_FLUSH_INTERVAL = 0.5 # Most seconds an event waits in the queue before being written
+LOG_BATCH_SIZE = 1000 # Most events written per batch
+
+_FLUSH = object() # Queue marker asking the writer to write everything before it, then set the attached event
+_STOP = object()
+
+
+class EventLogger:
+    """
+    Queues events and writes them to a CSV file in batches from a background thread, optionally echoing them to the console.
+    The file is rotated by size and/or age. If the queue fills up, new events are dropped and counted rather than waiting.
+    Each row is: timestamp, level, message, then any extra fields (e.g. telemetry values).
+    """
+    def __init__(self, path=DEFAULT_LOG_FILE, level=LEVEL_DEBUG, console_level=LEVEL_INFO, max_bytes=DEFAULT_MAX_BYTES,
+                 rotate_interval=None, backup_count=DEFAULT_BACKUP_COUNT, queue_depth=DEFAULT_LOG_QUEUE_DEPTH, console=print):
+        """
+        Args:
+            path (str): CSV file to log to. Appended to if it exists.
+            level (int): Lowest level written to the file.
+            console_level (int): Lowest level also printed to the console, or None to print nothing.
+            max_bytes (int): Rotate the file once it reaches this size, checked after each batch, or 0 for no limit.
+            rotate_interval (float): Rotate the file once it has been open this many seconds, or None for no limit.
+            backup_count (int): Number of rotated files to keep.
+            queue_depth (int): Most events waiting to be written.
+            console (function): Called with each line printed to the console, from the logger's thread.
+        """
+        self.path = path
+        self.level = level
+        self.console_level = console_level
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.console = console
+
+        self.written = 0 # Events written to the file
+        self.dropped = 0 # Events discarded because the queue was full
+
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._file = None
+        self._writer = None
+        self._opened_at = 0.0
+        self._thread = threading.Thread(target=self._writer_loop, name="Event logger", daemon=True)
+        self._thread.start()
+
+    def _lowest_level(self):
+        return self.level if self.console_level == None else min(self.level, self.console_level)
+
+    def log(self, message, level=LEVEL_INFO, fields=None):
+        """
+        Queue an event to be logged. Never blocks.
+        Args:
+            message (str): Description of the event.
+            level (int): LEVEL_* of the event.
+            fields (list): Extra values written after the message, such as telemetry readings.
+        """
+        if (level < self._lowest_level()):
+            return
+        try:
+            self._queue.put_nowait((time.time(), level, message, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, message, fields=None):
+        self.log(message, LEVEL_DEBUG, fields)
+
+    def info(self, message, fields=None):
+        self.log(message, LEVEL_INFO, fields)
+
+    def warning(self, message, fields=None):
+        self.log(message, LEVEL_WARNING, fields)
+
+    def error(self, message, fields=None):
+        self.log(message, LEVEL_ERROR, fields)
+
+    def flush(self, timeout=None):
+        """
+        Wait until every event logged so far has been written to disk.
+        Args:
+            timeout (float): Most seconds to wait, or None to wait indefinitely.
+        Returns:
+            bool: True if everything was written in time.
+        """
+        if (not self._thread.is_alive()):
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put((_FLUSH, done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """Write every queued event, then stop the logger's thread and close the file."""
+        flushed = self.flush(timeout)
+        try:
+            self._queue.put((_STOP, None), timeout=timeout)
+        except queue.Full:
+            return False
+        self._thread.join(timeout)
+        return flushed
+
+    def stats(self):
+        return {"written": self.written, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+    def _open(self):
+        self._file = open(self.path, mode="a", newline="")
+        self._writer = csv.writer(self._file)
+        self._opened_at = time.time()
+
+    def _close_file(self):
+        if (self._file != None):
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+    def _should_rotate(self):
+        if (self._file.tell() == 0):
+            return False # Never rotate out an empty file
+        if (self.max_bytes and self._file.tell() >= self.max_bytes):
+            return True
+        return self.rotate_interval != None and time.time() - self._opened_at >= self.rotate_interval
+
+    def _rotate(self):
+        """Move packet_log.csv to packet_log.csv.1, .1 to .2 and so on, discarding the oldest, and start a new file."""
+        self._close_file()
+        if (self.backup_count > 0):
+            for i in range(self.backup_count - 1, 0, -1):
+                older = f"{self.path}.{i}"
+                if (os.path.exists(older)):
+                    os.replace(older, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _rotate_safely(self):
+        try:
+            self._rotate()
+        except OSError as e:
+            if (self.console != None):
+                self.console(f"Unable to rotate log {self.path}: {e}")
+
+    def _write_batch(self, records):
+        if (self._file == None):
+            self._open()
+        for timestamp, level, message, fields in records:
+            # Formatting is left to this thread - it costs more than queueing the event
+            text = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] # Format: YYYY-MM-DD HH:MM:SS.mmm
+            if (self.console_level != None and level >= self.console_level and self.console != None):
+                self.console(text + ": " + message)
+            if (level >= self.level):
+                self._writer.writerow([text, LEVEL_NAMES.get(level, level), message] + (list(fields) if fields != None else []))
+                self.written += 1
+        self._file.flush()
+        if (self._should_rotate()):
+            self._rotate()
+
+    def _writer_loop(self):
+        while (True):
+            try:
+                item = self._queue.get(timeout=LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                # Nothing logged for a while - still rotate on time even when the log is quiet
+                if (self._file != None and self.rotate_interval != None and self._should_rotate()):
+                    self._rotate_safely()
+                continue
+
+            # Take everything else already queued, up to a batch
+            records = []
+            markers = []
+            while (True):
+                if (item[0] is _FLUSH or item[0] is _STOP):
+                    markers.append(item)
+                    break
+                records.append(item)
+                if (len(records) >= LOG_BATCH_SIZE):
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if (len(records) > 0):
+                try:
+                    self._write_batch(records)
+                except OSError as e:
+                    # Disk full or file locked - report it and carry on, rather than stop logging for good
+                    if (self.console != None):
+                        self.console(f"Unable to write to log {self.path}: {e}")
+                    self._close_file()
+
+            for marker, done in markers:
+                if (marker is _FLUSH):
+                    done.set()
+                else:
+                    self._close_file()
+                    return
+
+
+_default_logger = None
+_default_logger_lock = threading.Lock()
+
+def default_logger():
+    """
+    The logger shared by every CMOSReadoutInterface not given its own, writing to packet_log.csv.
+    Created on first use. Anything still queued is written when the program exits.
+    """
+    global _default_logger
+    with _default_logger_lock:
+        if (_default_logger == None):
+            _default_logger = EventLogger()
+            atexit.register(_default_logger.close, 2.0)
+        return _default_logger
@@ -0,0 +1,359 @@
+# FrameProcessing.py
+# Working with full-resolution 12-bit frames: unpacking them from the board's packed pixel format,
+# and turning them into images for display - binning, region of interest crops and 8-bit conversion.
+
+import threading
+
+import numpy as np
+
+PREVIEW_BINNING = 4 # Binning factor of the preview sent with each finished frame - 2048x2048 becomes 512x512
+MAX_PIXEL_VALUE = 4095 # 12-bit
+
+# Display curves, mapping 12-bit pixel values between the black and white levels onto 0-255
+CURVE_LINEAR = "linear"
+CURVE_LOG = "log" # Brightens dim detail, compressing highlights
+CURVE_GAMMA = "gamma"
+DISPLAY_CURVES = (CURVE_LINEAR, CURVE_LOG, CURVE_GAMMA)
+DEFAULT_GAMMA = 0.5 # Below 1 brightens dim detail, above 1 darkens it
+LOG_CURVE_STRENGTH = 100.0 # How strongly the log curve lifts dim values
+
+AUTO_CONTRAST_PERCENTILES = (0.5, 99.5) # Pixel value percentiles mapped to black and white by auto-contrast
+AUTO_CONTRAST_STRIDE = 4 # Auto-contrast samples every 4th pixel of every 4th row - 16384 of the 512x512 binned preview it runs on
+
+
+def packed_12bit_length(pixel_count):
+    """Number of bytes occupied by pixel_count packed 12-bit pixels (3 hex digits each)."""
+    return (pixel_count * 3 + 1) // 2
+
+def unpack_12bit(payload, out):
+    """
+    Unpack big-endian packed 12-bit pixels from raw packet bytes into out, a 1D integer array (or view).
+    Every 3 bytes hold 2 pixels: AB CD EF -> 0xABC, 0xDEF. Equivalent to reading the payload as a hex
+    string 3 digits at a time, but done with NumPy on the bytes directly. Pixels missing from a short
+    payload are left untouched in out.
+    A batch of equal-length payloads can be unpacked in one call by passing a 2D uint8 array with one
+    payload per row, and a 2D out with one row of pixels per payload.
+    Args:
+        payload (bytes-like or np.ndarray): Packed pixel data, with no header.
+        out (np.ndarray): Destination for the unpacked pixels.
+    Returns:
+        int: Number of pixels written to each row of out.
+    """
+    raw = payload if isinstance(payload, np.ndarray) else np.frombuffer(payload, dtype=np.uint8)
+    pixel_count = min(out.shape[-1], raw.shape[-1] * 2 // 3)
+    pairs = pixel_count // 2
+
+    # Whole 3-byte groups, each holding 2 pixels
+    groups = raw[..., :pairs * 3].reshape(raw.shape[:-1] + (pairs, 3)).astype(np.uint16)
+    out[..., 0:pairs * 2:2] = (groups[..., 0] << 4) | (groups[..., 1] >> 4)
+    out[..., 1:pairs * 2:2] = ((groups[..., 1] & 0x0F) << 8) | groups[..., 2]
+
+    # Odd pixel count - last pixel occupies 1.5 bytes
+    if (pixel_count % 2):
+        out[..., pixel_count - 1] = (raw[..., pairs * 3].astype(np.uint16) << 4) | (raw[..., pairs * 3 + 1] >> 4)
+
+    return pixel_count
+
+def pack_12bit(pixels):
+    """
+    Pack 12-bit pixels into big-endian bytes, 3 bytes per 2 pixels - the inverse of unpack_12bit.
+    An odd final pixel takes 2 bytes, with the low 4 bits of the last byte zero.
+    Args:
+        pixels (np.ndarray): Pixel values 0-4095. Packed along the last axis.
+    Returns:
+        np.ndarray: uint8 array with the last axis replaced by the packed bytes.
+    """
+    pixels = np.asarray(pixels)
+    pixel_count = pixels.shape[-1]
+    pairs = pixel_count // 2
+    packed = np.empty(pixels.shape[:-1] + (packed_12bit_length(pixel_count),), dtype=np.uint8)
+
+    even = pixels[..., 0:pairs * 2:2].astype(np.uint16)
+    odd = pixels[..., 1:pairs * 2:2].astype(np.uint16)
+    packed[..., 0:pairs * 3:3] = even >> 4
+    packed[..., 1:pairs * 3:3] = ((even & 0x0F) << 4) | (odd >> 8)
+    packed[..., 2:pairs * 3:3] = odd & 0xFF
+
+    if (pixel_count % 2):
+        last = pixels[..., -1].astype(np.uint16)
+        packed[..., -2] = last >> 4
+        packed[..., -1] = (last & 0x0F) << 4
+
+    return packed
+
+def bin_frame(frame, factor):
+    """
+    Average each factor x factor block of pixels into one (true binning, not decimation, so no pixel is ignored).
+    Rows and columns beyond the last whole block are left out.
+    Done with strided adds over reshaped views rather than a sum over a 4D reshape, which is several times faster.
+    Args:
+        frame (np.ndarray): 2D integer frame.
+        factor (int): Block size.
+    Returns:
+        np.ndarray: int32 array of shape (height // factor, width // factor).
+    """
+    if (factor <= 1):
+        return frame
+    height = frame.shape[0] // factor
+    width = frame.shape[1] // factor
+
+    # Sum blocks of rows, each a contiguous run of whole rows
+    rows = frame[:height * factor, :width * factor].reshape(height, factor, width * factor)
+    total = rows[:, 0].astype(np.int32)
+    for i in range(1, factor):
+        total += rows[:, i]
+
+    # Then blocks of columns
+    columns = total.reshape(height, width, factor)
+    binned = columns[..., 0].copy()
+    for i in range(1, factor):
+        binned += columns[..., i]
+
+    binned //= factor * factor
+    return binned
+
+def crop(frame, roi):
+    """
+    A region of interest of a frame, as a view - nothing is copied.
+    Args:
+        frame (np.ndarray): 2D frame.
+        roi (tuple): (x0, y0, x1, y1) in frame pixels, end exclusive. Clipped to the frame.
+    Returns:
+        tuple: (view, (x0, y0, x1, y1) after clipping).
+    """
+    x0, y0, x1, y1 = roi
+    x0 = min(max(int(x0), 0), frame.shape[1] - 1)
+    y0 = min(max(int(y0), 0), frame.shape[0] - 1)
+    x1 = min(max(int(x1), x0 + 1), frame.shape[1])
+    y1 = min(max(int(y1), y0 + 1), frame.shape[0])
+    return frame[y0:y1, x0:x1], (x0, y0, x1, y1)
+
+def fit_to_display(region, display_width, display_height):
+    """
+    Scale a region to fit a display area: binned down if it is larger, or enlarged by whole-pixel repeats if smaller,
+    so each displayed pixel is always either an average of real pixels or one real pixel.
+    Args:
+        region (np.ndarray): 2D frame or crop of one.
+        display_width (int): Width of the display area in pixels.
+        display_height (int): Height of the display area in pixels.
+    Returns:
+        tuple: (image, scale) - the scaled image, and the number of region pixels per displayed pixel along each axis.
+    """
+    height, width = region.shape
+    factor = max(-(-height // display_height), -(-width // display_width)) # Smallest binning that fits
+    if (factor > 1):
+        return bin_frame(region, factor), float(factor)
+
+    zoom = max(1, min(display_height // height, display_width // width))
+    if (zoom > 1):
+        region = np.repeat(np.repeat(region, zoom, axis=0), zoom, axis=1)
+    return region, 1.0 / zoom
+
+def make_lut(black=0, white=MAX_PIXEL_VALUE, curve=CURVE_LINEAR, gamma=DEFAULT_GAMMA):
+    """
+    Lookup table from every 12-bit pixel value to its 8-bit display value.
+    Args:
+        black (int): Pixel value shown as black - anything at or below it is 0.
+        white (int): Pixel value shown as white - anything at or above it is 255.
+        curve (str): CURVE_* between black and white.
+        gamma (float): Exponent of CURVE_GAMMA.
+    Returns:
+        np.ndarray: (MAX_PIXEL_VALUE + 1,) uint8 array.
+    """
+    if (curve not in DISPLAY_CURVES):
+        raise ValueError(f"Unknown display curve {curve}")
+    white = max(white, black + 1)
+    level = np.clip((np.arange(MAX_PIXEL_VALUE + 1, dtype=np.float64) - black) / (white - black), 0.0, 1.0)
+    if (curve == CURVE_LOG):
+        level = np.log1p(LOG_CURVE_STRENGTH * level) / np.log1p(LOG_CURVE_STRENGTH)
+    elif (curve == CURVE_GAMMA):
+        level = level ** gamma
+    return np.rint(level * 255).astype(np.uint8)
+
+LINEAR_LUT = make_lut()
+
+def apply_lut(frame, lut):
+    """
+    Map a 12-bit image through a lookup table - one indexing pass, with no floating point temporaries.
+    Values outside 0 to MAX_PIXEL_VALUE are clipped to the ends of the table.
+    """
+    return lut.take(frame, mode="clip")
+
+def auto_levels(frame, percentiles=AUTO_CONTRAST_PERCENTILES, stride=AUTO_CONTRAST_STRIDE):
+    """
+    Black and white levels for auto-contrast: the given percentiles of the frame's pixel values.
+    Estimated from a strided subsample of the frame, which costs a small fraction of sorting every pixel.
+    Args:
+        frame (np.ndarray): 2D frame.
+        percentiles (tuple): (low, high) percentiles, 0 to 100.
+        stride (int): Sample every stride-th pixel of every stride-th row.
+    Returns:
+        tuple: (black, white) pixel values.
+    """
+    sample = frame[::stride, ::stride]
+    if (sample.size == 0):
+        sample = frame
+    black, white = np.percentile(sample, percentiles)
+    return int(black), int(np.ceil(white))
+
+def to_8bit(frame, mapping=None):
+    """
+    Scale a 12-bit image to 8 bits for display.
+    Args:
+        frame (np.ndarray): 2D frame.
+        mapping (DisplayMapping): Curve and contrast to display with, or None for a linear stretch of the full 12-bit range.
+    """
+    if (mapping == None):
+        return apply_lut(frame, LINEAR_LUT)
+    return mapping.map(frame)
+
+
+_PIXEL_VALUES = np.arange(MAX_PIXEL_VALUE + 1, dtype=np.float64)
+
+def accumulate_histogram(histogram, pixels):
+    """
+    Add pixels to a running histogram of a frame.
+    Args:
+        histogram (np.ndarray): (MAX_PIXEL_VALUE + 1,) int64 counts, updated in place.
+        pixels (np.ndarray): Integer pixel values, 0 to MAX_PIXEL_VALUE, of any shape.
+    """
+    if (pixels.size > 0):
+        histogram += np.bincount(pixels.ravel(), minlength=len(histogram))
+
+class FrameStatistics:
+    """
+    Pixel statistics of one frame: count, mean, standard deviation, min, max and saturated pixel count.
+    All are worked out from the frame's histogram, built up as its rows arrive, so no pass over the frame itself is needed.
+    """
+    def __init__(self, histogram):
+        """
+        Args:
+            histogram (np.ndarray): (MAX_PIXEL_VALUE + 1,) counts of each pixel value. Kept, not copied.
+        """
+        self.histogram = histogram
+        self.count = int(histogram.sum()) # Pixels received - fewer than the frame size if sections were lost
+        self.saturated = int(histogram[MAX_PIXEL_VALUE]) # Pixels at MAX_PIXEL_VALUE
+        if (self.count == 0):
+            self.mean = self.std = 0.0
+            self.min = self.max = None
+            return
+        self.mean = float(histogram @ _PIXEL_VALUES) / self.count
+        self.std = float(np.sqrt(histogram @ (_PIXEL_VALUES - self.mean) ** 2 / self.count))
+        present = np.flatnonzero(histogram)
+        self.min = int(present[0])
+        self.max = int(present[-1])
+
+    def __repr__(self):
+        return f"FrameStatistics(count={self.count}, mean={self.mean:.1f}, std={self.std:.1f}, min={self.min}, max={self.max}, saturated={self.saturated})"
+
+
+class DisplayMapping:
+    """
+    How 12-bit frames are shown in 8 bits: a display curve between black and white levels, optionally set by auto-contrast
+    from each frame mapped. The lookup table is only rebuilt when the curve or levels change.
+    Settings may be changed from one thread while another maps frames.
+    """
+    def __init__(self, curve=CURVE_LINEAR, gamma=DEFAULT_GAMMA, auto_contrast=False, black=0, white=MAX_PIXEL_VALUE,
+                 percentiles=AUTO_CONTRAST_PERCENTILES, stride=AUTO_CONTRAST_STRIDE):
+        """
+        Args:
+            curve (str): CURVE_* to display with.
+            gamma (float): Exponent of CURVE_GAMMA.
+            auto_contrast (bool): True to set the levels from each frame mapped, False to keep black and white.
+            black (int): Pixel value shown as black, until auto-contrast sets it.
+            white (int): Pixel value shown as white, until auto-contrast sets it.
+            percentiles (tuple): Percentiles auto-contrast maps to black and white.
+            stride (int): Auto-contrast samples every stride-th pixel of every stride-th row.
+        """
+        self.curve = curve
+        self.gamma = gamma
+        self.auto_contrast = auto_contrast
+        self.black = black
+        self.white = white
+        self.percentiles = percentiles
+        self.stride = stride
+        self._lock = threading.Lock()
+        self._lut = None
+        self._lut_key = None
+
+    def set_curve(self, curve, gamma=None):
+        if (curve not in DISPLAY_CURVES):
+            raise ValueError(f"Unknown display curve {curve}")
+        self.curve = curve
+        if (gamma != None):
+            self.gamma = gamma
+
+    def set_levels(self, black, white):
+        """Fix the black and white levels, turning auto-contrast off."""
+        self.auto_contrast = False
+        self.black = black
+        self.white = white
+
+    def lut(self):
+        """The lookup table for the current settings, rebuilt only if they have changed."""
+        key = (self.curve, self.gamma, self.black, self.white)
+        with self._lock:
+            if (key != self._lut_key):
+                self._lut = make_lut(self.black, self.white, self.curve, self.gamma)
+                self._lut_key = key
+            return self._lut
+
+    def map(self, frame, update_levels=True):
+        """
+        Map a frame to 8 bits.
+        Args:
+            frame (np.ndarray): 2D frame.
+            update_levels (bool): With auto-contrast on, set the levels from this frame. False to keep the current levels,
+                e.g. when mapping part of a frame that should match the rest.
+        Returns:
+            np.ndarray: uint8 image of the same shape.
+        """
+        if (self.auto_contrast and update_levels):
+            self.black, self.white = auto_levels(frame, self.percentiles, self.stride)
+        return apply_lut(frame, self.lut())
+
+def update_preview(preview, frame, row_start, row_end, factor, mapping=None):
+    """
+    Re-bin just the rows of a frame that have changed into an existing 8-bit preview, for drawing a frame as it arrives.
+    Args:
+        preview (np.ndarray): uint8 preview of the frame, binned by factor. Updated in place.
+        frame (np.ndarray): Full-resolution frame.
+        row_start (int): First changed frame row.
+        row_end (int): Frame row after the last changed one.
+        factor (int): Binning factor of the preview.
+        mapping (DisplayMapping): Curve and contrast to display with, keeping its current levels, or None for a linear stretch.
+    """
+    start = row_start // factor
+    end = min(-(-row_end // factor), preview.shape[0]) # Every preview row touched by a changed row
+    if (end > start):
+        band = bin_frame(frame[start * factor:end * factor], factor)
+        preview[start:end] = to_8bit(band) if mapping == None else mapping.map(band, update_levels=False)
+
+def missing_sections(filled, width, factor):
+    """
+    Which pixels of a binned preview belong to row sections not received yet.
+    Args:
+        filled (np.ndarray): (height, sections) bool array of the row sections received.
+        width (int): Width of the preview in pixels.
+        factor (int): Binning factor of the preview - a preview pixel is missing if any row binned into it is.
+    Returns:
+        np.ndarray: bool array of shape (height // factor, width).
+    """
+    height = filled.shape[0] // factor
+    missing = ~filled[:height * factor].reshape(height, factor, filled.shape[1]).all(axis=1)
+    return np.repeat(missing, -(-width // filled.shape[1]), axis=1)[:, :width]
+
+def overlay_missing(preview, missing):
+    """
+    Tint missing pixels of an 8-bit preview red, so gaps stand out from dark parts of the image.
+    Args:
+        preview (np.ndarray): 2D uint8 image.
+        missing (np.ndarray): bool array of the same shape.
+    Returns:
+        np.ndarray: (height, width, 3) uint8 RGB image.
+    """
+    rgb = np.repeat(preview[:, :, None], 3, axis=2)
+    tinted = rgb[missing] // 2
+    tinted[:, 0] += 128
+    rgb[missing] = tinted
+    return rgb
@@ -0,0 +1,202 @@
+# FrameStacking.py
+# Co-adding frames for faint targets. Each stacker keeps preallocated arrays and folds every new frame in with a fixed number
+# of in-place operations, so the cost per frame does not grow with the number of frames stacked.
+
+import threading
+
+import numpy as np
+
+STACK_MEAN = "mean" # Running mean of every frame
+STACK_SIGMA_CLIP = "sigma_clip" # Running mean leaving out pixel values far from the mean so far, e.g. cosmic ray hits
+STACK_WINDOW = "window" # Mean of the last window frames
+STACK_MODES = (STACK_MEAN, STACK_SIGMA_CLIP, STACK_WINDOW)
+
+DEFAULT_CLIP_SIGMA = 3.0 # Pixel values more than this many standard deviations from the mean are left out
+DEFAULT_CLIP_WARMUP = 10 # Frames each pixel takes unclipped, before its standard deviation can be trusted
+MIN_CLIP_VARIANCE = 1.0 # Least variance, in ADU^2, clipping assumes - a pixel whose values so far were all equal still accepts nearby ones
+DEFAULT_STACK_WINDOW = 16 # Frames in a sliding window - 128 MB at 2048x2048
+
+
+class RunningMeanStack:
+    """Mean of every frame added, kept in a single float32 accumulator."""
+    def __init__(self, image_height, image_width):
+        self.count = 0 # Frames stacked
+        self._mean = np.zeros((image_height, image_width), dtype=np.float32)
+        self._scratch = np.zeros_like(self._mean)
+        self._lock = threading.Lock()
+
+    def add(self, frame):
+        """Fold a frame into the mean: mean += (frame - mean) / count."""
+        with self._lock:
+            self.count += 1
+            np.subtract(frame, self._mean, out=self._scratch, dtype=np.float32)
+            self._scratch *= 1.0 / self.count
+            self._mean += self._scratch
+
+    def result(self):
+        """The stacked frame, as a float32 copy safe to keep."""
+        with self._lock:
+            return self._mean.copy()
+
+    def rounded(self, out):
+        """
+        The stacked frame rounded to whole pixel values, for display - written into out, so no full-size arrays are allocated.
+        Args:
+            out (np.ndarray): int32 frame to write into.
+        """
+        with self._lock:
+            np.rint(self._mean, out=out, casting="unsafe")
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self._mean.fill(0)
+
+
+class SigmaClipStack:
+    """
+    Mean of every frame added, leaving out pixel values more than sigma standard deviations from that pixel's mean so far.
+    Each pixel's mean and variance are kept with Welford's running update, so nothing is recomputed over past frames.
+    """
+    def __init__(self, image_height, image_width, sigma=DEFAULT_CLIP_SIGMA, warmup=DEFAULT_CLIP_WARMUP):
+        """
+        Args:
+            sigma (float): Clipping threshold in standard deviations.
+            warmup (int): Values each pixel accepts before clipping starts. At least 2, as a variance needs two values.
+        """
+        if (warmup < 2):
+            raise ValueError(f"Sigma clipping warmup must be at least 2 frames, not {warmup}")
+        self.sigma = sigma
+        self.warmup = warmup
+        self.count = 0 # Frames stacked
+        self.rejected = 0 # Pixel values left out
+        shape = (image_height, image_width)
+        self._counts = np.zeros(shape, dtype=np.float32) # Values accepted per pixel
+        self._mean = np.zeros(shape, dtype=np.float32)
+        self._m2 = np.zeros(shape, dtype=np.float32) # Sum of squared differences from the mean
+        self._delta = np.zeros(shape, dtype=np.float32)
+        self._scratch = np.zeros(shape, dtype=np.float32)
+        self._squared = np.zeros(shape, dtype=np.float32)
+        self._accept = np.zeros(shape, dtype=bool)
+        self._warming = np.zeros(shape, dtype=bool)
+        self._lock = threading.Lock()
+
+    def add(self, frame):
+        with self._lock:
+            self.count += 1
+            delta = self._delta
+            scratch = self._scratch
+            accept = self._accept
+
+            # Accept a value if delta^2 <= sigma^2 * variance, or while the pixel is still warming up
+            np.subtract(frame, self._mean, out=delta, dtype=np.float32)
+            np.subtract(self._counts, 1, out=scratch)
+            np.maximum(scratch, 1, out=scratch)
+            np.divide(self._m2, scratch, out=scratch)
+            np.maximum(scratch, MIN_CLIP_VARIANCE, out=scratch)
+            scratch *= self.sigma * self.sigma
+            np.multiply(delta, delta, out=self._squared)
+            np.less_equal(self._squared, scratch, out=accept)
+            np.less(self._counts, self.warmup, out=self._warming)
+            accept |= self._warming
+            self.rejected += accept.size - int(np.count_nonzero(accept))
+
+            # Welford update: mean += delta / n, m2 += delta * (value - new mean)
+            # Rejected values get a delta of 0, so the same unmasked operations leave their pixels unchanged
+            delta *= accept
+            self._counts += accept
+            np.divide(delta, self._counts, out=scratch)
+            self._mean += scratch
+            np.subtract(frame, self._mean, out=scratch, dtype=np.float32)
+            scratch *= delta
+            self._m2 += scratch
+
+    def result(self):
+        """The stacked frame, as a float32 copy safe to keep."""
+        with self._lock:
+            return self._mean.copy()
+
+    def rounded(self, out):
+        """
+        The stacked frame rounded to whole pixel values, for display - written into out, so no full-size arrays are allocated.
+        Args:
+            out (np.ndarray): int32 frame to write into.
+        """
+        with self._lock:
+            np.rint(self._mean, out=out, casting="unsafe")
+
+    def std(self):
+        """Standard deviation of the accepted values of each pixel, as a float32 array."""
+        with self._lock:
+            return np.sqrt(self._m2 / np.maximum(self._counts - 1, 1))
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.rejected = 0
+            self._counts.fill(0)
+            self._mean.fill(0)
+            self._m2.fill(0)
+
+
+class SlidingWindowStack:
+    """
+    Mean of the last window frames, kept in a ring of frames with a running integer sum.
+    Each new frame is added to the sum and the frame it replaces subtracted, so the sum never drifts.
+    """
+    def __init__(self, image_height, image_width, window=DEFAULT_STACK_WINDOW):
+        """
+        Args:
+            window (int): Frames averaged.
+        """
+        self.window = window
+        self.count = 0 # Frames added in all
+        self._ring = np.zeros((window, image_height, image_width), dtype=np.uint16)
+        self._sum = np.zeros((image_height, image_width), dtype=np.int32)
+        self._lock = threading.Lock()
+
+    def add(self, frame):
+        with self._lock:
+            slot = self._ring[self.count % self.window]
+            self._sum -= slot
+            slot[...] = frame
+            self._sum += slot
+            self.count += 1
+
+    def result(self):
+        """The mean of the frames in the window, as a float32 array."""
+        with self._lock:
+            return np.multiply(self._sum, 1.0 / max(1, min(self.count, self.window)), dtype=np.float32)
+
+    def rounded(self, out):
+        """
+        The mean of the frames in the window rounded to whole pixel values, for display - written into out, in integers.
+        Args:
+            out (np.ndarray): int32 frame to write into.
+        """
+        with self._lock:
+            frames = max(1, min(self.count, self.window))
+            np.add(self._sum, frames // 2, out=out)
+            np.floor_divide(out, frames, out=out)
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self._ring.fill(0)
+            self._sum.fill(0)
+
+
+def make_stacker(mode, image_height, image_width, **options):
+    """
+    Create a stacker.
+    Args:
+        mode (str): STACK_* mode.
+        options: Passed to the stacker, e.g. sigma and warmup for STACK_SIGMA_CLIP, or window for STACK_WINDOW.
+    """
+    if (mode == STACK_MEAN):
+        return RunningMeanStack(image_height, image_width)
+    if (mode == STACK_SIGMA_CLIP):
+        return SigmaClipStack(image_height, image_width, **options)
+    if (mode == STACK_WINDOW):
+        return SlidingWindowStack(image_height, image_width, **options)
+    raise ValueError(f"Unknown stacking mode {mode}")
@@ -0,0 +1,378 @@
+# FrameStorage.py
+# Saving frames to disk off the acquisition path: background PNG writers, and raw recordings in a single memory-mapped file.
+
+import threading
+
+import queue
+
+import time
+import datetime
+
+import os
+
+import struct
+
+import cv2
+import numpy as np
+
+# What ImageWriterPool.submit does when every writer is busy and the queue is full
+POLICY_BLOCK = "block" # Wait for space - never loses a frame, but holds up the caller
+POLICY_DROP = "drop" # Discard the frame and count it
+POLICY_SPILL = "spill" # Write the raw frame as .npy on the caller's thread - no PNG encode, so much quicker, but still disk I/O
+
+DEFAULT_WRITERS = 2
+DEFAULT_WRITE_QUEUE_DEPTH = 4 # Frames waiting for a writer, on top of those being written
+DEFAULT_PNG_COMPRESSION = 1 # cv2 PNG compression level, 0 (fastest, largest) to 9 (slowest, smallest)
+
+# Raw recording file layout: header, then the frame index, then frames of little-endian 16-bit words each holding one 12-bit pixel.
+# Every region starts on a page boundary, and every frame is the same size, so frame i is at a fixed offset.
+RECORDING_MAGIC = b"CMOSREC1"
+RECORDING_VERSION = 1
+RECORDING_ALIGNMENT = 4096
+RECORDING_HEADER = struct.Struct("<8sIIIIQQQ") # Magic, version, height, width, bits per pixel, capacity, frame count, data offset
+RECORDING_COUNT_OFFSET = 32 # Byte offset of the frame count within the header, rewritten after each frame
+RECORDING_INDEX_DTYPE = np.dtype([("timestamp", "<f8"), ("frame_number", "<i8"), ("offset", "<u8")])
+RECORDING_PIXEL_DTYPE = np.dtype("<u2")
+DEFAULT_RECORDING_FRAMES = 256 # Frames preallocated per recording - 2 GB at 2048x2048
+
+
+def frame_filename(save_dir, timestamp=None, frame_number=None, extension="png"):
+    """
+    Name for a saved frame, unique even for several frames within one second.
+    Args:
+        save_dir (str): Directory to save in.
+        timestamp (float): Unix time of the frame, or None for now.
+        frame_number (int): Frame sequence number, if known.
+        extension (str): File extension, without the dot.
+    Returns:
+        str: Path of the file.
+    """
+    when = datetime.datetime.fromtimestamp(timestamp) if timestamp != None else datetime.datetime.now()
+    name = f"image_{when.strftime('%Y%m%d_%H%M%S_%f')}"
+    if (frame_number != None and frame_number >= 0):
+        name += f"_{frame_number:06d}"
+    return os.path.join(save_dir, f"{name}.{extension}")
+
+def to_16bit(frame):
+    """Scale a 12-bit frame to the full 16-bit range for saving."""
+    return (frame * (65535.0/4095)).astype(np.uint16)
+
+
+class ImageWriterPool:
+    """
+    Bounded pool of background threads that save frames as 16-bit PNGs, so encoding never runs on the receive or decode thread.
+    At most workers + queue_depth frames are held at once. What happens beyond that is set by policy (see POLICY_*).
+    """
+    def __init__(self, save_dir, workers=DEFAULT_WRITERS, queue_depth=DEFAULT_WRITE_QUEUE_DEPTH, compression=DEFAULT_PNG_COMPRESSION,
+                 policy=POLICY_DROP, spill_dir=None, log=print):
+        if (policy not in (POLICY_BLOCK, POLICY_DROP, POLICY_SPILL)):
+            raise ValueError(f"Unknown image writer policy: {policy}")
+        self.save_dir = save_dir # Directory to save PNGs to
+        self.compression = compression # PNG compression level, 0-9
+        self.policy = policy
+        self.spill_dir = spill_dir if spill_dir != None else save_dir # Directory for raw .npy frames written under POLICY_SPILL
+        self.log = log # Function called with a message for each saved, dropped or failed frame
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._threads = [threading.Thread(target=self._writer_loop, name=f"Image writer {i}", daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, frame, on_done=None, timestamp=None, frame_number=None):
+        """
+        Queue a frame to be saved.
+        Args:
+            frame (np.ndarray): 12-bit frame. Must not change until on_done is called.
+            on_done (function): Called with no arguments once the frame is no longer needed, whether it was saved or not.
+            timestamp (float): Unix time of the frame, for the file name.
+            frame_number (int): Frame sequence number, for the file name.
+        Returns:
+            bool: True if the frame was queued or spilled, False if it was dropped.
+        """
+        self.submitted += 1
+        job = (frame, on_done, timestamp, frame_number)
+
+        if (self.policy == POLICY_BLOCK):
+            self._queue.put(job)
+            return True
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            pass
+
+        if (self.policy == POLICY_SPILL):
+            try:
+                filename = frame_filename(self.spill_dir, timestamp, frame_number, extension="npy")
+                np.save(filename, frame.astype(np.uint16))
+                self.spilled += 1
+                self.log(f"Image writers busy, spilled raw frame to {filename}")
+                return True
+            except OSError as e:
+                self.failed += 1
+                self.log(f"Failed to spill frame: {e}")
+                return False
+            finally:
+                if (on_done != None):
+                    on_done()
+
+        self.dropped += 1
+        self.log("Image writers busy, frame not saved")
+        if (on_done != None):
+            on_done()
+        return False
+
+    def pending(self):
+        """Number of frames queued and not yet picked up by a writer."""
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued frame has been written.
+        Args:
+            timeout (float): Most seconds to wait, or None to wait indefinitely.
+        Returns:
+            bool: True if everything was written in time.
+        """
+        deadline = None if timeout == None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while (self._queue.unfinished_tasks > 0):
+                remaining = None if deadline == None else deadline - time.monotonic()
+                if (remaining != None and remaining <= 0):
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Flush queued frames, then stop the writer threads. For use on shutdown.
+        Args:
+            timeout (float): Most seconds to wait for queued frames to be written.
+        Returns:
+            bool: True if everything was written in time.
+        """
+        flushed = self.flush(timeout)
+        for thread in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break # Writers still busy after the timeout - they are daemon threads and end with the program
+        return flushed
+
+    def stats(self):
+        """Counts of frames submitted, written, dropped, spilled and failed, and the number queued."""
+        return {"submitted": self.submitted, "written": self.written, "dropped": self.dropped, "spilled": self.spilled,
+                "failed": self.failed, "queued": self.pending()}
+
+    def _writer_loop(self):
+        while (True):
+            job = self._queue.get()
+            if (job == None):
+                self._queue.task_done()
+                return
+            frame, on_done, timestamp, frame_number = job
+            try:
+                filename = frame_filename(self.save_dir, timestamp, frame_number)
+                if (cv2.imwrite(filename, to_16bit(frame), [cv2.IMWRITE_PNG_COMPRESSION, self.compression])):
+                    self.written += 1
+                    self.log(f"Saved image to {filename}")
+                else:
+                    self.failed += 1
+                    self.log(f"Failed to save image to {filename}")
+            except Exception as e:
+                self.failed += 1
+                self.log(f"Failed to save image: {e}")
+            finally:
+                if (on_done != None):
+                    on_done()
+                self._queue.task_done()
+
+
+def _align(offset):
+    return -(-offset // RECORDING_ALIGNMENT) * RECORDING_ALIGNMENT
+
+def _recording_layout(image_height, image_width, capacity):
+    """
+    Byte layout of a recording.
+    Returns:
+        tuple: (index offset, data offset, bytes per frame).
+    """
+    indexOffset = RECORDING_ALIGNMENT
+    dataOffset = _align(indexOffset + capacity * RECORDING_INDEX_DTYPE.itemsize)
+    return indexOffset, dataOffset, image_height * image_width * RECORDING_PIXEL_DTYPE.itemsize
+
+
+class FrameRecorder:
+    """
+    Appends raw 12-bit frames to a preallocated, memory-mapped recording file, with an index of timestamps and offsets.
+    Appending a frame is a single copy into the mapping - there is no encoding, and the OS writes pages back in the background.
+    The copy happens on the caller's thread, and stalls there if the OS falls behind writing back, so it adds to the latency of
+    whatever calls append.
+    Read recordings back with RecordingReader, including while they are still being written.
+    """
+    def __init__(self, path, image_height, image_width, capacity=DEFAULT_RECORDING_FRAMES):
+        """
+        Create the recording file, replacing any existing file, and allocate space for capacity frames up front.
+        Args:
+            path (str): File to record to.
+            image_height (int): Frame height in pixels.
+            image_width (int): Frame width in pixels.
+            capacity (int): Most frames the recording can hold.
+        """
+        self.path = path
+        self.image_height = image_height
+        self.image_width = image_width
+        self.capacity = capacity
+        self.frame_count = 0
+        self.dropped = 0 # Frames not recorded because the file was full
+        self._lock = threading.Lock()
+
+        indexOffset, self.data_offset, self.frame_bytes = _recording_layout(image_height, image_width, capacity)
+        size = self.data_offset + capacity * self.frame_bytes
+        with open(path, "wb") as file:
+            file.truncate(size)
+            # Reserve the disk space now, so a long recording cannot run out of space part way through
+            if (hasattr(os, "posix_fallocate")):
+                try:
+                    os.posix_fallocate(file.fileno(), 0, size)
+                except OSError:
+                    pass # Not supported by this filesystem - the file is sparse and fills in as frames are written
+
+        self._map = np.memmap(path, dtype=np.uint8, mode="r+", shape=(size,))
+        self._index = self._map[indexOffset:indexOffset + capacity * RECORDING_INDEX_DTYPE.itemsize].view(RECORDING_INDEX_DTYPE)
+        self._frames = self._map[self.data_offset:].view(RECORDING_PIXEL_DTYPE).reshape(capacity, image_height, image_width)
+        RECORDING_HEADER.pack_into(self._map, 0, RECORDING_MAGIC, RECORDING_VERSION, image_height, image_width, 12, capacity, 0, self.data_offset)
+
+    def append(self, frame, timestamp=None, frame_number=-1):
+        """
+        Record a frame.
+        Args:
+            frame (np.ndarray): 12-bit frame, image_height by image_width.
+            timestamp (float): Unix time of the frame, or None for now.
+            frame_number (int): Frame sequence number, if known.
+        Returns:
+            int: Index of the frame in the recording, or None if the recording is full or closed.
+        """
+        with self._lock:
+            if (self._map is None or self.frame_count >= self.capacity):
+                self.dropped += 1
+                return None
+            i = self.frame_count
+            np.copyto(self._frames[i], frame, casting="unsafe")
+            self._index[i] = (time.time() if timestamp == None else timestamp, frame_number, self.data_offset + i * self.frame_bytes)
+            # Count the frame only once it and its index entry are complete, so a live reader never sees a partial frame
+            self.frame_count += 1
+            struct.pack_into("<Q", self._map, RECORDING_COUNT_OFFSET, self.frame_count)
+            return i
+
+    def is_full(self):
+        return self.frame_count >= self.capacity
+
+    def flush(self):
+        """Write recorded frames out to disk now, rather than when the OS gets round to it."""
+        with self._lock:
+            if (self._map is not None):
+                self._map.flush()
+
+    def close(self):
+        """Flush the recording and shrink the file to the frames actually recorded."""
+        with self._lock:
+            if (self._map is None):
+                return
+            self._map.flush()
+            self._index = self._frames = self._map = None
+            size = self.data_offset + self.frame_count * self.frame_bytes
+        os.truncate(self.path, size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordingReader:
+    """
+    Random access to the frames of a recording made by FrameRecorder. Frames are read straight from the memory-mapped file,
+    so opening a recording is instant and reading any one frame costs the same regardless of its position.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            header = file.read(RECORDING_HEADER.size)
+        if (len(header) < RECORDING_HEADER.size):
+            raise ValueError(f"{path} is not a frame recording")
+        magic, version, self.image_height, self.image_width, self.bits_per_pixel, self.capacity, self.frame_count, dataOffset = RECORDING_HEADER.unpack(header)
+        if (magic != RECORDING_MAGIC or version != RECORDING_VERSION):
+            raise ValueError(f"{path} is not a frame recording")
+
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        indexOffset, self._data_offset, self._frame_bytes = _recording_layout(self.image_height, self.image_width, self.capacity)
+        self._index = self._map[indexOffset:indexOffset + self.capacity * RECORDING_INDEX_DTYPE.itemsize].view(RECORDING_INDEX_DTYPE)
+
+    def refresh(self):
+        """
+        Pick up frames appended since the reader was opened, for following a recording that is still being written.
+        Returns:
+            int: Number of frames now available.
+        """
+        self.frame_count = struct.unpack_from("<Q", self._map, RECORDING_COUNT_OFFSET)[0]
+        return self.frame_count
+
+    def __len__(self):
+        return self.frame_count
+
+    def __getitem__(self, i):
+        """
+        Frame i of the recording, as a read-only view of the file.
+        Returns:
+            np.ndarray: 16-bit array, image_height by image_width, holding 12-bit pixel values.
+        """
+        if (i < 0):
+            i += self.frame_count
+        if (i < 0 or i >= self.frame_count):
+            raise IndexError(f"Frame {i} not in recording of {self.frame_count} frames")
+        start = self._data_offset + i * self._frame_bytes
+        return self._map[start:start + self._frame_bytes].view(RECORDING_PIXEL_DTYPE).reshape(self.image_height, self.image_width)
+
+    def __iter__(self):
+        for i in range(self.frame_count):
+            yield self[i]
+
+    @property
+    def index(self):
+        """Index entries (timestamp, frame_number, offset) of the recorded frames."""
+        return self._index[:self.frame_count]
+
+    @property
+    def timestamps(self):
+        return self._index["timestamp"][:self.frame_count]
+
+    @property
+    def frame_numbers(self):
+        return self._index["frame_number"][:self.frame_count]
+
+    def frame_at_time(self, timestamp):
+        """
+        Index of the last frame recorded at or before a given time.
+        Args:
+            timestamp (float): Unix time.
+        Returns:
+            int: Frame index, or -1 if the recording starts after timestamp.
+        """
+        return int(np.searchsorted(self.timestamps, timestamp, side="right")) - 1
+
+    def close(self):
+        self._index = self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,197 @@
+# PacketCapture.py
+# Capturing the raw datagram stream received from the readout system, and replaying it later through CMOSReadoutInterface.
+# A capture file is a header followed by one record per datagram: arrival time, length, then the datagram exactly as received.
+
+import threading
+
+import queue
+
+import time
+
+import struct
+
+CAPTURE_MAGIC = b"CMOSCAP1"
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct("<8sIIId") # Magic, version, image height, image width, Unix time the capture started
+CAPTURE_RECORD = struct.Struct("<QH") # Nanoseconds since the capture started, datagram length
+CAPTURE_BUFFER_SIZE = 1024 * 1024 # Bytes buffered before writing to disk
+CAPTURE_QUEUE_DEPTH = 1024 # Most received batches waiting to be written before new ones are dropped
+
+_STOP = object()
+
+
+class PacketCaptureWriter:
+    """
+    Writes received datagrams, with their arrival times, to a capture file.
+    Capturing a batch only copies it into a queue - the file is written by a background thread, so the receiver never waits on the disk.
+    If the queue fills up, new batches are dropped and counted rather than waiting.
+    """
+    def __init__(self, path, image_height=0, image_width=0, queue_depth=CAPTURE_QUEUE_DEPTH):
+        """
+        Args:
+            path (str): File to capture to. Replaced if it exists.
+            image_height (int): Frame height in pixels, stored so the capture can be replayed with the right settings.
+            image_width (int): Frame width in pixels.
+            queue_depth (int): Most batches waiting to be written.
+        """
+        self.path = path
+        self.packets = 0 # Datagrams captured
+        self.bytes = 0 # Datagram bytes captured, not including record headers
+        self.dropped = 0 # Datagrams discarded because the queue was full
+        self._closed = False
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._file = open(path, "wb", buffering=CAPTURE_BUFFER_SIZE)
+        self._start_ns = time.perf_counter_ns()
+        self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, image_height, image_width, time.time()))
+        self._thread = threading.Thread(target=self._writer_loop, name="Packet capture writer", daemon=True)
+        self._thread.start()
+
+    def write(self, datagrams):
+        """
+        Capture datagrams that have just arrived. Never blocks.
+        Args:
+            datagrams (list): Received datagrams, as bytes-like objects. Copied, so they may be reused on return.
+        """
+        if (self._closed or len(datagrams) == 0):
+            return
+        arrival = time.perf_counter_ns() - self._start_ns
+        try:
+            # One join copies the whole batch, including datagrams that are views into reusable receive buffers
+            self._queue.put_nowait((arrival, [len(data) for data in datagrams], b"".join(datagrams)))
+        except queue.Full:
+            self.dropped += len(datagrams)
+
+    def _writer_loop(self):
+        """Writer thread: write queued batches to the file until closed."""
+        while (True):
+            item = self._queue.get()
+            if (item is _STOP):
+                break
+            arrival, lengths, joined = item
+            joined = memoryview(joined)
+            offset = 0
+            for length in lengths:
+                self._file.write(CAPTURE_RECORD.pack(arrival, length))
+                self._file.write(joined[offset:offset + length])
+                offset += length
+            self.bytes += offset
+            self.packets += len(lengths)
+        self._file.close()
+
+    def close(self, timeout=None):
+        """
+        Write every batch queued so far, then stop the writer thread and close the file.
+        Returns:
+            bool: True if everything was written in time.
+        """
+        if (not self._closed):
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PacketCaptureReader:
+    """Reads the datagrams in a capture file, in the order they arrived."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            header = file.read(CAPTURE_HEADER.size)
+        if (len(header) < CAPTURE_HEADER.size):
+            raise ValueError(f"{path} is not a packet capture")
+        magic, version, self.image_height, self.image_width, self.start_time = CAPTURE_HEADER.unpack(header)
+        if (magic != CAPTURE_MAGIC or version != CAPTURE_VERSION):
+            raise ValueError(f"{path} is not a packet capture")
+
+    def __iter__(self):
+        """
+        Yields:
+            tuple: (nanoseconds since the capture started, datagram bytes) for each datagram.
+                A record cut short by the capture ending abruptly is skipped.
+        """
+        with open(self.path, "rb", buffering=CAPTURE_BUFFER_SIZE) as file:
+            file.seek(CAPTURE_HEADER.size)
+            while (True):
+                record = file.read(CAPTURE_RECORD.size)
+                if (len(record) < CAPTURE_RECORD.size):
+                    return
+                arrival, length = CAPTURE_RECORD.unpack(record)
+                data = file.read(length)
+                if (len(data) < length):
+                    return
+                yield arrival, data
+
+
+class PacketReplay:
+    """
+    Source of datagrams from a capture file, handed out at the times they originally arrived.
+    Pass one to CMOSReadoutInterface as replay to run a capture through the normal decode path, with getPacket, getPackets or start.
+    """
+    def __init__(self, path, speed=1.0):
+        """
+        Args:
+            path (str): Capture file to replay.
+            speed (float): Replay speed relative to the original, e.g. 1.0 for real time or 10.0 for ten times faster.
+                None or 0 to replay as fast as the datagrams are taken.
+        """
+        self.reader = PacketCaptureReader(path)
+        self.image_height = self.reader.image_height
+        self.image_width = self.reader.image_width
+        self.speed = speed
+        self.packets = 0 # Datagrams handed out so far
+        self.finished = False # True once every datagram has been handed out
+        self._records = iter(self.reader)
+        self._next = None # Next record, read ahead to find when it is due
+        self._first_arrival = None
+        self._start_ns = None
+
+    def _peek(self):
+        if (self._next == None and not self.finished):
+            self._next = next(self._records, None)
+            if (self._next == None):
+                self.finished = True
+        return self._next
+
+    def _seconds_until(self, arrival):
+        """Seconds until a datagram that arrived at arrival nanoseconds into the capture is due."""
+        if (not self.speed):
+            return 0.0
+        due = self._start_ns + (arrival - self._first_arrival) / self.speed
+        return (due - time.perf_counter_ns()) / 1e9
+
+    def next_batch(self, max_packets=1, timeout=None):
+        """
+        Wait until the next datagram is due, then take it along with every following datagram also due by now.
+        Args:
+            max_packets (int): Most datagrams to take.
+            timeout (float): Most seconds to wait for the next datagram, or None to wait as long as needed.
+        Returns:
+            list: Datagrams, in order - empty if the timeout passed first. None once the capture has been fully replayed.
+        """
+        record = self._peek()
+        if (record == None):
+            return None
+        if (self._start_ns == None):
+            self._start_ns = time.perf_counter_ns()
+            self._first_arrival = record[0]
+
+        wait = self._seconds_until(record[0])
+        if (timeout != None and wait > timeout):
+            time.sleep(max(timeout, 0.0))
+            return []
+        if (wait > 0):
+            time.sleep(wait)
+
+        batch = []
+        while (record != None and len(batch) < max_packets and self._seconds_until(record[0]) <= 0):
+            batch.append(record[1])
+            self._next = None
+            record = self._peek()
+        self.packets += len(batch)
+        return batch
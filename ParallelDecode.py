@@ -0,0 +1,235 @@
+# ParallelDecode.py
+# Decoding image row packets in worker processes, for when one core cannot keep up. Frame buffers and per-worker histograms
+# live in shared memory, so workers write pixels straight into the frame being assembled and only small task and result
+# messages cross between processes. The main process keeps track of frame boundaries, and of which row sections have been
+# received, so each section is counted in the statistics exactly once.
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import queue
+
+import weakref
+
+import numpy as np
+
+import FrameProcessing
+
+DEFAULT_DECODE_WORKERS = 4
+SLOTS_PER_WORKER = 4 # Batches of packets each worker can have waiting, copied into shared memory for it
+HISTOGRAM_BINS = FrameProcessing.MAX_PIXEL_VALUE + 1
+WORKER_START_METHOD = "spawn" # Not fork - the interface already has threads running by the time workers start
+WORKER_JOIN_TIMEOUT = 2.0
+
+
+def _decode_worker(worker_index, names, image_height, image_width, buffer_count, pkts_per_row, packet_length, batch_size, tasks, results):
+    """
+    Worker process: decode batches of row packets from the input slots into the frame buffers.
+    Args:
+        names (tuple): Shared memory names of the frame buffers, histograms, input slots and histogram flags.
+    """
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    frames, histograms, slots, counted = _shared_views(blocks, image_height, image_width, buffer_count, packet_length, batch_size)
+    histogram = histograms[worker_index]
+    sectionWidth = image_width // pkts_per_row
+    pixels = np.zeros((batch_size, sectionWidth), dtype=np.int32)
+    packets = None
+
+    try:
+        while (True):
+            task = tasks.get()
+            if (task == None):
+                break
+            slot, count, bufferIndex = task
+            packets = slots[slot, :count]
+            batchCounted = counted[slot, :count]
+
+            rows = (packets[:, 1].astype(np.intp) << 8) | packets[:, 2]
+            sections = packets[:, 3].astype(np.intp)
+            valid = (rows < image_height) & (sections < pkts_per_row)
+            batchPixels = pixels[:count]
+            FrameProcessing.unpack_12bit(packets[:, 4:], batchPixels)
+
+            validRows = rows[valid]
+            validSections = sections[valid]
+            frames[bufferIndex].reshape(image_height, pkts_per_row, sectionWidth)[validRows, validSections] = batchPixels[valid]
+            # Which packets to count was decided by the main process when the batch was submitted
+            FrameProcessing.accumulate_histogram(histogram, batchPixels[batchCounted])
+
+            rowStart = int(validRows.min()) if len(validRows) > 0 else image_height
+            rowEnd = int(validRows.max()) if len(validRows) > 0 else -1
+            results.put((slot, rowStart, rowEnd, count - len(validRows)))
+    finally:
+        # Views must go before the blocks can be closed
+        frames = histograms = slots = counted = histogram = packets = batchCounted = None
+        for block in blocks:
+            block.close()
+
+def _shared_views(blocks, image_height, image_width, buffer_count, packet_length, batch_size):
+    """NumPy views of the shared memory blocks: frame buffers, histograms, input slots, and which packets of each slot to count in the histogram."""
+    frameBlock, histogramBlock, slotBlock, countedBlock = blocks
+    frames = np.ndarray((buffer_count, image_height, image_width), dtype=np.int32, buffer=frameBlock.buf)
+    histograms = np.ndarray((histogramBlock.size // (HISTOGRAM_BINS * 8), HISTOGRAM_BINS), dtype=np.int64, buffer=histogramBlock.buf)
+    slotCount = slotBlock.size // (batch_size * packet_length)
+    slots = np.ndarray((slotCount, batch_size, packet_length), dtype=np.uint8, buffer=slotBlock.buf)
+    counted = np.ndarray((slotCount, batch_size), dtype=bool, buffer=countedBlock.buf)
+    return frames, histograms, slots, counted
+
+def _release_shared(processes, tasks, blocks):
+    """Stop the workers and free the shared memory - also run if a ParallelDecoder is never closed."""
+    for process in processes:
+        if (process.is_alive()):
+            tasks.put(None)
+    for process in processes:
+        process.join(WORKER_JOIN_TIMEOUT)
+        if (process.is_alive()):
+            process.terminate()
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            pass # Frame buffers still referenced - the memory goes once they do, as the name is unlinked below
+        block.unlink()
+
+
+class ParallelDecoder:
+    """
+    Pool of worker processes decoding full-length image row packets into shared-memory frame buffers.
+    The caller hands over batches in order with submit, and must call wait before reading a frame as finished -
+    batches are decoded in any order, which is harmless within a frame, as each packet writes only its own row section.
+    rows_filled is kept by submit, in the calling process, so a section may be marked received before a worker has decoded it.
+    """
+    def __init__(self, image_height, image_width, buffer_count, pkts_per_row, packet_length, batch_size, workers=DEFAULT_DECODE_WORKERS):
+        """
+        Args:
+            image_height (int): Frame height in pixels.
+            image_width (int): Frame width in pixels.
+            buffer_count (int): Frame buffers to allocate in shared memory, for the interface's FramePool.
+            pkts_per_row (int): Row sections per row.
+            packet_length (int): Length of a full row packet, header included. Longer packets are cut to this.
+            batch_size (int): Most packets per batch.
+            workers (int): Worker processes to start.
+        """
+        self.image_height = image_height
+        self.image_width = image_width
+        self.pkts_per_row = pkts_per_row
+        self.packet_length = packet_length
+        self.batch_size = batch_size
+        self.workers = workers
+        self.row_start = image_height # Rows decoded since take_decoded_rows, start to end inclusive
+        self.row_end = -1
+        self.discarded = 0 # Packets for out-of-range rows/sections since take_decoded_rows
+
+        slotCount = workers * SLOTS_PER_WORKER
+        sizes = (buffer_count * image_height * image_width * 4, workers * HISTOGRAM_BINS * 8, slotCount * batch_size * packet_length, slotCount * batch_size)
+        self._blocks = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+        self.frames, self._histograms, self._slots, self._counted = _shared_views(self._blocks, image_height, image_width, buffer_count, packet_length, batch_size)
+        self.frames.fill(0)
+        self.rows_filled = np.zeros((image_height, pkts_per_row), dtype=bool) # Row sections received for the frame being assembled
+        self._histograms.fill(0)
+        self._free_slots = list(range(slotCount))
+        self._outstanding = 0
+
+        context = multiprocessing.get_context(WORKER_START_METHOD)
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        names = tuple(block.name for block in self._blocks)
+        self._processes = [context.Process(target=_decode_worker, name=f"CMOS decode worker {i}", daemon=True,
+                                           args=(i, names, image_height, image_width, buffer_count, pkts_per_row, packet_length, batch_size, self._tasks, self._results))
+                           for i in range(workers)]
+        for process in self._processes:
+            process.start()
+        self._finalizer = weakref.finalize(self, _release_shared, self._processes, self._tasks, self._blocks)
+
+    def submit(self, datagrams, buffer_index):
+        """
+        Queue a batch of full-length row packets for decoding into a frame buffer. Waits for a free input slot if needed.
+        Args:
+            datagrams (list): Up to batch_size row packets, each at least packet_length long. Copied, so they may be reused on return.
+            buffer_index (int): Index of the frame buffer to decode into.
+        """
+        while (len(self._free_slots) == 0):
+            self._collect(block=True)
+        slot = self._free_slots.pop()
+        count = len(datagrams)
+        joined = b"".join(datagrams)
+        if (len(joined) == count * self.packet_length):
+            # The usual case - every packet exactly full length, so the batch is copied in one go
+            self._slots[slot, :count] = np.frombuffer(joined, dtype=np.uint8).reshape(count, self.packet_length)
+        else:
+            for i, data in enumerate(datagrams):
+                self._slots[slot, i] = np.frombuffer(data, dtype=np.uint8, count=self.packet_length)
+        self._mark_received(slot, count)
+        self._outstanding += 1
+        self._tasks.put((slot, count, buffer_index))
+        self._collect(block=False)
+
+    def _mark_received(self, slot, count):
+        """
+        Mark the row sections of a batch as received, and flag the packets that bring a section for the first time
+        to be counted in the histogram - a section received twice, in one batch or two, is counted once, whichever worker decodes it.
+        """
+        packets = self._slots[slot, :count]
+        rows = (packets[:, 1].astype(np.intp) << 8) | packets[:, 2]
+        sections = packets[:, 3].astype(np.intp)
+        validIndex = np.flatnonzero((rows < self.image_height) & (sections < self.pkts_per_row))
+        validRows = rows[validIndex]
+        validSections = sections[validIndex]
+        newIndex = validIndex[~self.rows_filled[validRows, validSections]]
+        if (len(newIndex) > 1):
+            keys = rows[newIndex].astype(np.int64) * self.pkts_per_row + sections[newIndex]
+            _, first = np.unique(keys, return_index=True)
+            newIndex = newIndex[first]
+        counted = self._counted[slot, :count]
+        counted.fill(False)
+        counted[newIndex] = True
+        self.rows_filled[validRows, validSections] = True
+
+    def _collect(self, block):
+        """Take results of finished batches, freeing their slots. If block, wait for at least one."""
+        while (self._outstanding > 0):
+            try:
+                slot, rowStart, rowEnd, discarded = self._results.get(block=block)
+            except queue.Empty:
+                return
+            block = False
+            self._outstanding -= 1
+            self._free_slots.append(slot)
+            self.row_start = min(self.row_start, rowStart)
+            self.row_end = max(self.row_end, rowEnd)
+            self.discarded += discarded
+
+    def wait(self):
+        """Wait until every batch submitted so far has been decoded into its frame buffer."""
+        while (self._outstanding > 0):
+            self._collect(block=True)
+
+    def take_decoded_rows(self):
+        """
+        Rows decoded and packets discarded since the last call, taking in any finished results first.
+        Returns:
+            tuple: (row start, row end inclusive, discarded packets). Start is greater than end if no rows were decoded.
+        """
+        self._collect(block=False)
+        result = (self.row_start, self.row_end, self.discarded)
+        self.row_start = self.image_height
+        self.row_end = -1
+        self.discarded = 0
+        return result
+
+    def take_histogram(self, out):
+        """
+        Add the workers' histograms of the frame just finished to out, and clear them for the next frame. Call after wait.
+        Args:
+            out (np.ndarray): (HISTOGRAM_BINS,) int64 histogram, updated in place.
+        """
+        out += self._histograms.sum(axis=0)
+        self._histograms.fill(0)
+
+    def clear_histogram(self):
+        self._histograms.fill(0)
+
+    def close(self):
+        """Stop the workers and free the shared memory. Frame buffers must no longer be in use."""
+        self.frames = self.rows_filled = self._histograms = self._slots = self._counted = None
+        self._finalizer()
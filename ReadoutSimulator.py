@@ -0,0 +1,353 @@
+# ReadoutSimulator.py
+# Simulates the CMOS Readout System development board, so the GUI and CMOSReadoutInterface can be exercised without hardware.
+# Speaks the same packet protocol as the board, over localhost UDP or a pseudo-terminal serial port.
+#
+# UDP, with the GUI listening on localhost:
+#   python ReadoutSimulator.py --host 127.0.0.1 --port 50007
+#   python gui.py --hostname 127.0.0.1
+# Serial (Linux/macOS) - open the printed device name as the serial port:
+#   python ReadoutSimulator.py --serial
+# Load test, streaming as fast as possible with 1% packet loss:
+#   python ReadoutSimulator.py --stream --frame-rate 0 --loss 0.01
+
+import threading
+
+import socket
+
+import time
+
+import optparse
+
+import os
+
+import numpy as np
+
+import CMOSReadoutInterface as cri
+
+DEFAULT_HOST = "127.0.0.1" # Address the host (GUI) listens on
+DEFAULT_PORT = 50007
+
+PATTERN_FRAMES = 8 # Distinct synthetic frames generated up front and cycled through while streaming
+TELEMETRY_INTERVAL = 1.0 # Seconds between telemetry packets
+
+STATE_STANDBY = 0x0F
+STATE_IMAGE_COLLECTION = 0xF0
+
+_CMD_IMAGE_ENABLE = bytes.fromhex(cri.CMD_P_IMAGE_ENABLE)
+_CMD_IMAGE_REQUEST = bytes.fromhex(cri.CMD_IMAGE_REQUEST)
+_CMD_RESET = bytes.fromhex(cri.CMD_RESET)
+_CMD_ABORT = bytes.fromhex(cri.CMD_ABORT)
+_CMD_CMOS_SETTING = bytes.fromhex(cri.CMD_P_CMOS_SETTING)
+_CMD_GET_CMOS = bytes.fromhex(cri.CMD_P_GET_CMOS)
+_CMD_WRITE_FLASH = bytes.fromhex(cri.CMD_WRITE_FLASH)
+_CMD_ROW_REQUEST = bytes.fromhex(cri.CMD_P_ROW_REQUEST)
+
+
+def make_test_frames(image_height, image_width, count=PATTERN_FRAMES, seed=0):
+    """
+    Generate synthetic 12-bit frames: a diagonal gradient with a bright spot that moves from frame to frame, plus noise.
+    Args:
+        image_height (int): Frame height in pixels.
+        image_width (int): Frame width in pixels.
+        count (int): Number of frames.
+        seed (int): Noise random seed, so runs are repeatable.
+    Returns:
+        np.ndarray: (count, image_height, image_width) uint16 array.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:image_height, 0:image_width]
+    gradient = (x + y) * (3000.0 / max(1, image_height + image_width - 2))
+
+    frames = np.empty((count, image_height, image_width), dtype=np.uint16)
+    for i in range(count):
+        cx = image_width * (i + 1) / (count + 1)
+        cy = image_height / 2
+        spot = 1000.0 * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * (image_width / 32) ** 2))
+        noise = rng.normal(0, 20, size=(image_height, image_width))
+        frames[i] = np.clip(gradient + spot + noise, 0, 4095).astype(np.uint16)
+    return frames
+
+def build_row_packets(frame):
+    """
+    Encode a frame as image row packets, one per row section, exactly as the board sends them.
+    Args:
+        frame (np.ndarray): (height, width) array of 12-bit pixels.
+    Returns:
+        np.ndarray: (height * PKTS_PER_ROW, packet length) uint8 array, one row packet per row, in row then section order.
+    """
+    height, width = frame.shape
+    sectionWidth = width // cri.PKTS_PER_ROW
+    sections = frame[:, :sectionWidth * cri.PKTS_PER_ROW].reshape(height, cri.PKTS_PER_ROW, sectionWidth)
+    payload = cri.pack_12bit(sections)
+
+    packets = np.empty((height, cri.PKTS_PER_ROW, 4 + payload.shape[-1]), dtype=np.uint8)
+    packets[:, :, 0] = cri._SIG_IMAGE_DATA_BYTES[0]
+    packets[:, :, 1] = (np.arange(height) >> 8)[:, None]
+    packets[:, :, 2] = (np.arange(height) & 0xFF)[:, None]
+    packets[:, :, 3] = np.arange(cri.PKTS_PER_ROW)[None, :]
+    packets[:, :, 4:] = payload
+    return packets.reshape(height * cri.PKTS_PER_ROW, -1)
+
+def telemetry_packet(state, temp1, temp2, voltage, fault_code):
+    """
+    Encode a telemetry packet, in the layout read by Telemetry.from_hex.
+    Returns:
+        bytes: TELEMETRY_PACKET_LENGTH byte packet.
+    """
+    return (cri._SIG_TELEMETRY_BYTES + bytes([state]) + int(temp1).to_bytes(2, "big") + int(temp2).to_bytes(2, "big")
+            + int(voltage).to_bytes(2, "big") + int(fault_code).to_bytes(4, "big"))
+
+
+class ReadoutBoardSimulator:
+    """
+    Stands in for the readout board: answers commands, streams frames as row packets, and sends periodic telemetry.
+    Impairments (loss, reordering, duplication) are applied to row packets only, so image start/end markers always arrive.
+    """
+    def __init__(self, image_height=2048, image_width=2048, host_address=(DEFAULT_HOST, DEFAULT_PORT), use_serial=False,
+                 frame_rate=1.0, loss=0.0, reorder=0.0, reorder_window=16, duplicate=0.0, seed=0):
+        self.image_height = image_height
+        self.image_width = image_width
+        self.host_address = host_address # (IP, port) the host listens on, for UDP
+        self.use_serial = use_serial # True to talk over a pseudo-terminal instead of UDP
+        self.frame_rate = frame_rate # Frames per second while streaming, or 0 for as fast as possible
+        self.loss = loss # Probability of dropping each row packet
+        self.reorder = reorder # Probability of delaying each row packet behind later ones
+        self.reorder_window = reorder_window # Most packets a reordered packet is delayed by
+        self.duplicate = duplicate # Probability of sending each row packet twice
+
+        self.state = STATE_STANDBY
+        self.streaming = False
+        self.frames_sent = 0
+        self.packets_sent = 0
+
+        self._rng = np.random.default_rng(seed)
+        self._frames = [build_row_packets(frame) for frame in make_test_frames(image_height, image_width, seed=seed)]
+        self._last_frame = self._frames[0] # Packets of the frame most recently sent, for answering row requests
+        self._running = False
+        self._send_lock = threading.Lock()
+        self._stream_wakeup = threading.Event()
+        self._threads = []
+
+        self.sock = None
+        self.serial_fd = None
+        self.serial_name = None
+
+    def start(self):
+        """Open the transport and start answering commands, streaming and sending telemetry."""
+        if (self.use_serial):
+            import pty, tty
+            self.serial_fd, slave_fd = pty.openpty()
+            tty.setraw(slave_fd)
+            self.serial_name = os.ttyname(slave_fd)
+            self._serial_slave_fd = slave_fd # Held open so the device stays usable between host connections
+            print(f"Simulated serial port: {self.serial_name}")
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, cri.RX_SOCKET_BUFFER_SIZE)
+            self.sock.bind(("127.0.0.1", 0))
+            print(f"Simulated board on {self.sock.getsockname()}, sending to {self.host_address}")
+
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._command_loop, name="Simulator commands", daemon=True),
+            threading.Thread(target=self._stream_loop, name="Simulator stream", daemon=True),
+            threading.Thread(target=self._telemetry_loop, name="Simulator telemetry", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+        # The host learns the board's address from the first datagram it receives
+        self.send_telemetry()
+
+    def stop(self):
+        """Stop all activity and close the transport."""
+        self._running = False
+        self.streaming = False
+        self._stream_wakeup.set()
+        if (self.sock != None):
+            self.sock.close()
+        if (self.serial_fd != None):
+            os.close(self.serial_fd)
+            os.close(self._serial_slave_fd)
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+
+    def _send(self, data):
+        """Send one packet to the host."""
+        with self._send_lock:
+            if (self.use_serial):
+                os.write(self.serial_fd, data)
+            else:
+                self.sock.sendto(data, self.host_address)
+            self.packets_sent += 1
+
+    def send_telemetry(self):
+        """Send one telemetry packet with slowly varying readings."""
+        t = time.time()
+        temp1 = 25 + 5 * np.sin(t / 60)
+        temp2 = 30 + 5 * np.cos(t / 60)
+        self._send(telemetry_packet(self.state, temp1, temp2, 5, 0))
+
+    def send_frame(self):
+        """Send the next synthetic frame: image start, its row packets (with impairments applied) and image end."""
+        packets = self._frames[self.frames_sent % len(self._frames)]
+        self._last_frame = packets
+        self._send(cri._SIG_IMAGE_START_BYTES)
+        for index in self._impaired_order(len(packets)):
+            self._send(packets[index])
+        self._send(cri._SIG_IMAGE_END_BYTES)
+        self.frames_sent += 1
+
+    def send_rows(self, start_row, row_count, section_mask):
+        """Resend some sections of a range of rows of the last frame, followed by image end, as for a row request."""
+        rows = np.arange(start_row, min(start_row + row_count, self.image_height))
+        sections = [section for section in range(cri.PKTS_PER_ROW) if (section_mask >> section) & 1]
+        indices = (rows[:, None] * cri.PKTS_PER_ROW + np.array(sections, dtype=np.intp)[None, :]).ravel()
+        for index in self._impaired_order(indices.size):
+            self._send(self._last_frame[indices[index]])
+        self._send(cri._SIG_IMAGE_END_BYTES)
+
+    def _impaired_order(self, count):
+        """
+        Order in which to send count packets, with loss, duplication and reordering applied.
+        Returns:
+            np.ndarray: Packet indices, possibly with some missing or repeated.
+        """
+        indices = np.arange(count)
+        if (self.loss > 0):
+            indices = indices[self._rng.random(count) >= self.loss]
+        if (self.duplicate > 0):
+            indices = np.repeat(indices, 1 + (self._rng.random(indices.size) < self.duplicate))
+        if (self.reorder > 0):
+            # Push a random subset of packets back by up to reorder_window places
+            keys = np.arange(indices.size, dtype=np.float64)
+            delayed = self._rng.random(indices.size) < self.reorder
+            keys[delayed] += self._rng.uniform(1, self.reorder_window + 1, size=np.count_nonzero(delayed))
+            indices = indices[np.argsort(keys, kind="stable")]
+        return indices
+
+    def _ack(self, command):
+        self._send(cri._SIG_ACK_BYTES + command[0:2])
+
+    def handle_command(self, data):
+        """
+        Act on one command from the host, as the board would.
+        Args:
+            data (bytes): Command packet, see encode_packet.
+        """
+        command = data[0:2]
+        if (command == _CMD_IMAGE_REQUEST):
+            self._ack(command)
+            self.send_frame()
+        elif (command == _CMD_IMAGE_ENABLE):
+            self._ack(command)
+            self.state = STATE_IMAGE_COLLECTION
+            self.streaming = True
+            self._stream_wakeup.set()
+        elif (command == _CMD_ABORT):
+            self._ack(command)
+            self.streaming = False
+            self.state = STATE_STANDBY
+        elif (command == _CMD_RESET):
+            self._ack(command)
+            self.streaming = False
+            self.state = STATE_STANDBY
+            self.frames_sent = 0
+        elif (command == _CMD_ROW_REQUEST and len(data) >= 7):
+            self.send_rows(int.from_bytes(data[2:4], "big"), int.from_bytes(data[4:6], "big"), data[6])
+        elif (command in (_CMD_CMOS_SETTING, _CMD_GET_CMOS, _CMD_WRITE_FLASH)):
+            self._ack(command)
+        else:
+            print(f"Simulator received unknown command: {data.hex()}")
+
+    def _command_loop(self):
+        """Receive commands from the host until stopped."""
+        while (self._running):
+            try:
+                if (self.use_serial):
+                    data = os.read(self.serial_fd, cri.RX_BUFFER_SIZE)
+                else:
+                    data, addr = self.sock.recvfrom(cri.RX_BUFFER_SIZE)
+            except OSError:
+                break # Transport closed
+            if (len(data) >= 2):
+                try:
+                    self.handle_command(data)
+                except OSError:
+                    break
+
+    def _stream_loop(self):
+        """Send frames back to back at frame_rate while in image collection mode."""
+        nextFrameTime = time.perf_counter()
+        while (self._running):
+            if (not self.streaming):
+                self._stream_wakeup.wait()
+                self._stream_wakeup.clear()
+                nextFrameTime = time.perf_counter()
+                continue
+            try:
+                self.send_frame()
+            except OSError:
+                break
+            if (self.frame_rate > 0):
+                nextFrameTime += 1.0 / self.frame_rate
+                delay = nextFrameTime - time.perf_counter()
+                if (delay > 0):
+                    time.sleep(delay)
+                else:
+                    nextFrameTime = time.perf_counter() # Running behind - do not try to catch up with a burst
+
+    def _telemetry_loop(self):
+        """Send telemetry every TELEMETRY_INTERVAL seconds."""
+        while (self._running):
+            time.sleep(TELEMETRY_INTERVAL)
+            try:
+                self.send_telemetry()
+            except OSError:
+                break
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--host", dest="host", default=DEFAULT_HOST, help="Host IP address to send to [default: %default].")
+    parser.add_option("-p", "--port", dest="port", type="int", default=DEFAULT_PORT, help="Host port to send to [default: %default].")
+    parser.add_option("--serial", dest="serial", action="store_true", default=False, help="Use a pseudo-terminal serial port instead of UDP.")
+    parser.add_option("--height", dest="height", type="int", default=2048, help="Frame height [default: %default].")
+    parser.add_option("--width", dest="width", type="int", default=2048, help="Frame width [default: %default].")
+    parser.add_option("--frame-rate", dest="frame_rate", type="float", default=1.0, help="Frames per second while streaming, 0 for as fast as possible [default: %default].")
+    parser.add_option("--loss", dest="loss", type="float", default=0.0, help="Row packet loss probability [default: %default].")
+    parser.add_option("--reorder", dest="reorder", type="float", default=0.0, help="Row packet reorder probability [default: %default].")
+    parser.add_option("--reorder-window", dest="reorder_window", type="int", default=16, help="Most places a reordered packet moves [default: %default].")
+    parser.add_option("--duplicate", dest="duplicate", type="float", default=0.0, help="Row packet duplication probability [default: %default].")
+    parser.add_option("--stream", dest="stream", action="store_true", default=False, help="Start streaming immediately, as if image collection was enabled.")
+    parser.add_option("--seed", dest="seed", type="int", default=0, help="Random seed for test frames and impairments [default: %default].")
+
+    (options, args) = parser.parse_args()
+
+    simulator = ReadoutBoardSimulator(
+        image_height = options.height,
+        image_width = options.width,
+        host_address = (options.host, options.port),
+        use_serial = options.serial,
+        frame_rate = options.frame_rate,
+        loss = options.loss,
+        reorder = options.reorder,
+        reorder_window = options.reorder_window,
+        duplicate = options.duplicate,
+        seed = options.seed,
+    )
+    simulator.start()
+    if (options.stream):
+        simulator.handle_command(_CMD_IMAGE_ENABLE)
+
+    try:
+        while (True):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    simulator.stop()
+    print(f"Sent {simulator.frames_sent} frames, {simulator.packets_sent} packets")
+
+
+if __name__ == "__main__":
+    main()
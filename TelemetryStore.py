@@ -0,0 +1,290 @@
+# TelemetryStore.py
+# In-memory history of telemetry readings, kept in preallocated NumPy arrays rather than one object per sample,
+# and bulk decoding of telemetry from packet captures and event logs into the same columns.
+
+import threading
+
+import csv
+
+import struct
+
+import time
+
+import numpy as np
+
+import PacketCapture
+
+DEFAULT_TELEMETRY_CAPACITY = 1000000 # Samples kept before the oldest are overwritten - 25 MB, about 11 days at one packet a second
+DEFAULT_QUERY_POINTS = 1000 # Most points returned by a query, e.g. roughly one per pixel of a plot
+
+# State strings from Telemetry.from_hex, stored as their index in this tuple
+TELEMETRY_STATES = ("Standby mode", "Image collection mode", "Invalid mode")
+_STATE_CODES = {name: code for code, name in enumerate(TELEMETRY_STATES)}
+
+# Stored fields, other than timestamp, and their types
+TELEMETRY_FIELDS = (("state", np.uint8), ("temp1", np.float32), ("temp2", np.float32), ("voltage", np.float32), ("fault_code", np.uint32))
+
+# Telemetry packet layout. CMOSReadoutInterface takes these from here too, so single and bulk decoding always agree.
+TELEMETRY_HEADER = 0x33
+TELEMETRY_PACKET_DTYPE = np.dtype([("header", "u1"), ("state", "u1"), ("temp1", ">u2"), ("temp2", ">u2"), ("voltage", ">u2"), ("fault_code", ">u4")]) # For decoding many packets at once
+TELEMETRY_PACKET_STRUCT = struct.Struct(">BBHHHI") # The same layout, for decoding one packet at a time
+TELEMETRY_STATE_BYTES = {0x0F: "Standby mode", 0xF0: "Image collection mode"} # Telemetry state byte values, anything else is invalid
+_STATE_BYTES = {value: _STATE_CODES[name] for value, name in TELEMETRY_STATE_BYTES.items()}
+
+
+class TelemetryStore:
+    """
+    Ring buffer of telemetry samples: timestamp, state, temp1, temp2, voltage and fault_code, one array per field.
+    Appending is O(1) and allocates nothing. Once full, each new sample overwrites the oldest.
+    Samples are assumed to be appended in time order.
+    """
+    def __init__(self, capacity=DEFAULT_TELEMETRY_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64) # Unix time of each sample
+        self.fields = {name: np.zeros(capacity, dtype=dtype) for name, dtype in TELEMETRY_FIELDS}
+        self._head = 0 # Index the next sample is written to
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def append(self, state, temp1, temp2, voltage, fault_code, timestamp=None):
+        """
+        Add a sample.
+        Args:
+            state (int or str): State code (index into TELEMETRY_STATES), or the state string from Telemetry.
+            timestamp (float): Unix time of the sample, or None for now.
+        """
+        if (isinstance(state, str)):
+            state = _STATE_CODES.get(state, _STATE_CODES["Invalid mode"])
+        with self._lock:
+            i = self._head
+            self.timestamps[i] = time.time() if timestamp == None else timestamp
+            fields = self.fields
+            fields["state"][i] = state
+            fields["temp1"][i] = temp1
+            fields["temp2"][i] = temp2
+            fields["voltage"][i] = voltage
+            fields["fault_code"][i] = fault_code
+            self._head = (i + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def append_telemetry(self, telemetry, timestamp=None):
+        """Add a sample from a Telemetry object."""
+        self.append(telemetry.state, telemetry.temp1, telemetry.temp2, telemetry.voltage, telemetry.fault_code, timestamp)
+
+    def extend(self, columns):
+        """
+        Add many samples at once, such as those decoded from a capture or log.
+        Args:
+            columns (dict): "timestamp" and each field name mapped to equal-length arrays, in time order.
+        """
+        n = len(columns["timestamp"])
+        if (n > self.capacity):
+            # Only the newest capacity samples would survive
+            columns = {name: values[n - self.capacity:] for name, values in columns.items()}
+            n = self.capacity
+        with self._lock:
+            positions = (self._head + np.arange(n)) % self.capacity
+            self.timestamps[positions] = columns["timestamp"]
+            for name, dtype in TELEMETRY_FIELDS:
+                self.fields[name][positions] = columns[name]
+            self._head = (self._head + n) % self.capacity
+            self._count = min(self._count + n, self.capacity)
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        with self._lock:
+            self._head = 0
+            self._count = 0
+
+    def _segments(self):
+        """Physical (start, stop) slices of the ring holding samples, oldest first."""
+        if (self._count < self.capacity):
+            return [(0, self._count)]
+        return [(self._head, self.capacity), (0, self._head)]
+
+    def _range(self, start, end):
+        """Physical slices holding samples with start <= timestamp <= end, oldest first."""
+        slices = []
+        for lo, hi in self._segments():
+            ts = self.timestamps[lo:hi]
+            i0 = lo + (0 if start == None else int(np.searchsorted(ts, start, side="left")))
+            i1 = lo + (len(ts) if end == None else int(np.searchsorted(ts, end, side="right")))
+            if (i1 > i0):
+                slices.append(slice(i0, i1))
+        return slices
+
+    def samples(self, start=None, end=None):
+        """
+        Every sample in a time range, undecimated.
+        Args:
+            start (float): Unix time of the earliest sample wanted, or None for the oldest kept.
+            end (float): Unix time of the latest sample wanted, or None for the newest.
+        Returns:
+            dict: "timestamp" and each field name, mapped to arrays in time order. Copies, safe to keep.
+        """
+        with self._lock:
+            slices = self._range(start, end)
+            result = {"timestamp": np.concatenate([self.timestamps[s] for s in slices]) if slices else np.zeros(0)}
+            for name, dtype in TELEMETRY_FIELDS:
+                result[name] = np.concatenate([self.fields[name][s] for s in slices]) if slices else np.zeros(0, dtype=dtype)
+        return result
+
+    def query(self, start=None, end=None, max_points=DEFAULT_QUERY_POINTS):
+        """
+        Samples in a time range, decimated for plotting. The range is split into at most max_points buckets of equal sample
+        count, and the min, max and mean of each field is given per bucket - so spikes survive decimation.
+        Args:
+            start (float): Unix time of the earliest sample wanted, or None for the oldest kept.
+            end (float): Unix time of the latest sample wanted, or None for the newest.
+            max_points (int): Most buckets to return.
+        Returns:
+            dict: "timestamp" (mean time of each bucket) and "count" (samples per bucket) arrays, and for each field name a dict of
+                "min", "max" and "mean" arrays. With no more samples than max_points, each bucket is a single sample.
+        """
+        with self._lock:
+            slices = self._range(start, end)
+            n = sum(s.stop - s.start for s in slices)
+            if (n == 0):
+                empty = np.zeros(0)
+                return dict({"timestamp": empty, "count": np.zeros(0, dtype=np.int64)}, **{name: {"min": empty, "max": empty, "mean": empty} for name, dtype in TELEMETRY_FIELDS})
+
+            buckets = min(n, max_points)
+            edges = (np.arange(buckets) * n) // buckets # First sample of each bucket, counting from the start of the range
+            counts = np.diff(np.append(edges, n))
+            timeSums = np.zeros(buckets)
+            sums = {name: np.zeros(buckets) for name, dtype in TELEMETRY_FIELDS}
+            mins = {name: np.empty(buckets, dtype=dtype) for name, dtype in TELEMETRY_FIELDS}
+            maxes = {name: np.empty(buckets, dtype=dtype) for name, dtype in TELEMETRY_FIELDS}
+
+            # Reduce each ring slice in place, rather than copying the range out first
+            offset = 0 # Position of this slice within the range
+            for s in slices:
+                length = s.stop - s.start
+                first = int(np.searchsorted(edges, offset, side="right")) - 1 # Bucket the slice starts in
+                last = int(np.searchsorted(edges, offset + length, side="left")) # One past the bucket it ends in
+                localEdges = np.maximum(edges[first:last] - offset, 0)
+                straddles = edges[first] < offset # First bucket began in the previous slice, so combine with it
+                timeSums[first:last] += np.add.reduceat(self.timestamps[s], localEdges)
+                for name, dtype in TELEMETRY_FIELDS:
+                    values = self.fields[name][s]
+                    sums[name][first:last] += np.add.reduceat(values, localEdges, dtype=np.float64)
+                    _reduce_into(mins[name], np.minimum, np.minimum.reduceat(values, localEdges), first, straddles)
+                    _reduce_into(maxes[name], np.maximum, np.maximum.reduceat(values, localEdges), first, straddles)
+                offset += length
+
+        result = {"timestamp": timeSums / counts, "count": counts}
+        for name, dtype in TELEMETRY_FIELDS:
+            result[name] = {"min": mins[name], "max": maxes[name], "mean": sums[name] / counts}
+        return result
+
+    def latest(self):
+        """
+        The newest sample.
+        Returns:
+            dict: "timestamp" and each field name mapped to its value, or None if the store is empty.
+        """
+        with self._lock:
+            if (self._count == 0):
+                return None
+            i = (self._head - 1) % self.capacity
+            result = {"timestamp": float(self.timestamps[i])}
+            for name, dtype in TELEMETRY_FIELDS:
+                result[name] = self.fields[name][i].item()
+        result["state"] = TELEMETRY_STATES[result["state"]] if result["state"] < len(TELEMETRY_STATES) else result["state"]
+        return result
+
+
+def _reduce_into(out, ufunc, partial, first, straddles):
+    """
+    Store per-bucket results for one ring slice, starting at bucket first.
+    If straddles, the first result is combined with ufunc into what the previous slice left in that bucket.
+    """
+    if (straddles):
+        out[first] = ufunc(out[first], partial[0])
+        out[first + 1:first + len(partial)] = partial[1:]
+    else:
+        out[first:first + len(partial)] = partial
+
+def decode_telemetry(packets):
+    """
+    Decode many raw telemetry packets at once into NumPy columns. Anything that is not a 12-byte telemetry packet is skipped.
+    Args:
+        packets (list or bytes-like): Packets, or several packets concatenated.
+    Returns:
+        tuple: (columns, valid). columns maps each field name to an array, with state as an index into TELEMETRY_STATES.
+            valid is a boolean array marking which of the given packets were decoded, for matching them to timestamps.
+    """
+    size = TELEMETRY_PACKET_DTYPE.itemsize
+    if (isinstance(packets, (bytes, bytearray, memoryview))):
+        buffer = bytes(packets[:len(packets) - len(packets) % size])
+        valid = np.ones(len(buffer) // size, dtype=bool)
+    else:
+        valid = np.fromiter((len(packet) == size for packet in packets), dtype=bool, count=len(packets))
+        buffer = b"".join(packet for packet, ok in zip(packets, valid) if ok)
+
+    raw = np.frombuffer(buffer, dtype=TELEMETRY_PACKET_DTYPE)
+    isTelemetry = raw["header"] == TELEMETRY_HEADER
+    valid[valid] = isTelemetry
+    raw = raw[isTelemetry]
+
+    states = np.full(len(raw), _STATE_CODES["Invalid mode"], dtype=np.uint8)
+    for value, code in _STATE_BYTES.items():
+        states[raw["state"] == value] = code
+    columns = {"state": states}
+    for name, dtype in TELEMETRY_FIELDS[1:]:
+        columns[name] = raw[name].astype(dtype)
+    return columns, valid
+
+def telemetry_from_capture(path):
+    """
+    Decode every telemetry packet in a packet capture (see PacketCapture).
+    Args:
+        path (str): Capture file.
+    Returns:
+        dict: "timestamp" (Unix time each packet arrived) and each field name, mapped to arrays.
+    """
+    reader = PacketCapture.PacketCaptureReader(path)
+    size = TELEMETRY_PACKET_DTYPE.itemsize
+    arrivals = []
+    packets = []
+    for arrival, data in reader:
+        if (len(data) == size and data[0] == TELEMETRY_HEADER):
+            arrivals.append(arrival)
+            packets.append(data)
+
+    columns, valid = decode_telemetry(packets)
+    columns["timestamp"] = reader.start_time + np.asarray(arrivals, dtype=np.float64)[valid] / 1e9
+    return columns
+
+def telemetry_from_log(path):
+    """
+    Read every telemetry reading back from an event log CSV written by CMOSReadoutInterface.
+    Handles logs with and without the level column.
+    Args:
+        path (str): Log file, e.g. packet_log.csv.
+    Returns:
+        dict: "timestamp" (Unix time) and each field name, mapped to arrays.
+    """
+    rows = []
+    with open(path, newline="") as file:
+        for row in csv.reader(file):
+            # Older logs have no level column
+            offset = 2 if (len(row) > 2 and row[1] == "Received telemetry") else 3
+            if (len(row) == offset + 5 and row[offset - 1] == "Received telemetry"):
+                rows.append([row[0]] + row[offset:])
+
+    table = np.array(rows, dtype=str).reshape(-1, 6)
+    states = np.full(len(table), _STATE_CODES["Invalid mode"], dtype=np.uint8)
+    for name, code in _STATE_CODES.items():
+        states[table[:, 1] == name] = code
+
+    columns = {
+        # Log times are UTC "YYYY-MM-DD HH:MM:SS.mmm", which NumPy parses as a whole column, as microseconds since the epoch
+        "timestamp": table[:, 0].astype("datetime64[us]").astype(np.int64) / 1e6,
+        "state": states,
+    }
+    for i, (name, dtype) in enumerate(TELEMETRY_FIELDS[1:]):
+        columns[name] = table[:, 2 + i].astype(np.float64).astype(dtype)
+    return columns
@@ -0,0 +1,404 @@
+# benchmark.py
+# Throughput and latency benchmarks for the acquisition path in CMOSReadoutInterface.
+# Drives the interface with synthetic frames from ReadoutSimulator, both in-process and over loopback UDP,
+# and saves the results as JSON so runs on different commits can be compared.
+#
+#   python benchmark.py                                  # run everything at 2048x2048
+#   python benchmark.py --frames 20 --no-udp             # in-process only
+#   python benchmark.py --compare benchmark_results/old.json
+#   python benchmark.py --replay field.cmoscap           # decode a packet capture, to compare decoder versions on identical input
+#   python benchmark.py --decode-workers 1,2,4,8         # scaling of the multi-process decoder
+
+import socket
+
+import time
+import datetime
+
+import optparse
+
+import sys
+
+import os
+
+import json
+
+import platform
+
+import subprocess
+
+import tempfile
+
+import tracemalloc
+
+import multiprocessing
+
+import hashlib
+
+import numpy as np
+
+import CMOSReadoutInterface as cri
+import ReadoutSimulator as rs
+import PacketCapture
+
+DEFAULT_FRAMES = 10
+DEFAULT_DECODE_WORKERS = "1,2,4" # Worker process counts to benchmark the parallel decoder with
+RESULTS_DIR = "benchmark_results"
+UDP_TIMEOUT = 30.0 # Seconds to wait for frames over loopback UDP before giving up
+MEMORY_FRAMES = 2 # Frames decoded in the untimed pass measuring peak memory
+
+
+def _frame_datagrams(image_height, image_width, frame_count):
+    """
+    Build the datagrams the board would send for frame_count synthetic frames.
+    Returns:
+        list: One list of bytes datagrams per frame, each starting with image start and ending with image end.
+    """
+    frames = rs.make_test_frames(image_height, image_width, count=min(frame_count, rs.PATTERN_FRAMES))
+    packetSets = [[bytes(packet) for packet in rs.build_row_packets(frame)] for frame in frames]
+    return [[cri._SIG_IMAGE_START_BYTES] + packetSets[i % len(packetSets)] + [cri._SIG_IMAGE_END_BYTES] for i in range(frame_count)]
+
+def _summary(values):
+    """Mean, median, 95th percentile and max of a list of timings, in milliseconds."""
+    values = np.asarray(values, dtype=np.float64) * 1000.0
+    if (values.size == 0):
+        return None
+    return {"mean_ms": float(values.mean()), "median_ms": float(np.median(values)), "p95_ms": float(np.percentile(values, 95)), "max_ms": float(values.max())}
+
+def _throughput(packet_count, byte_count, seconds):
+    return {"seconds": seconds, "packets_per_s": packet_count / seconds, "mb_per_s": byte_count / seconds / 1e6}
+
+def bench_decode(image_height, image_width, datagrams, batched):
+    """
+    Feed pre-built datagrams straight into the interface's parser, with no socket involved.
+    Args:
+        batched (bool): Use the batch decoder (getPackets path) rather than one datagram at a time (getPacket path).
+    Returns:
+        dict: Throughput and per-frame assembly latency.
+    """
+    iface = cri.CMOSReadoutInterface(image_height, image_width)
+    assembly = []
+    packetCount = sum(len(frame) for frame in datagrams)
+    byteCount = sum(len(packet) for frame in datagrams for packet in frame)
+
+    start = time.perf_counter()
+    for frame in datagrams:
+        if (batched):
+            packets = []
+            for i in range(0, len(frame), cri.RX_BATCH_SIZE):
+                packets += iface._process_batch(frame[i:i + cri.RX_BATCH_SIZE])
+        else:
+            packets = [iface._process_datagram(packet) for packet in frame]
+        for packet in packets:
+            if (packet != None and packet.type == cri.PacketType.TYPE_IMAGE_DATA):
+                assembly.append(packet.data2.assembly_seconds)
+                packet.release()
+    seconds = time.perf_counter() - start
+
+    result = _throughput(packetCount, byteCount, seconds)
+    result["frames"] = len(assembly)
+    result["frames_per_s"] = len(assembly) / seconds
+    result["assembly"] = _summary(assembly)
+    return result
+
+def bench_parallel_decode(image_height, image_width, datagrams, workers):
+    """
+    Feed pre-built datagrams through the batch decoder with row packets decoded by worker processes (see ParallelDecode).
+    The first frame is decoded before timing starts, so worker start-up is not counted.
+    Args:
+        workers (int): Decode worker processes.
+    Returns:
+        dict: Throughput and per-frame assembly latency.
+    """
+    iface = cri.CMOSReadoutInterface(image_height, image_width, decode_workers=workers)
+    try:
+        for packets in [iface._process_batch(datagrams[0][i:i + cri.RX_BATCH_SIZE]) for i in range(0, len(datagrams[0]), cri.RX_BATCH_SIZE)]:
+            for packet in packets:
+                packet.release()
+
+        assembly = []
+        packetCount = sum(len(frame) for frame in datagrams)
+        byteCount = sum(len(packet) for frame in datagrams for packet in frame)
+        start = time.perf_counter()
+        for frame in datagrams:
+            for i in range(0, len(frame), cri.RX_BATCH_SIZE):
+                for packet in iface._process_batch(frame[i:i + cri.RX_BATCH_SIZE]):
+                    if (packet.type == cri.PacketType.TYPE_IMAGE_DATA):
+                        assembly.append(packet.data2.assembly_seconds)
+                    packet.release()
+        seconds = time.perf_counter() - start
+    finally:
+        iface.close_decode_workers()
+
+    result = _throughput(packetCount, byteCount, seconds)
+    result["workers"] = workers
+    result["frames"] = len(assembly)
+    result["frames_per_s"] = len(assembly) / seconds
+    result["assembly"] = _summary(assembly)
+    return result
+
+def bench_end_of_frame(image_height, image_width, frame_count):
+    """
+    Time the work done at image end on its own: handing off the buffer, resizing and normalizing the preview,
+    with and without handing the frame to the background image writers. Also times how long the writers then take to catch up.
+    Returns:
+        dict: Timing summaries for each case.
+    """
+    result = {}
+    frame = rs.make_test_frames(image_height, image_width, count=1)[0]
+    with tempfile.TemporaryDirectory() as saveDir:
+        for save in (False, True):
+            iface = cri.CMOSReadoutInterface(image_height, image_width, enable_save_images=save, image_save_dir=saveDir)
+            timings = []
+            for i in range(frame_count):
+                iface._frame[:] = frame
+                start = time.perf_counter()
+                packet = iface._finish_frame()
+                timings.append(time.perf_counter() - start)
+                packet.release()
+            result["with_save" if save else "without_save"] = _summary(timings)
+            if (save):
+                start = time.perf_counter()
+                iface.close_image_writer()
+                result["save_backlog_flush_ms"] = (time.perf_counter() - start) * 1000.0
+    return result
+
+def _simulator_process(image_height, image_width, host_address, frame_count, go, stop, results):
+    """
+    Simulator side of bench_udp, in its own process so sending does not compete with the receiver for the GIL.
+    Sends frame_count frames once go is set and reports how long that took, then the packets sent in all once stop is set.
+    """
+    simulator = rs.ReadoutBoardSimulator(image_height, image_width, host_address=host_address)
+    simulator.start()
+    go.wait()
+    packetsBefore = simulator.packets_sent
+    start = time.perf_counter()
+    for i in range(frame_count):
+        simulator.send_frame()
+    results.put(time.perf_counter() - start)
+    stop.wait()
+    simulator.stop()
+    results.put(simulator.packets_sent - packetsBefore)
+
+def bench_udp(image_height, image_width, frame_count, zero_copy):
+    """
+    Stream frames from the simulator, run in a separate process, to the threaded pipeline over loopback UDP,
+    as fast as the simulator can send.
+    Returns:
+        dict: Throughput, drops at each stage and per-frame assembly latency.
+    """
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(("127.0.0.1", 0))
+    context = multiprocessing.get_context("spawn")
+    go = context.Event()
+    stop = context.Event()
+    simulatorResults = context.Queue()
+    simulator = context.Process(target=_simulator_process, name="Simulator", daemon=True,
+                                args=(image_height, image_width, rx.getsockname(), frame_count, go, stop, simulatorResults))
+    simulator.start()
+    rx.recvfrom(cri.RX_BUFFER_SIZE) # Initial telemetry packet, sent once the simulator is ready
+
+    iface = cri.CMOSReadoutInterface(image_height, image_width, socket=rx, zero_copy_receive=zero_copy)
+    subscription = iface.subscribe(types=(cri.PacketType.TYPE_IMAGE_DATA,), maxsize=frame_count)
+    iface.start()
+
+    assembly = []
+    start = time.perf_counter()
+    go.set()
+    sendSeconds = simulatorResults.get()
+
+    # Wait until every frame has been completed or dropped, or nothing more is arriving
+    deadline = time.perf_counter() + UDP_TIMEOUT
+    lastDecoded = -1
+    while (time.perf_counter() < deadline):
+        for packet in subscription.get_all(timeout=0.5):
+            assembly.append(packet.data2.assembly_seconds)
+            packet.release()
+        stats = iface.pipeline_stats()
+        if (stats["frames_completed"] + stats["frames_dropped"] >= frame_count):
+            break
+        if (stats["decoded_datagrams"] == lastDecoded and stats["rx_queue_depth"] == 0):
+            break # Idle - remaining image end packets were lost
+        lastDecoded = stats["decoded_datagrams"]
+    seconds = time.perf_counter() - start
+
+    stats = iface.pipeline_stats()
+    iface.stop()
+    stop.set()
+    packetsSent = simulatorResults.get()
+    simulator.join()
+    rx.close()
+
+    result = _throughput(stats["decoded_datagrams"], stats["decoded_datagrams"] * (4 + iface._section_bytes), seconds)
+    result.update({
+        "zero_copy": zero_copy,
+        "send_seconds": sendSeconds,
+        "packets_sent": packetsSent,
+        "packets_lost_in_kernel": packetsSent - stats["rx_datagrams"] - stats["rx_dropped"],
+        "rx_dropped": stats["rx_dropped"],
+        "frames_completed": stats["frames_completed"],
+        "frames_dropped": stats["frames_dropped"],
+        "frames_per_s": stats["frames_completed"] / seconds,
+        "assembly": _summary(assembly),
+    })
+    return result
+
+def bench_replay(path, speed=None):
+    """
+    Replay a packet capture through getPackets, by default as fast as it can be decoded.
+    Frames are hashed, so runs on different commits can confirm they decoded the same capture identically.
+    Args:
+        path (str): Capture file made with CMOSReadoutInterface.start_capture.
+        speed (float): Replay speed relative to the original, or None for as fast as possible.
+    Returns:
+        dict: Throughput, frame count, per-frame assembly latency and a digest of every frame decoded.
+    """
+    replay = PacketCapture.PacketReplay(path, speed=speed)
+    iface = cri.CMOSReadoutInterface(replay.image_height, replay.image_width, replay=replay)
+    digest = hashlib.sha1()
+    assembly = []
+    hashSeconds = 0.0
+
+    start = time.perf_counter()
+    while (not replay.finished):
+        for packet in iface.getPackets():
+            if (packet.type == cri.PacketType.TYPE_IMAGE_DATA):
+                assembly.append(packet.data2.assembly_seconds)
+                hashStart = time.perf_counter()
+                digest.update(packet.data2.array.tobytes())
+                hashSeconds += time.perf_counter() - hashStart
+            packet.release()
+    seconds = time.perf_counter() - start - hashSeconds
+
+    stats = iface.pipeline_stats()
+    result = _throughput(replay.packets, replay.packets * (4 + iface._section_bytes), seconds)
+    result.update({
+        "capture": os.path.basename(path),
+        "image_height": replay.image_height,
+        "image_width": replay.image_width,
+        "frames": len(assembly),
+        "frames_dropped": stats["frames_dropped"],
+        "frames_per_s": len(assembly) / seconds,
+        "assembly": _summary(assembly),
+        "frames_sha1": digest.hexdigest(),
+    })
+    return result
+
+def measure_decode_memory(image_height, image_width, datagrams):
+    """
+    Peak memory allocated while batch decoding a few frames, traced in a pass of its own -
+    tracing slows Python code several times over, so it is kept out of every timed benchmark.
+    Returns:
+        float: Peak traced allocations in MB.
+    """
+    tracemalloc.start()
+    try:
+        bench_decode(image_height, image_width, datagrams[:MEMORY_FRAMES], batched=True)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MB, where the OS reports it."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 / 1024.0 if sys.platform == "darwin" else peak / 1024.0
+
+def run(image_height, image_width, frame_count, udp=True, replay=None, decode_workers=()):
+    """
+    Run every benchmark, or only the replay benchmark if given a capture to replay.
+    Returns:
+        dict: Results, with details of the machine and commit they were measured on.
+    """
+    results = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "image_height": image_height,
+        "image_width": image_width,
+        "frames": frame_count,
+    }
+
+    if (replay != None):
+        print(f"Replaying {replay}...")
+        results["replay"] = bench_replay(replay)
+        for key in ("image_height", "image_width", "frames"):
+            results[key] = results["replay"][key]
+    else:
+        datagrams = _frame_datagrams(image_height, image_width, frame_count)
+        print("Decoding in-process, one datagram at a time...")
+        results["decode_single"] = bench_decode(image_height, image_width, datagrams, batched=False)
+        print("Decoding in-process, batched...")
+        results["decode_batched"] = bench_decode(image_height, image_width, datagrams, batched=True)
+        for workers in decode_workers:
+            print(f"Decoding with {workers} worker process{'es' if workers > 1 else ''}...")
+            results[f"decode_workers_{workers}"] = bench_parallel_decode(image_height, image_width, datagrams, workers)
+        print("Timing end-of-frame processing...")
+        results["end_of_frame"] = bench_end_of_frame(image_height, image_width, min(frame_count, 5))
+        if (udp):
+            for zeroCopy in (False, True):
+                print(f"Streaming over loopback UDP{' (zero-copy)' if zeroCopy else ''}...")
+                results["udp_zero_copy" if zeroCopy else "udp"] = bench_udp(image_height, image_width, frame_count, zeroCopy)
+        print("Measuring decode memory...")
+        results["decode_peak_traced_mb"] = measure_decode_memory(image_height, image_width, datagrams)
+
+    results["peak_rss_mb"] = _peak_rss_mb()
+    return results
+
+def compare(results, baseline):
+    """Print the change in the headline numbers of results against a baseline run."""
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    sections = ["decode_single", "decode_batched", "udp", "udp_zero_copy", "replay"] + sorted(key for key in results if key.startswith("decode_workers_"))
+    for section in sections:
+        for key in ("packets_per_s", "frames_per_s"):
+            if (section in results and section in baseline and key in baseline[section] and baseline[section][key]):
+                ratio = results[section][key] / baseline[section][key]
+                print(f"  {section}.{key}: {baseline[section][key]:.1f} -> {results[section][key]:.1f} ({ratio:.2f}x)")
+    if ("replay" in results and "replay" in baseline):
+        same = results["replay"]["frames_sha1"] == baseline["replay"]["frames_sha1"]
+        print(f"  replay frames: {'identical' if same else 'DIFFERENT'}")
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--height", dest="height", type="int", default=2048, help="Frame height [default: %default].")
+    parser.add_option("--width", dest="width", type="int", default=2048, help="Frame width [default: %default].")
+    parser.add_option("-n", "--frames", dest="frames", type="int", default=DEFAULT_FRAMES, help="Frames per benchmark [default: %default].")
+    parser.add_option("--no-udp", dest="udp", action="store_false", default=True, help="Skip the loopback UDP benchmarks.")
+    parser.add_option("-o", "--output", dest="output", default=None, help="File to save results to [default: benchmark_results/<time>_<commit>.json].")
+    parser.add_option("--compare", dest="compare", default=None, help="Earlier results file to compare against.")
+    parser.add_option("--replay", dest="replay", default=None, help="Packet capture to decode, instead of the synthetic benchmarks.")
+    parser.add_option("--decode-workers", dest="decode_workers", default=DEFAULT_DECODE_WORKERS, help="Comma-separated worker process counts for the parallel decode benchmark, empty to skip [default: %default].")
+
+    (options, args) = parser.parse_args()
+
+    decodeWorkers = [int(count) for count in options.decode_workers.split(",") if count.strip()]
+    results = run(options.height, options.width, options.frames, udp=options.udp, replay=options.replay, decode_workers=decodeWorkers)
+
+    output = options.output
+    if (output == None):
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{results['commit'] or 'unknown'}.json")
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f"Saved results to {output}")
+
+    if (options.compare != None):
+        with open(options.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,23 @@
 import tkinter as tk
 
 import CMOSReadoutInterface as cri
+import FrameProcessing as fp
+import FrameStacking
 
 import threading
 
+import multiprocessing
+
 #import queue
 
+import collections
+
 import socket
 
 #import csv 
 
-#import time
-#import datetime
+import time
+import datetime
 
 import optparse
 
@@ -41,6 +47,14 @@ SERIAL_COM_PORT = 'COM4' # Serial port name (Windows: 'COM1', Linux: '/dev/ttyUS
 
 IMAGE_SAVE_DIR = "saved_images" # Directory to save images to
 
+DEFAULT_DISPLAY_FPS = 20 # Most times per second the image and telemetry on screen are updated
+
+HISTOGRAM_WIDTH = 256 # Histogram plot size in pixels - 16 pixel values per column
+HISTOGRAM_HEIGHT = 100
+
+CONSOLE_MAX_LINES = 1000 # Lines kept in the console text box
+CONSOLE_FLUSH_INTERVAL = 100 # Milliseconds between console text box updates
+
 
 
 # TODO:
@@ -50,30 +64,59 @@ IMAGE_SAVE_DIR = "saved_images" # Directory to save images to
     
 
 # Replaces standard sys.stdout with a GUI text box to display console output
+# Output is buffered, and added to the text box in one go on a timer from the Tk main loop, whichever thread printed it
 class ConsoleRedirect:
-    def __init__(self, text_widget):
+    def __init__(self, text_widget, max_lines=CONSOLE_MAX_LINES, flush_interval=CONSOLE_FLUSH_INTERVAL):
         self.text_widget = text_widget
         self.text_widget.config(state="normal")  
         self.text_widget.delete("1.0", tk.END)  
         self.text_widget.config(state="disabled") 
-        
+        self.max_lines = max_lines # Oldest lines are trimmed from the text box beyond this
+        self.flush_interval = flush_interval # Milliseconds between updates of the text box
 
-    def write(self, message):
-        self.text_widget.config(state="normal") 
         # When print() is called, write() is called twice - once with the message, once with a newline
-        self.text_widget.insert(tk.END, message) 
-        self.text_widget.see(tk.END) 
-        self.text_widget.config(state="disabled")  
+        # Only the last max_lines lines can be shown anyway, so output beyond that between updates is discarded
+        self._pending = collections.deque(maxlen=max_lines * 2)
+        self._lock = threading.Lock()
+        self._job = self.text_widget.after(self.flush_interval, self._update_widget)
+
+    def write(self, message):
+        with self._lock:
+            self._pending.append(message)
 
     def flush(self):
-        pass  # Required for compatibility with sys.stdout
+        pass  # Required for compatibility with sys.stdout - the text box is updated on the timer
+
+    def close(self):
+        """Stop updating the text box."""
+        if (self._job != None):
+            self.text_widget.after_cancel(self._job)
+            self._job = None
+
+    def _update_widget(self):
+        with self._lock:
+            text = "".join(self._pending)
+            self._pending.clear()
+
+        if (text):
+            self.text_widget.config(state="normal") 
+            self.text_widget.insert(tk.END, text) 
+            # Trim to max_lines - "end-1c" is the last character, on the empty line after the last newline
+            lines = int(self.text_widget.index("end-1c").split(".")[0]) - 1
+            if (lines > self.max_lines):
+                self.text_widget.delete("1.0", f"{lines - self.max_lines + 1}.0")
+            self.text_widget.see(tk.END) 
+            self.text_widget.config(state="disabled")  
+
+        self._job = self.text_widget.after(self.flush_interval, self._update_widget)
 
 # Window object, specifying image source, buttons, text, image refresh rate, and other parameters
 # implementation partially inspired by https://scribles.net/showing-video-image-on-tkinter-window-with-opencv/ 
 class MainWindow():
-    def __init__(self, window):
+    def __init__(self, window, display_fps=DEFAULT_DISPLAY_FPS, decode_workers=0):
         
         self.window = window 
+        self.display_interval = 1.0 / display_fps # Seconds between display updates
 
         # True if using UDP to transmit, false if using serial
         
@@ -96,6 +139,30 @@ class MainWindow():
         self.main_image = tk.Canvas(self.window, width=IMAGE_WIDTH//4, height=IMAGE_HEIGHT//4)
         self.main_image.create_rectangle(0, 0, IMAGE_WIDTH//4, IMAGE_HEIGHT//4, fill="red", outline="")
         self.main_image.grid(row=0, column=0, rowspan=10, columnspan=1)
+        # One display buffer and one canvas item, created once - each frame is pasted into the buffer in place
+        self.display_image = ImageTk.PhotoImage(Image.new("L", (IMAGE_WIDTH//4, IMAGE_HEIGHT//4)))
+        self.display_item = self.main_image.create_image(0, 0, anchor=tk.NW, image=self.display_image, state="hidden")
+        self.display_mode = "L"
+
+        # Progressive display: the frame being received is drawn as its rows arrive, with sections not yet received tinted red
+        self.progress_preview = None # 8-bit preview of the frame being received, updated band by band
+        self.progress_rgb = None # progress_preview with missing sections tinted, as displayed
+        self.progress_displayed = False # True while the display buffer holds progress_rgb, so bands of it can be repainted alone
+        self.progress_filled = None # Row sections already drawn into progress_preview
+        self.progress_frame = None # Number of the frame in progress_preview
+        self.last_frame_number = -1 # Number of the last finished frame shown - progress on it or earlier frames is stale
+
+        # Region of interest zoom: drag on the image to show that region at full resolution, click to show the area around
+        # that point at 1:1, right click to go back to the whole frame
+        self.roi = None # (x0, y0, x1, y1) in frame pixels, or None to show the whole frame
+        self.view_origin = (0, 0) # Frame pixel shown at the top left of the canvas
+        self.view_scale = IMAGE_WIDTH / (IMAGE_WIDTH//4) # Frame pixels per canvas pixel
+        self.drag_start = None
+        self.drag_rectangle = self.main_image.create_rectangle(0, 0, 0, 0, outline="yellow", state="hidden")
+        self.main_image.bind("<ButtonPress-1>", self.on_drag_start)
+        self.main_image.bind("<B1-Motion>", self.on_drag)
+        self.main_image.bind("<ButtonRelease-1>", self.on_drag_end)
+        self.main_image.bind("<ButtonPress-3>", self.reset_zoom)
         
         # Text box
         #self.l = tk.Label(self.window, text = "Send a command to readout system")
@@ -140,16 +207,55 @@ class MainWindow():
         self.checkbutton_save_images = tk.Checkbutton(self.window, text="Save images to disk", variable=self.enable_save_images, onvalue=1, offvalue=0)
         self.checkbutton_save_images.grid(row=9, column=1)
 
+        self.button_record = tk.Button(self.window, text="Start recording raw frames", command=self.toggle_recording)
+        self.button_record.grid(row=11, column=1)
+
+        self.button_capture = tk.Button(self.window, text="Start packet capture", command=self.toggle_capture)
+        self.button_capture.grid(row=12, column=1)
+
+        self.progressive = tk.IntVar(value = 0)
+        self.checkbutton_progressive = tk.Checkbutton(self.window, text="Progressive display", variable=self.progressive, onvalue=1, offvalue=0, command=self.toggle_progressive)
+        self.checkbutton_progressive.grid(row=13, column=1)
+
+        # 12-bit to 8-bit display mapping, applied to the preview by the interface and to zoomed regions here
+        self.display_curve = tk.StringVar(value = fp.CURVE_LINEAR)
+        self.optionmenu_curve = tk.OptionMenu(self.window, self.display_curve, *fp.DISPLAY_CURVES, command=self.set_display_curve)
+        self.optionmenu_curve.grid(row=14, column=1)
+
+        self.auto_contrast = tk.IntVar(value = 0)
+        self.checkbutton_auto_contrast = tk.Checkbutton(self.window, text="Auto contrast", variable=self.auto_contrast, onvalue=1, offvalue=0, command=self.toggle_auto_contrast)
+        self.checkbutton_auto_contrast.grid(row=15, column=1)
+
+        # Stacking - while on, the display shows the stack rather than each frame
+        self.stack_mode = tk.StringVar(value = FrameStacking.STACK_MEAN)
+        self.optionmenu_stack_mode = tk.OptionMenu(self.window, self.stack_mode, *FrameStacking.STACK_MODES)
+        self.optionmenu_stack_mode.grid(row=16, column=1)
+
+        self.button_stack = tk.Button(self.window, text="Start stacking", command=self.toggle_stacking)
+        self.button_stack.grid(row=17, column=1)
+        self.stack_frame = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH), dtype=np.int32) # The stack rounded for display, reused every update
+
         self.tele = tk.Text(self.window, width=30, height=6)
         self.tele.insert(1.0, "Waiting for telemetry")
         self.tele.config(state="disabled")
         self.tele.grid(row=10, column=1)
 
+        # Statistics of the last frame shown, and its histogram on a log scale
+        self.stats = tk.Text(self.window, width=30, height=6)
+        self.stats.insert(1.0, "Waiting for frame")
+        self.stats.config(state="disabled")
+        self.stats.grid(row=10, column=2)
+
+        self.histogram = tk.Canvas(self.window, width=HISTOGRAM_WIDTH, height=HISTOGRAM_HEIGHT, background="black")
+        self.histogram.grid(row=11, column=2, rowspan=4)
+        self.histogram_line = self.histogram.create_line(0, HISTOGRAM_HEIGHT, HISTOGRAM_WIDTH, HISTOGRAM_HEIGHT, fill="white")
+
         self.console_output = tk.Text(self.window, height=20, width=80, wrap="word")
         self.console_output.config(state="disabled")  
         self.console_output.grid(row=10, column=0, padx=10)
 
-        sys.stdout = ConsoleRedirect(self.console_output)  # Redirect stdout to the text box
+        self.console = ConsoleRedirect(self.console_output)
+        sys.stdout = self.console  # Redirect stdout to the text box
         #sys.stderr = ConsoleRedirect(self.console_output)  # Redirect stderr to the text box
         print("GUI started")
 
@@ -160,6 +266,8 @@ class MainWindow():
         # Initialize connection
         # Attempt to initialize UDP
         self.sock = None
+        self.addr = None
+        self.transmission_udp = True
         try:
             self.sock = udp_start()
             self.data, self.addr = self.sock.recvfrom(4096)
@@ -197,77 +305,247 @@ class MainWindow():
             image_height = IMAGE_HEIGHT,
             image_width = IMAGE_WIDTH,
             socket = self.sock,
-            transmission_udp = True,
-            serial_port = SERIAL_COM_PORT,
+            remote_address = self.addr,
+            transmission_udp = self.transmission_udp,
+            serial_port = self.ser,
             enable_save_images = True, 
             image_save_dir = IMAGE_SAVE_DIR,
-            
+            decode_workers = decode_workers,
         )
 
-        self.processor_thread = threading.Thread(target=self.update_image, daemon=True)
-        self.processor_thread.start()
+        # Receiving and decoding run on the interface's own threads, this window only consumes finished packets
+        # Frames and telemetry each go to a one-packet mailbox - a new packet replaces one not yet displayed,
+        # so the display only ever shows the latest and can never hold up acquisition
+        self.frame_mailbox = self.readout_interface.subscribe(types=(cri.PacketType.TYPE_IMAGE_DATA,), maxsize=1)
+        self.telemetry_mailbox = self.readout_interface.subscribe(types=(cri.PacketType.TYPE_TELEMETRY,), maxsize=1)
+        self.progress_mailbox = self.readout_interface.subscribe(types=(cri.PacketType.TYPE_IMAGE_PROGRESS,), maxsize=1)
+        self.ack_subscription = self.readout_interface.subscribe(types=(cri.PacketType.TYPE_ACK,))
+        self.readout_interface.start()
+
+        # Tk widgets may only be touched from the main loop, so the mailboxes are polled from it with window.after
+        self.running = True
+        self.update_job = self.window.after(0, self.update_image)
 
 
     def update_image(self):
-        """A separate thread to process incoming data and update the GUI accordingly"""
-        while (True): 
-            #time.sleep(0.2)
-            
-            data_hex = None
-            
-            latestPacket = self.readout_interface.getPacket() # Should block thread until a packet is received
+        """Runs on the Tk main loop at up to the display frame rate: show the newest frame and telemetry, skipping any older ones."""
+        if (not self.running):
+            return
+        start = time.perf_counter()
+
+        latestPacket = self.frame_mailbox.take_latest()
+        if (latestPacket != None): # finished frame, sent on image end packet
+            # Update video frame - or while stacking, the stack the frame has just been added to
+            stacker = self.readout_interface.stacker
+            if (stacker != None):
+                stacker.rounded(self.stack_frame)
+                self.show_full_frame(self.stack_frame)
+            else:
+                self.show_frame_packet(latestPacket)
+
+            # Only the preview is displayed, so the full-resolution frame buffer can go straight back to the pool
+            self.last_frame_number = latestPacket.data2.frame_number
+            self.show_statistics(latestPacket.data3)
+            latestPacket.release()
+
+        latestPacket = self.progress_mailbox.take_latest()
+        if (latestPacket != None):
+            # Progress on a frame already shown finished is dropped rather than drawn over it
+            if (self.progressive.get() and latestPacket.data4 > self.last_frame_number):
+                self.show_progress_packet(latestPacket)
+            latestPacket.release()
+
+        latestPacket = self.telemetry_mailbox.take_latest()
+        if (latestPacket != None):
+            curr_telemetry = latestPacket.data1
         
-           
-                
-            if (latestPacket.type == cri.PacketType.TYPE_IMAGE_DATA):
-                #print("Received image data packet")
-                continue
-            elif (latestPacket.type == cri.PacketType.TYPE_IMAGE_START): # image start packet
-                print("Received image start packet")
-            elif (latestPacket.type == cri.PacketType.TYPE_IMAGE_END): # image end packet
-                print("Received image end packet")
-                #percent_filled = np.count_nonzero(self.rows_filled) / self.rows_filled.size * 100
-                #print(f"Frame completion: {percent_filled:.1f}%")
-                print("Updating image:")
-                # Reset rows_filled to all false
-                self.rows_filled.fill(False)
-            
-                # Update video frame 
-                pil_image = ImageTk.PhotoImage(image=Image.fromarray(latestPacket.data1, mode='L')) # L = grayscale - ImageTK only supports 8-bit
-
-                # Check over these lines
-                self.main_image.create_image(0, 0, anchor=tk.NW, image=pil_image)
-                self.main_image.image = pil_image
-
-            elif (latestPacket.type == cri.PacketType.TYPE_TELEMETRY):
-                curr_telemetry = latestPacket.data1
-                
-                self.tele.config(state="normal")
-                self.tele.delete(1.0, tk.END) # clears entire text box at once
-                
-                # Print telemetry data to GUI
-                self.tele.insert("1.0", curr_telemetry.state)
-                self.tele.insert("end", f"\nTemperature 1: {curr_telemetry.temp1} C")
-                self.tele.insert("end", f"\nTemperature 2: {curr_telemetry.temp2} C")
-                self.tele.insert("end", f"\nVoltage: {curr_telemetry.voltage} V")
-                self.tele.insert("end", f"\nFault code: {curr_telemetry.fault_code}")
+            self.tele.config(state="normal")
+            self.tele.delete(1.0, tk.END) # clears entire text box at once
+        
+            # Print telemetry data to GUI
+            self.tele.insert("1.0", curr_telemetry.state)
+            self.tele.insert("end", f"\nTemperature 1: {curr_telemetry.temp1} C")
+            self.tele.insert("end", f"\nTemperature 2: {curr_telemetry.temp2} C")
+            self.tele.insert("end", f"\nVoltage: {curr_telemetry.voltage} V")
+            self.tele.insert("end", f"\nFault code: {curr_telemetry.fault_code}")
 
-                self.tele.config(state="disabled")
+            self.tele.config(state="disabled")
 
-                self.print("Received telemetry", curr_telemetry)
+        for latestPacket in self.ack_subscription.get_all(timeout=0):
+            self.console.write(f"Board acknowledged command {latestPacket.data1}\n")
 
-            elif (latestPacket.type == cri.PacketType.TYPE_ACK):
-                self.print("Received ACK")
-                    
-                
+        # Schedule the next update one display interval after this one started
+        elapsed = time.perf_counter() - start
+        self.update_job = self.window.after(max(1, int((self.display_interval - elapsed) * 1000)), self.update_image)
 
-            #self.ser.write(str.encode(str(dummy_value))) # Send a dummy byte to trigger the readout system - replace with actual command
+    def show_frame_packet(self, packet):
+        """Display a finished frame - its binned preview, or a full-resolution crop of the frame buffer in zoom mode."""
+        self.show_full_frame(packet.data2.array, packet.data1)
 
-            #out = b""
-            #while self.ser.inWaiting() > 0:
-            #    out += self.ser.read(1)
-            #print(out)
-           
+    def show_full_frame(self, frame, preview=None):
+        """
+        Display a full-resolution frame, binned to fit the canvas, or the zoomed region of it at full resolution.
+        Args:
+            frame (np.ndarray): 2D integer frame.
+            preview (np.ndarray): 8-bit binned preview of the frame if there already is one, or None to make one.
+        """
+        # Levels are left to the decoder thread, which sets them from each frame's preview - mapping here only reads them
+        if (self.roi == None):
+            if (preview is None):
+                preview = self.readout_interface.display_mapping.map(fp.bin_frame(frame, self.readout_interface.preview_binning), update_levels=False)
+            self.view_origin = (0, 0)
+            self.view_scale = IMAGE_WIDTH / preview.shape[1]
+        else:
+            # Only the region is read from the frame buffer - the crop is a view, not a copy
+            region, self.roi = fp.crop(frame, self.roi)
+            image, self.view_scale = fp.fit_to_display(region, IMAGE_WIDTH//4, IMAGE_HEIGHT//4)
+            self.view_origin = self.roi[0:2]
+            preview = self.readout_interface.display_mapping.map(image, update_levels=False)
+        self.show_frame(preview)
+
+    def show_statistics(self, statistics):
+        """Show a frame's FrameStatistics in the statistics box and histogram plot."""
+        self.stats.config(state="normal")
+        self.stats.delete(1.0, tk.END)
+        self.stats.insert("1.0", f"Mean: {statistics.mean:.1f}")
+        self.stats.insert("end", f"\nStd dev: {statistics.std:.1f}")
+        self.stats.insert("end", f"\nMin: {statistics.min}")
+        self.stats.insert("end", f"\nMax: {statistics.max}")
+        self.stats.insert("end", f"\nSaturated: {statistics.saturated}")
+        self.stats.insert("end", f"\nPixels: {statistics.count}")
+        self.stats.config(state="disabled")
+
+        # One column per group of pixel values, heights on a log scale so sparse bright pixels still show
+        counts = statistics.histogram.reshape(HISTOGRAM_WIDTH, -1).sum(axis=1)
+        heights = np.log1p(counts)
+        heights *= (HISTOGRAM_HEIGHT - 1) / max(heights.max(), 1.0)
+        coords = np.empty((HISTOGRAM_WIDTH, 2))
+        coords[:, 0] = np.arange(HISTOGRAM_WIDTH)
+        coords[:, 1] = HISTOGRAM_HEIGHT - heights
+        self.histogram.coords(self.histogram_line, *coords.ravel().tolist())
+
+    def show_progress_packet(self, packet):
+        """Display a frame still being received - only the rows received since the last update are re-binned."""
+        frame = packet.data2.array
+        filled = packet.data3
+        if (self.roi != None):
+            self.show_full_frame(frame)
+            return
+
+        factor = self.readout_interface.preview_binning
+        if (self.progress_frame != packet.data4 or self.progress_preview is None):
+            # New frame - start from blank, all missing
+            self.progress_preview = np.zeros((frame.shape[0] // factor, frame.shape[1] // factor), dtype=np.uint8)
+            self.progress_rgb = fp.overlay_missing(self.progress_preview, np.ones(self.progress_preview.shape, dtype=bool))
+            self.progress_filled = np.zeros_like(filled)
+            self.progress_frame = packet.data4
+            self.progress_displayed = False
+
+        # Rows with sections received since the last update, plus any the interface reports as rewritten
+        # Progress packets may have been skipped, so the reported range alone is not enough
+        changedRows = np.flatnonzero((filled & ~self.progress_filled).any(axis=1))
+        rowStart, rowEnd = packet.data1
+        if (len(changedRows) > 0):
+            rowStart = min(rowStart, int(changedRows[0]))
+            rowEnd = max(rowEnd, int(changedRows[-1]) + 1)
+        fp.update_preview(self.progress_preview, frame, rowStart, rowEnd, factor, self.readout_interface.display_mapping)
+        self.progress_filled = filled
+
+        # Re-tint and repaint only the preview rows the changed frame rows were binned into
+        top = rowStart // factor
+        bottom = min(-(-rowEnd // factor), self.progress_preview.shape[0])
+        if (bottom > top):
+            missing = fp.missing_sections(filled[top * factor:bottom * factor], self.progress_preview.shape[1], factor)
+            self.progress_rgb[top:bottom] = fp.overlay_missing(self.progress_preview[top:bottom], missing)
+
+        self.view_origin = (0, 0)
+        self.view_scale = IMAGE_WIDTH / self.progress_preview.shape[1]
+        if (self.progress_displayed):
+            if (bottom > top):
+                self.show_frame_rows(self.progress_rgb, top, bottom)
+        else:
+            self.show_frame(self.progress_rgb)
+            self.progress_displayed = True
+
+    def toggle_progressive(self):
+        self.readout_interface.progressive = bool(self.progressive.get())
+        self.progress_preview = None
+        self.progress_frame = None
+        self.progress_displayed = False
+
+    def set_display_curve(self, curve):
+        self.readout_interface.display_mapping.set_curve(curve)
+
+    def toggle_auto_contrast(self):
+        mapping = self.readout_interface.display_mapping
+        if (self.auto_contrast.get()):
+            mapping.auto_contrast = True
+        else:
+            mapping.set_levels(0, fp.MAX_PIXEL_VALUE)
+
+    def canvas_to_frame(self, x, y):
+        """Frame pixel coordinates of a point on the canvas, for the image currently shown."""
+        return (self.view_origin[0] + x * self.view_scale, self.view_origin[1] + y * self.view_scale)
+
+    def on_drag_start(self, event):
+        self.drag_start = (event.x, event.y)
+        self.main_image.coords(self.drag_rectangle, event.x, event.y, event.x, event.y)
+        self.main_image.itemconfig(self.drag_rectangle, state="normal")
+
+    def on_drag(self, event):
+        if (self.drag_start != None):
+            self.main_image.coords(self.drag_rectangle, *self.drag_start, event.x, event.y)
+
+    def on_drag_end(self, event):
+        if (self.drag_start == None):
+            return
+        self.main_image.itemconfig(self.drag_rectangle, state="hidden")
+        isClick = abs(event.x - self.drag_start[0]) < 4 and abs(event.y - self.drag_start[1]) < 4
+        x0, y0 = self.canvas_to_frame(*self.drag_start)
+        x1, y1 = self.canvas_to_frame(event.x, event.y)
+        self.drag_start = None
+
+        if (isClick):
+            # A click - show the canvas-sized area around it at 1:1
+            halfWidth, halfHeight = IMAGE_WIDTH//8, IMAGE_HEIGHT//8
+            x0, y0 = max(0, min(x1 - halfWidth, IMAGE_WIDTH - 2 * halfWidth)), max(0, min(y1 - halfHeight, IMAGE_HEIGHT - 2 * halfHeight))
+            x1, y1 = x0 + 2 * halfWidth, y0 + 2 * halfHeight
+        self.roi = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        print(f"Zoomed to x {int(self.roi[0])}-{int(self.roi[2])}, y {int(self.roi[1])}-{int(self.roi[3])} - right click to reset")
+
+    def reset_zoom(self, event=None):
+        self.roi = None
+
+    def show_frame(self, preview):
+        """
+        Display an 8-bit preview image, reusing the display buffer and canvas item.
+        While progressive display is on the buffer stays RGB, grayscale frames included, so it is not
+        replaced every time a tinted partial frame and a finished frame take turns.
+        Args:
+            preview (np.ndarray): 2D uint8 grayscale image, or (height, width, 3) uint8 RGB image.
+        """
+        frame = Image.fromarray(preview, mode='L' if preview.ndim == 2 else 'RGB') # L = grayscale - ImageTK only supports 8-bit
+        mode = 'RGB' if (self.readout_interface.progressive or preview.ndim == 3) else 'L'
+        if (frame.size != (self.display_image.width(), self.display_image.height()) or mode != self.display_mode):
+            # Preview size or mode changed - replace the buffer once, then carry on pasting into the new one
+            self.display_image = ImageTk.PhotoImage(mode, frame.size)
+            self.display_mode = mode
+            self.main_image.itemconfig(self.display_item, image=self.display_image)
+        self.display_image.paste(frame) # Converted to the buffer's mode if need be
+        self.main_image.itemconfig(self.display_item, state="normal")
+        self.progress_displayed = False
+
+    def show_frame_rows(self, image, top, bottom):
+        """
+        Repaint rows top to bottom of the display from an image already shown with show_frame, leaving the rest untouched.
+        Args:
+            image (np.ndarray): (height, width, 3) uint8 RGB image.
+            top (int): First row to repaint.
+            bottom (int): Row after the last to repaint.
+        """
+        band = ImageTk.PhotoImage(Image.fromarray(image[top:bottom], mode='RGB'))
+        # Tk photo images can copy a region from another in place - ImageTk's paste only replaces the whole image
+        self.window.tk.call(str(self.display_image), "copy", str(band), "-to", 0, top)
 
     def toggle_udp_serial(self):
         if self.transmission_udp: # If already transmitting via UDP
@@ -285,6 +563,7 @@ class MainWindow():
                 elif (not self.ser.is_open):
                     self.ser.open()
                 self.transmission_udp = False
+                self.restart_receiving()
                 self.comm_mode_text.config(state="normal")
                 self.comm_mode_text.delete(1.0, tk.END)
                 self.comm_mode_text.insert(1.0, "Using Serial")
@@ -305,6 +584,7 @@ class MainWindow():
                     self.data, self.addr = self.sock.recvfrom(4096)
                     print(self.addr)
                 self.transmission_udp = True
+                self.restart_receiving()
                 self.comm_mode_text.config(state="normal")
                 self.comm_mode_text.delete(1.0, tk.END)
                 self.comm_mode_text.insert(1.0, "Using UDP")
@@ -314,6 +594,15 @@ class MainWindow():
                 print("Error creating UDP socket (2)")
             
 
+    def restart_receiving(self):
+        """Restart the readout interface's receive pipeline on the link now selected, UDP or serial."""
+        self.readout_interface.stop(timeout=1.0)
+        self.readout_interface.transmission_udp = self.transmission_udp
+        self.readout_interface.socket = self.sock
+        self.readout_interface.remote_address = self.addr
+        self.readout_interface.serial_port = self.ser
+        self.readout_interface.start()
+
     # Custom functions for each button
     def send_reset(self):
         packet = cri.Packet(type=cri.PacketType.TYPE_RESET)
@@ -326,7 +615,7 @@ class MainWindow():
         print("Sent abort packet")
 
     def send_enter_image_collection(self):
-        packet = cri.Packet(type=cri.PacketType.TYPE_IMAGE_COLLECTION_START)
+        packet = cri.Packet(type=cri.PacketType.TYPE_IMAGE_ENABLE)
         self.readout_interface.sendPacket(packet)
         print("Sent enter image collection mode packet")
 
@@ -340,6 +629,41 @@ class MainWindow():
         self.readout_interface.sendPacket(packet)
         print("Sent write to flash packet")
 
+    def toggle_recording(self):
+        if (self.readout_interface.recorder == None):
+            path = os.path.join(IMAGE_SAVE_DIR, f"recording_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.cmosraw")
+            try:
+                self.readout_interface.start_recording(path)
+            except OSError as e:
+                print(f"Unable to start recording: {e}")
+                return
+            self.button_record.config(text="Stop recording raw frames")
+        else:
+            self.readout_interface.stop_recording()
+            self.button_record.config(text="Start recording raw frames")
+
+    def toggle_stacking(self):
+        if (self.readout_interface.stacker == None):
+            self.readout_interface.start_stacking(self.stack_mode.get())
+            self.button_stack.config(text="Stop stacking")
+        else:
+            stacker = self.readout_interface.stop_stacking()
+            print(f"Stacked {stacker.count} frames")
+            self.button_stack.config(text="Start stacking")
+
+    def toggle_capture(self):
+        if (self.readout_interface.capture == None):
+            path = os.path.join(IMAGE_SAVE_DIR, f"capture_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.cmoscap")
+            try:
+                self.readout_interface.start_capture(path)
+            except OSError as e:
+                print(f"Unable to start packet capture: {e}")
+                return
+            self.button_capture.config(text="Stop packet capture")
+        else:
+            self.readout_interface.stop_capture()
+            self.button_capture.config(text="Start packet capture")
+
     def open_popup(self):
         top = tk.Toplevel()
         top.option_add("*Font", "Consolas 12")
@@ -495,8 +819,20 @@ class MainWindow():
 
     def on_closing(self):
         print("Closing GUI")
-        # Set a flag to stop the processing thread
+        # Stop updating the display
         self.running = False
+        self.window.after_cancel(self.update_job)
+        # Stop the readout interface's receive pipeline
+        self.readout_interface.stop(timeout=1.0)
+        self.readout_interface.stop_recording()
+        self.readout_interface.stop_capture()
+        self.readout_interface.close_decode_workers()
+        # Finish writing any images still queued to disk
+        print("Saving queued images...")
+        if not self.readout_interface.close_image_writer(timeout=10.0):
+            print("Timed out saving images")
+        # Write out any events still queued for the log
+        self.readout_interface.logger.flush(timeout=1.0)
         # Close UDP socket if it exists
         if self.sock:
             print("Closing UDP socket...")
@@ -505,20 +841,24 @@ class MainWindow():
         if self.ser and self.ser.is_open:
             print("Closing serial...")
             self.ser.close()
-        # Wait for processor thread to finish
-        if self.processor_thread.is_alive():
-            self.processor_thread.join(timeout=1.0)
 
         sys.stdout = sys.__stdout__  # Restore original stdout
+        self.console.close()
         self.window.destroy()
 
 
-def udp_start():
+def parse_options():
     parser = optparse.OptionParser()
     parser.add_option("-p", "--port", dest="port", type="int", default=DEFAULT_PORT, help="Port to listen on [default: %default].")
     parser.add_option("--hostname", dest="hostname", default=DEFAULT_IP, help="Hostname to listen on.")
+    parser.add_option("--fps", dest="fps", type="float", default=DEFAULT_DISPLAY_FPS, help="Most display updates per second [default: %default].")
+    parser.add_option("--decode-workers", dest="decode_workers", type="int", default=0, help="Worker processes decoding image packets, 0 to decode on a thread [default: %default].")
 
     (options, args) = parser.parse_args()
+    return options
+
+def udp_start():
+    options = parse_options()
 
     return echo_server(options.hostname, options.port)
 
@@ -545,7 +885,8 @@ def create_gui():
     root.title("CMOS Readout System Test System")
 
     # Load the window
-    window = MainWindow(root)
+    options = parse_options()
+    window = MainWindow(root, display_fps=options.fps, decode_workers=options.decode_workers)
 
 
     # Run the Tkinter event loop - no code runs beyond here
@@ -555,6 +896,9 @@ def create_gui():
 
 
 if __name__ == "__main__":
+    # In a pyinstaller executable, lets decode worker processes (--decode-workers) start as workers rather than rerun the GUI
+    multiprocessing.freeze_support()
+
     if not os.path.exists(IMAGE_SAVE_DIR): # Create directory if it does not exist
         os.makedirs(IMAGE_SAVE_DIR)
 